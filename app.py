@@ -4,21 +4,39 @@ Autor: Sistema Havaianas
 Versão: 2.0 - com Configurações Profissionais de Impressão
 """
 
-from flask import Flask, render_template, request, jsonify, flash, redirect, url_for, send_file, session
+from flask import Flask, render_template, request, jsonify, flash, redirect, url_for, send_file, session, has_request_context
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime, timedelta
-from sqlalchemy import func
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import func, update, insert, event, tuple_, text, table, column, bindparam
+from sqlalchemy.orm import Session as SessaoORM, aliased
 from sqlalchemy.sql import case  
+from sqlalchemy.exc import OperationalError, IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
 from werkzeug.utils import secure_filename
 from flask import send_from_directory
+from flask.helpers import get_debug_flag
+import click
 from PIL import Image
 import os
 import json
 import time 
+import random
+import bisect
+import threading
 import shutil
 import humanize
 import subprocess  # ← Este é necessário
 import re  # ← Este é necessário
+import unicodedata
+import xml.etree.ElementTree as ET
+import csv
+import hashlib
+import queue
+import sqlite3
+import gzip
+import atexit
+import codecs
+from functools import lru_cache
 # ========== CORREÇÃO ULTRA ROBUSTA PARA EMOJIS ==========
 import sys
 import io
@@ -84,13 +102,19 @@ instance_path = os.path.join(BASE_DIR, 'instance')
 db_path = os.path.join(instance_path, 'database.db')
 app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{db_path}'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Vários terminais PDV no mesmo arquivo: espera o lock antes de devolver SQLITE_BUSY
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'connect_args': {'timeout': 10}}
 
 # Pastas de upload
 app.config['UPLOAD_FOLDER'] = os.path.join(BASE_DIR, 'uploads')
 app.config['BACKUP_FOLDER'] = os.path.join(instance_path, 'backups')
 
+# Movimentações mais velhas que isso vão para instance/archive_AAAA.db (ver arquivar_movimentacoes)
+app.config['HORIZONTE_MOVIMENTACOES_DIAS'] = 400
+
 # Configurações para upload
 app.config['MAX_CONTENT_LENGTH'] = 2 * 1024 * 1024  # 2MB
+LIMITE_UPLOAD_IMPORTACAO = 64 * 1024 * 1024  # NF-e e planilhas: ajustado na própria rota
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'webp'}
 
 def allowed_file(filename):
@@ -137,11 +161,51 @@ def criar_thumbnail(caminho_original, nome_arquivo):
         return None
 # ========================================
 
+# ===== MAPA DE IMAGENS DE PRODUTOS =====
+class MapaImagens:
+    """Conjunto em memória dos arquivos de uploads/produtos.
+
+    Evita um os.path.exists por produto: a listagem só é refeita quando o
+    mtime da pasta muda (arquivo criado/removido) ou quando o próprio
+    sistema salva/apaga uma imagem e chama invalidar().
+    """
+
+    def __init__(self, pasta):
+        self.pasta = pasta
+        self._arquivos = frozenset()
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def invalidar(self):
+        self._mtime = None
+
+    def arquivos(self):
+        try:
+            mtime = os.stat(self.pasta).st_mtime_ns
+        except OSError:
+            return frozenset()
+        if mtime != self._mtime:
+            with self._lock:
+                if mtime != self._mtime:
+                    try:
+                        self._arquivos = frozenset(os.listdir(self.pasta))
+                        self._mtime = mtime
+                    except OSError as e:
+                        print(f"⚠️ Erro ao listar imagens: {e}")
+        return self._arquivos
+
+    def existe(self, nome):
+        return bool(nome) and nome in self.arquivos()
+
+mapa_imagens = MapaImagens(os.path.join(app.config['UPLOAD_FOLDER'], 'produtos'))
+# ========================================
+
 # ========== MODELOS DO BANCO ==========
 class Produto(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     sku = db.Column(db.String(50), unique=True, nullable=False)
     descricao = db.Column(db.String(200))
+    descricao_busca = db.Column(db.String(200), index=True)  # descricao sem acento/minúscula (normalizar_busca)
     modelo = db.Column(db.String(50))
     colecao = db.Column(db.String(100))
     genero = db.Column(db.String(20))
@@ -151,6 +215,7 @@ class Produto(db.Model):
     ativo = db.Column(db.Boolean, default=True)
     data_cadastro = db.Column(db.DateTime, default=datetime.utcnow)
     imagem = db.Column(db.String(200), nullable=True)
+    alteracao = db.Column(db.Integer, nullable=False, default=0, index=True)  # Versão do catálogo na última alteração
     grades = db.relationship('Grade', backref='produto', lazy=True, cascade='all, delete-orphan')
     
     def __repr__(self):
@@ -160,14 +225,19 @@ class Grade(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     produto_id = db.Column(db.Integer, db.ForeignKey('produto.id'), nullable=False)
     cor = db.Column(db.String(50))
+    cor_busca = db.Column(db.String(50), index=True)  # cor sem acento/minúscula (normalizar_busca)
     tamanho = db.Column(db.String(10))
     estoque_atual = db.Column(db.Integer, default=0)
     estoque_minimo = db.Column(db.Integer, default=5)
     estoque_maximo = db.Column(db.Integer, default=50)
     sku_grade = db.Column(db.String(100), unique=True)
+    ean = db.Column(db.String(14), unique=True, index=True)  # Código de barras EAN-13/GTIN
     localizacao = db.Column(db.String(50), default='PRATELEIRA-A')
+    versao = db.Column(db.Integer, nullable=False, default=0)  # Controle otimista entre terminais
+    alteracao = db.Column(db.Integer, nullable=False, default=0, index=True)  # Versão do catálogo na última alteração
     
     __table_args__ = (db.UniqueConstraint('produto_id', 'cor', 'tamanho'),)
+    __mapper_args__ = {'version_id_col': versao}
     
     def atualizar_estoque(self, quantidade, tipo):
         if tipo == 'ENTRADA':
@@ -185,19 +255,78 @@ class Grade(db.Model):
         db.session.add(mov)
         return self
 
+# SKU é digitado em qualquer caixa e as grades do recebimento têm cor em caixa mista:
+# o autocomplete compara com COLLATE NOCASE, que usa estes índices para as faixas
+db.Index('ix_produto_sku_nocase', Produto.__table__.c.sku.collate('NOCASE'))
+db.Index('ix_grade_sku_grade_nocase', Grade.__table__.c.sku_grade.collate('NOCASE'))
+
+class ContadorCatalogo(db.Model):
+    """Versão do catálogo: sobe a cada commit que altera grades ou produtos"""
+    __tablename__ = 'contador_catalogo'
+    id = db.Column(db.Integer, primary_key=True)
+    valor = db.Column(db.Integer, nullable=False, default=0)
+
+class GradeRemovida(db.Model):
+    """Grades apagadas, para o feed do catálogo avisar os terminais"""
+    __tablename__ = 'grade_removida'
+    grade_id = db.Column(db.Integer, primary_key=True)
+    alteracao = db.Column(db.Integer, nullable=False, index=True)
+
 class Movimentacao(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     tipo = db.Column(db.String(10))
     grade_id = db.Column(db.Integer, db.ForeignKey('grade.id'))
     quantidade = db.Column(db.Integer)
-    data = db.Column(db.DateTime, default=hora_brasil)
+    data = db.Column(db.DateTime, default=hora_brasil, index=True)
     origem = db.Column(db.String(100))
-    documento = db.Column(db.String(100))
+    documento = db.Column(db.String(100), index=True)  # V-<venda>, INV-<inventário>, nota fiscal
     observacao = db.Column(db.Text)
     usuario = db.Column(db.String(100), default='Sistema')
+    sinal = db.Column(db.Integer)  # AJUSTE: +1 ou -1 (a quantidade fica sempre positiva)
     
     grade = db.relationship('Grade', backref='movimentacoes')
 
+class ImportacaoEstoque(db.Model):
+    """Importação de planilha de estoque (XLSX/CSV) processada em segundo plano"""
+    __tablename__ = 'importacao_estoque'
+    id = db.Column(db.Integer, primary_key=True)
+    arquivo = db.Column(db.String(200))   # nome enviado pelo usuário
+    caminho = db.Column(db.String(500))   # cópia em instance/importacoes até terminar
+    codificacao = db.Column(db.String(20))  # CSV: detectada no upload (utf-8-sig ou cp1252)
+    hash_arquivo = db.Column(db.String(64))  # sha256: a mesma planilha não entra de novo enquanto a outra não terminar
+    origem = db.Column(db.String(100))    # fornecedor / 'Saldo inicial', vai para as movimentações
+    status = db.Column(db.String(20), default='pendente', index=True)  # pendente, processando, concluido, erro
+    total_linhas = db.Column(db.Integer)  # linhas de dados, contadas na validação do upload
+    linhas_lidas = db.Column(db.Integer, default=0)  # gravado no mesmo commit do lote: retoma daqui (também depois de erro)
+    linhas_aplicadas = db.Column(db.Integer, default=0)
+    linhas_rejeitadas = db.Column(db.Integer, default=0)
+    itens = db.Column(db.Integer, default=0)
+    erros = db.Column(db.Text)  # JSON com as primeiras rejeições [{linha, motivo}]
+    mensagem = db.Column(db.Text)
+    usuario = db.Column(db.String(100), default='Sistema')
+    data_criacao = db.Column(db.DateTime, default=hora_brasil)
+    data_conclusao = db.Column(db.DateTime)
+
+class FechamentoEstoque(db.Model):
+    """Fotografia do estoque (fechamento diário ou sob demanda)"""
+    __tablename__ = 'fechamento_estoque'
+    id = db.Column(db.Integer, primary_key=True)
+    momento = db.Column(db.DateTime, nullable=False, default=hora_brasil, index=True)
+    grades = db.Column(db.Integer, default=0)  # saldos gravados neste fechamento
+    usuario = db.Column(db.String(100), default='Sistema')
+
+class SaldoFechamento(db.Model):
+    """Saldo de uma grade num fechamento; só entram as grades que mudaram desde o fechamento anterior"""
+    __tablename__ = 'saldo_fechamento'
+    fechamento_id = db.Column(db.Integer, db.ForeignKey('fechamento_estoque.id'), primary_key=True)
+    grade_id = db.Column(db.Integer, primary_key=True)  # sem FK: grades apagadas ficam no histórico
+    estoque = db.Column(db.Integer, nullable=False)
+    
+    __table_args__ = (
+        db.Index('ix_saldo_fechamento_grade', 'grade_id', 'fechamento_id', 'estoque'),
+        {'sqlite_with_rowid': False},
+    )
+
 class Venda(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     data = db.Column(db.DateTime, default=hora_brasil)
@@ -210,11 +339,24 @@ class Venda(db.Model):
     status = db.Column(db.String(20), default='FINALIZADA')
     subtotal = db.Column(db.Float, default=0)
     desconto_percentual = db.Column(db.Float, default=0)
+    comprovante_json = db.Column(db.Text)  # Comprovante congelado no momento da venda
     itens = db.relationship('ItemVenda', backref='venda', lazy=True, cascade='all, delete-orphan')
+    
+    # Histórico do PDV pagina por (data, id) em ordem decrescente
+    __table_args__ = (db.Index('ix_venda_data_id', 'data', 'id'),)
+
+class ChaveIdempotencia(db.Model):
+    """Chave enviada pelo terminal em cada venda; reenvios devolvem a resposta original"""
+    __tablename__ = 'chave_idempotencia'
+    chave = db.Column(db.String(64), primary_key=True)
+    venda_id = db.Column(db.Integer, index=True)
+    hash_corpo = db.Column(db.String(64))  # SHA-256 do corpo da venda; reenvio com outro corpo é recusado
+    resposta = db.Column(db.Text, nullable=False)
+    data_criacao = db.Column(db.DateTime, default=hora_brasil, index=True)
 
 class ItemVenda(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    venda_id = db.Column(db.Integer, db.ForeignKey('venda.id'))
+    venda_id = db.Column(db.Integer, db.ForeignKey('venda.id'), index=True)
     grade_id = db.Column(db.Integer, db.ForeignKey('grade.id'))
     quantidade = db.Column(db.Integer)
     preco_unitario = db.Column(db.Float)
@@ -292,12 +434,16 @@ class ConfigComprovante(db.Model):
 class Cliente(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     nome = db.Column(db.String(200), nullable=False)
+    nome_busca = db.Column(db.String(200), index=True)  # nome sem acento/minúscula (normalizar_busca)
     tipo = db.Column(db.String(10), default='FISICA')
     cpf_cnpj = db.Column(db.String(20), unique=True)
+    cpf_cnpj_digitos = db.Column(db.String(20), index=True)  # só os números (apenas_digitos)
     rg = db.Column(db.String(20))
     email = db.Column(db.String(100))
     telefone = db.Column(db.String(20))
+    telefone_digitos = db.Column(db.String(20), index=True)
     celular = db.Column(db.String(20), nullable=False)
+    celular_digitos = db.Column(db.String(20), index=True)
     whatsapp = db.Column(db.Boolean, default=False)
     logradouro = db.Column(db.String(200))
     numero = db.Column(db.String(10))
@@ -307,7 +453,7 @@ class Cliente(db.Model):
     estado = db.Column(db.String(2))
     cep = db.Column(db.String(10))
     observacoes = db.Column(db.Text)
-    ativo = db.Column(db.Boolean, default=True)
+    ativo = db.Column(db.Boolean, default=True, index=True)
     data_cadastro = db.Column(db.DateTime, default=hora_brasil)
     total_vendas = db.Column(db.Integer, default=0)
     total_gasto = db.Column(db.Float, default=0.0)
@@ -315,12 +461,16 @@ class Cliente(db.Model):
 class Fornecedor(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     razao_social = db.Column(db.String(200), nullable=False)
+    razao_social_busca = db.Column(db.String(200), index=True)  # razao_social sem acento/minúscula (normalizar_busca)
     nome_fantasia = db.Column(db.String(200))
     cnpj = db.Column(db.String(20), unique=True, nullable=False)
+    cnpj_digitos = db.Column(db.String(20), index=True)  # só os números (apenas_digitos)
     inscricao_estadual = db.Column(db.String(20))
     email = db.Column(db.String(100))
     telefone = db.Column(db.String(20))
+    telefone_digitos = db.Column(db.String(20), index=True)
     celular = db.Column(db.String(20))
+    celular_digitos = db.Column(db.String(20), index=True)
     responsavel = db.Column(db.String(100))
     logradouro = db.Column(db.String(200))
     numero = db.Column(db.String(10))
@@ -335,6 +485,33 @@ class Fornecedor(db.Model):
     total_compras = db.Column(db.Integer, default=0)
     valor_total_compras = db.Column(db.Float, default=0.0)
 
+class CodigoFornecedor(db.Model):
+    """Código do produto no fornecedor (cProd da NF-e) -> grade, gravado ao importar notas"""
+    __tablename__ = 'codigo_fornecedor'
+    id = db.Column(db.Integer, primary_key=True)
+    cnpj = db.Column(db.String(14), nullable=False)  # só os números, do emitente da nota
+    codigo = db.Column(db.String(60), nullable=False)
+    descricao = db.Column(db.String(200))  # xProd, só para conferência
+    grade_id = db.Column(db.Integer, db.ForeignKey('grade.id'), nullable=False)
+    data_cadastro = db.Column(db.DateTime, default=hora_brasil)
+    
+    __table_args__ = (db.UniqueConstraint('cnpj', 'codigo'),)
+
+class NotaEntrada(db.Model):
+    """NF-e de fornecedor: a prévia guarda aqui as linhas lidas do XML e a confirmação lança só elas"""
+    __tablename__ = 'nota_entrada'
+    id = db.Column(db.Integer, primary_key=True)
+    chave = db.Column(db.String(60), unique=True, nullable=False)  # chNFe (44 dígitos) ou CNPJ-série-número
+    numero = db.Column(db.String(20))
+    serie = db.Column(db.String(5))
+    cnpj = db.Column(db.String(14))
+    fornecedor = db.Column(db.String(200))
+    itens = db.Column(db.Text)  # JSON [{codigo, descricao, ean, quantidade}] do XML
+    status = db.Column(db.String(20), default='previa')  # previa, lancada
+    usuario = db.Column(db.String(100))
+    data_criacao = db.Column(db.DateTime, default=hora_brasil)
+    data_lancamento = db.Column(db.DateTime)
+
 # ========== MODELO DE USUÁRIO PARA LOGIN ==========
 class Usuario(db.Model):
     """Modelo para autenticação de usuários no sistema"""
@@ -435,6 +612,111 @@ class Impressora(db.Model):
     ativo = db.Column(db.Boolean, default=True)
     data_cadastro = db.Column(db.DateTime, default=hora_brasil)
 
+class TrabalhoImpressao(db.Model):
+    """Fila persistente de impressão (spooler)"""
+    __tablename__ = 'trabalho_impressao'
+    id = db.Column(db.Integer, primary_key=True)
+    tipo = db.Column(db.String(20), default='comprovante')  # comprovante, teste
+    venda_id = db.Column(db.Integer, index=True)
+    impressora_id = db.Column(db.Integer)  # Impressora cadastrada; vazio = fila do Windows pelo nome
+    impressora_nome = db.Column(db.String(100))
+    papel = db.Column(db.String(10), default='80mm')
+    vias = db.Column(db.Integer, default=1)
+    vias_impressas = db.Column(db.Integer, default=0)
+    status = db.Column(db.String(20), default='pendente', index=True)  # pendente, imprimindo, concluido, erro
+    tentativas = db.Column(db.Integer, default=0)  # falhas seguidas
+    erro = db.Column(db.Text)
+    data_criacao = db.Column(db.DateTime, default=hora_brasil)
+    data_conclusao = db.Column(db.DateTime)
+
+# ========== TEXTO NORMALIZADO PARA BUSCA ==========
+def normalizar_busca(texto):
+    """'  Tradiçao  CAFÉ ' -> 'tradicao cafe' (sem acento, minúsculo, espaços simples)"""
+    if not texto:
+        return ''
+    texto = str(texto)
+    if not texto.isascii():
+        texto = unicodedata.normalize('NFKD', texto)
+        texto = ''.join(c for c in texto if not unicodedata.combining(c))
+    return ' '.join(texto.lower().split())
+
+def apenas_digitos(texto):
+    """'(11) 98765-4321' -> '11987654321'"""
+    return re.sub(r'\D', '', str(texto)) if texto else ''
+
+def filtro_prefixo(coluna, prefixo):
+    """coluna começa com `prefixo`, como faixa (>= / <) para usar o índice B-tree"""
+    return db.and_(coluna >= prefixo, coluna < prefixo + '\U0010ffff')
+
+def condicoes_digitos(termo, *colunas):
+    """Prefixo dos números digitados em cada coluna *_digitos (nenhuma condição se não há número)"""
+    digitos = apenas_digitos(termo)
+    return [filtro_prefixo(coluna, digitos) for coluna in colunas] if digitos else []
+
+# (modelo, coluna original, coluna normalizada, normalização) mantidas em sincronia na escrita
+COLUNAS_BUSCA = [
+    (Produto, 'descricao', 'descricao_busca', normalizar_busca),
+    (Grade, 'cor', 'cor_busca', normalizar_busca),
+    (Cliente, 'nome', 'nome_busca', normalizar_busca),
+    (Cliente, 'cpf_cnpj', 'cpf_cnpj_digitos', apenas_digitos),
+    (Cliente, 'telefone', 'telefone_digitos', apenas_digitos),
+    (Cliente, 'celular', 'celular_digitos', apenas_digitos),
+    (Fornecedor, 'razao_social', 'razao_social_busca', normalizar_busca),
+    (Fornecedor, 'cnpj', 'cnpj_digitos', apenas_digitos),
+    (Fornecedor, 'telefone', 'telefone_digitos', apenas_digitos),
+    (Fornecedor, 'celular', 'celular_digitos', apenas_digitos),
+]
+
+def _registrar_coluna_busca(modelo, origem, sombra, normalizar):
+    def ao_inserir(mapper, connection, alvo):
+        valor = getattr(alvo, origem)
+        setattr(alvo, sombra, normalizar(valor) if valor is not None else None)
+    
+    def ao_atualizar(mapper, connection, alvo):
+        # Só quando a coluna original mudou (não carrega nada a mais no flush)
+        if db.inspect(alvo).attrs[origem].history.has_changes():
+            ao_inserir(mapper, connection, alvo)
+    
+    event.listen(modelo, 'before_insert', ao_inserir)
+    event.listen(modelo, 'before_update', ao_atualizar)
+
+for _coluna_busca in COLUNAS_BUSCA:
+    _registrar_coluna_busca(*_coluna_busca)
+
+def preencher_colunas_busca(todas=False):
+    """Preenche as colunas *_busca vazias (ou recalcula todas). Devolve quantas linhas mudaram.
+    
+    Cobre bancos antigos e linhas gravadas sem passar pelo ORM.
+    """
+    total = 0
+    for modelo, origem, sombra, normalizar in COLUNAS_BUSCA:
+        tabela = modelo.__table__
+        consulta = db.select(tabela.c.id, tabela.c[origem])
+        if not todas:
+            consulta = consulta.where(tabela.c[sombra].is_(None), tabela.c[origem].isnot(None))
+        linhas = db.session.execute(consulta).all()
+        if not linhas:
+            continue
+        
+        atualizar = (tabela.update().where(tabela.c.id == db.bindparam('b_id'))
+                     .values({sombra: db.bindparam('b_valor')}))
+        for inicio in range(0, len(linhas), 1000):
+            db.session.execute(atualizar, [
+                {'b_id': linha_id, 'b_valor': normalizar(valor) if valor is not None else None}
+                for linha_id, valor in linhas[inicio:inicio + 1000]
+            ])
+        total += len(linhas)
+        print(f"🔧 {tabela.name}.{sombra}: {len(linhas)} linha(s) normalizada(s)")
+    db.session.commit()
+    return total
+
+@app.cli.command('preencher-busca')
+@click.option('--todas', is_flag=True, help='Recalcula todas as linhas, não só as vazias')
+def comando_preencher_busca(todas):
+    """Preenche as colunas normalizadas de busca (textos sem acento, documentos e telefones só com números)"""
+    total = preencher_colunas_busca(todas=todas)
+    print(f"✅ {total} linha(s) atualizada(s)")
+
 # ========== FUNÇÕES PARA TEMPLATES ==========  
 def cor_para_hex(cor_nome):
     """Converte nome de cor para código hexadecimal"""
@@ -520,6 +802,23 @@ def format_cnpj(cnpj):
 app.jinja_env.filters['format_cpf'] = format_cpf
 app.jinja_env.filters['format_cnpj'] = format_cnpj
 
+# ========== CÓDIGO DE BARRAS (EAN/GTIN) ==========
+def normalizar_ean(codigo):
+    """Valida um EAN-8/UPC-A/EAN-13/GTIN-14 e devolve só os dígitos (ou None se vazio)"""
+    if not codigo:
+        return None
+    digitos = re.sub(r'\D', '', str(codigo))
+    if not digitos:
+        return None
+    if len(digitos) not in (8, 12, 13, 14):
+        raise ValueError(f'EAN inválido: {codigo}')
+    
+    # Dígito verificador GTIN: pesos 3 e 1 alternados da direita para a esquerda
+    soma = sum(int(d) * (3 if i % 2 == 0 else 1) for i, d in enumerate(reversed(digitos[:-1])))
+    if (10 - soma % 10) % 10 != int(digitos[-1]):
+        raise ValueError(f'EAN inválido (dígito verificador): {codigo}')
+    return digitos
+
 @app.context_processor
 def utility_processor():
     def get_now():
@@ -1050,6 +1349,197 @@ def perfil_alterar_senha():
     
     return redirect(url_for('perfil'))
 
+# ========== BUSCA TEXTUAL (FTS5) ==========
+# Índices full-text do SQLite para as buscas de produtos e grades. As tabelas
+# virtuais são mantidas por triggers no próprio banco, então qualquer escrita
+# (ORM, UPDATE em lote, importação) já sai indexada. O tokenizer ignora
+# acentos e maiúsculas; cada palavra digitada vira um prefixo ("trad" acha
+# "Tradiçao") e todas precisam aparecer.
+BUSCA_FTS_TOKENIZER = "tokenize='unicode61 remove_diacritics 2', prefix='2 3'"
+
+BUSCA_FTS_DDL = [
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS busca_produto USING fts5(
+        sku, descricao, modelo, colecao, {BUSCA_FTS_TOKENIZER})""",
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS busca_grade USING fts5(
+        sku, descricao, modelo, colecao, sku_grade, cor, tamanho, {BUSCA_FTS_TOKENIZER})""",
+    """CREATE TRIGGER IF NOT EXISTS busca_produto_ai AFTER INSERT ON produto BEGIN
+        INSERT INTO busca_produto (rowid, sku, descricao, modelo, colecao)
+        VALUES (new.id, new.sku, new.descricao, new.modelo, new.colecao);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS busca_produto_au AFTER UPDATE OF sku, descricao, modelo, colecao ON produto BEGIN
+        UPDATE busca_produto SET sku = new.sku, descricao = new.descricao, modelo = new.modelo, colecao = new.colecao
+        WHERE rowid = new.id;
+        UPDATE busca_grade SET sku = new.sku, descricao = new.descricao, modelo = new.modelo, colecao = new.colecao
+        WHERE rowid IN (SELECT id FROM grade WHERE produto_id = new.id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS busca_produto_ad AFTER DELETE ON produto BEGIN
+        DELETE FROM busca_produto WHERE rowid = old.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS busca_grade_ai AFTER INSERT ON grade BEGIN
+        INSERT INTO busca_grade (rowid, sku, descricao, modelo, colecao, sku_grade, cor, tamanho)
+        SELECT new.id, p.sku, p.descricao, p.modelo, p.colecao, new.sku_grade, new.cor, new.tamanho
+        FROM (SELECT 1) LEFT JOIN produto p ON p.id = new.produto_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS busca_grade_au AFTER UPDATE OF produto_id, sku_grade, cor, tamanho ON grade BEGIN
+        DELETE FROM busca_grade WHERE rowid = old.id;
+        INSERT INTO busca_grade (rowid, sku, descricao, modelo, colecao, sku_grade, cor, tamanho)
+        SELECT new.id, p.sku, p.descricao, p.modelo, p.colecao, new.sku_grade, new.cor, new.tamanho
+        FROM (SELECT 1) LEFT JOIN produto p ON p.id = new.produto_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS busca_grade_ad AFTER DELETE ON grade BEGIN
+        DELETE FROM busca_grade WHERE rowid = old.id;
+    END""",
+]
+
+# Pesos do BM25 por coluna (códigos valem mais que texto livre)
+BUSCA_FTS_RANK = {
+    'busca_produto': 'bm25(10.0, 4.0, 2.0, 1.0)',
+    'busca_grade': 'bm25(10.0, 4.0, 2.0, 1.0, 10.0, 3.0, 3.0)',
+}
+
+busca_produto_fts = table('busca_produto', column('rowid'), column('busca_produto'), column('rank'))
+busca_grade_fts = table('busca_grade', column('rowid'), column('busca_grade'), column('rank'))
+BUSCA_FTS_ATIVA = False
+
+def criar_busca_textual():
+    """Cria (se preciso) as tabelas FTS5 e os triggers; na primeira vez indexa o que já existe"""
+    global BUSCA_FTS_ATIVA
+    try:
+        with db.engine.begin() as conn:
+            existia = conn.execute(text(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'busca_grade'"
+            )).scalar()
+            for ddl in BUSCA_FTS_DDL:
+                conn.execute(text(ddl))
+            if not existia:
+                reconstruir_busca_textual(conn)
+        BUSCA_FTS_ATIVA = True
+    except OperationalError as e:
+        # SQLite compilado sem FTS5: as buscas continuam no LIKE antigo
+        BUSCA_FTS_ATIVA = False
+        print(f"⚠️ Busca textual (FTS5) indisponível: {e}")
+
+def reconstruir_busca_textual(conn):
+    """Reindexa produtos e grades do zero"""
+    conn.execute(text('DELETE FROM busca_produto'))
+    conn.execute(text('DELETE FROM busca_grade'))
+    conn.execute(text(
+        'INSERT INTO busca_produto (rowid, sku, descricao, modelo, colecao) '
+        'SELECT id, sku, descricao, modelo, colecao FROM produto'
+    ))
+    conn.execute(text(
+        'INSERT INTO busca_grade (rowid, sku, descricao, modelo, colecao, sku_grade, cor, tamanho) '
+        'SELECT g.id, p.sku, p.descricao, p.modelo, p.colecao, g.sku_grade, g.cor, g.tamanho '
+        'FROM grade g LEFT JOIN produto p ON p.id = g.produto_id'
+    ))
+    for tabela, rank in BUSCA_FTS_RANK.items():
+        conn.execute(text(f"INSERT INTO {tabela} ({tabela}, rank) VALUES ('rank', :rank)"), {'rank': rank})
+        conn.execute(text(f"INSERT INTO {tabela} ({tabela}) VALUES ('optimize')"))
+    print("🔎 Índice de busca textual (FTS5) reconstruído")
+
+def expressao_fts(termo, colunas=None):
+    """Texto digitado -> expressão MATCH do FTS5 (cada palavra vira prefixo, todas obrigatórias)"""
+    palavras = re.findall(r'\w+', termo or '')
+    if not palavras:
+        return None
+    expressao = ' '.join(f'"{palavra}"*' for palavra in palavras)
+    if colunas:
+        expressao = '{%s} : (%s)' % (' '.join(colunas), expressao)
+    return expressao
+
+def restringir_busca(query, indice, chave, termo, campos):
+    """Restringe `query` às linhas cujo texto em `campos` casa com `termo`.
+    
+    Usa o índice FTS5 `indice` (junção por rowid = `chave`) e devolve junto a
+    coluna de relevância (BM25, menor = melhor). Sem FTS5 cai no contains()
+    sobre os mesmos campos e a relevância volta como None.
+    """
+    expressao = expressao_fts(termo, [campo.name for campo in campos]) if BUSCA_FTS_ATIVA else None
+    if expressao is None:
+        return query.filter(db.or_(*(campo.contains(termo) for campo in campos))), None
+    return (query.join(indice, indice.c.rowid == chave)
+            .filter(indice.c[indice.name].op('MATCH')(expressao))), indice.c.rank
+
+def filtrar_busca(query, indice, chave, termo, campos):
+    """Como restringir_busca(), já ordenando por relevância"""
+    query, rank = restringir_busca(query, indice, chave, termo, campos)
+    return query.order_by(rank) if rank is not None else query
+
+def ranking_produtos(termo, limite=10):
+    """Top `limite` produtos para o autocomplete, numa única consulta.
+    
+    Cada produto entra pelo melhor motivo: SKU exato (0), prefixo do SKU (1),
+    prefixo do SKU de uma das grades (2) ou texto da descrição/SKU no FTS (3);
+    empates pelo BM25 e depois pelo SKU. Os ramos de SKU são faixas sem
+    diferença de maiúsculas nos índices NOCASE e cada ramo já sai limitado.
+    Só produtos ativos. Devolve linhas (produto, grade), com a grade só
+    quando o produto veio por ela.
+    """
+    termo_sku = termo.strip()
+    sku = Produto.sku.collate('NOCASE')
+    sku_grade = Grade.sku_grade.collate('NOCASE')
+    
+    por_sku = (
+        db.select(
+            Produto.id.label('produto_id'),
+            db.null().label('grade_id'),
+            case((sku == termo_sku, 0), else_=1).label('peso'),
+            db.literal(0.0).label('rank'),
+        )
+        .where(Produto.ativo == True, filtro_prefixo(sku, termo_sku))
+        .order_by(sku).limit(limite)
+    )
+    # Uma linha por produto, com a menor grade da faixa (no SQLite as colunas soltas
+    # vêm da linha do min()); a grade exata, se houver, é a menor
+    menor_sku_grade = func.min(sku_grade)
+    por_grade = (
+        db.select(
+            Grade.produto_id.label('produto_id'),
+            Grade.id.label('grade_id'),
+            case((func.upper(menor_sku_grade) == termo_sku.upper(), 0), else_=2).label('peso'),
+            db.literal(0.0).label('rank'),
+        )
+        .join(Produto, Produto.id == Grade.produto_id)
+        .where(Produto.ativo == True, filtro_prefixo(sku_grade, termo_sku))
+        .group_by(Grade.produto_id)
+        .order_by(menor_sku_grade).limit(limite)
+    )
+    por_texto, rank = restringir_busca(
+        db.select(
+            Produto.id.label('produto_id'),
+            db.null().label('grade_id'),
+            db.literal(3).label('peso'),
+        ).where(Produto.ativo == True),
+        busca_produto_fts, Produto.id, termo, [Produto.sku, Produto.descricao]
+    )
+    if rank is None:
+        por_texto = por_texto.add_columns(db.literal(0.0).label('rank')).order_by(Produto.sku)
+    else:
+        por_texto = por_texto.add_columns(rank.label('rank')).order_by(rank)
+    por_texto = por_texto.limit(limite)
+    
+    # O SQLite não aceita ORDER BY/LIMIT direto em partes de um UNION
+    candidatos = db.union_all(*(
+        db.select(ramo.subquery().c) for ramo in (por_sku, por_grade, por_texto)
+    )).subquery('candidatos')
+    
+    melhores = db.select(
+        candidatos,
+        func.row_number().over(
+            partition_by=candidatos.c.produto_id,
+            order_by=(candidatos.c.peso, candidatos.c.rank)
+        ).label('posicao')
+    ).subquery('melhores')
+    
+    return db.session.execute(
+        db.select(Produto, Grade)
+        .join(melhores, melhores.c.produto_id == Produto.id)
+        .outerjoin(Grade, Grade.id == melhores.c.grade_id)
+        .where(melhores.c.posicao == 1)
+        .order_by(melhores.c.peso, melhores.c.rank, Produto.sku)
+        .limit(limite)
+    ).all()
+
 # ========== ROTAS DE PRODUTOS ==========
 @app.route('/produtos')
 def produtos():
@@ -1064,12 +1554,8 @@ def produtos():
         query = Produto.query.filter_by(ativo=True)
     
     if busca:
-        query = query.filter(
-            (Produto.sku.contains(busca)) |
-            (Produto.descricao.contains(busca)) |
-            (Produto.modelo.contains(busca)) |
-            (Produto.colecao.contains(busca))
-        )
+        query = filtrar_busca(query, busca_produto_fts, Produto.id, busca,
+                              [Produto.sku, Produto.descricao, Produto.modelo, Produto.colecao])
     
     if filtro == 'inativos':
         produtos_list = query.order_by(
@@ -1115,6 +1601,7 @@ def novo_produto():
                     caminho_completo = os.path.join(app.config['UPLOAD_FOLDER'], 'produtos', nome_arquivo)
                     
                     file.save(caminho_completo)
+                    mapa_imagens.invalidar()
                     imagem_nome = nome_arquivo
                     print(f"✅ Imagem original salva: {nome_arquivo}")
                     
@@ -1150,12 +1637,13 @@ def novo_produto():
             minimos = request.form.getlist('estoque_minimo[]')
             maximos = request.form.getlist('estoque_maximo[]')
             localizacoes = request.form.getlist('localizacao[]')
+            eans = request.form.getlist('ean[]')
             
             grades_criadas = 0
             
             for i in range(len(cores)):
                 if cores[i] and tamanhos[i]:
-                    sku_grade = f"{codigo_base}-{cores[i].upper()}-{tamanhos[i]}"
+                    sku_grade = sku_da_grade(codigo_base, cores[i], tamanhos[i])
                     
                     grade = Grade(
                         produto_id=produto.id,
@@ -1165,6 +1653,7 @@ def novo_produto():
                         estoque_minimo=int(minimos[i]) if i < len(minimos) else 5,
                         estoque_maximo=int(maximos[i]) if i < len(maximos) else 50,
                         sku_grade=sku_grade,
+                        ean=normalizar_ean(eans[i]) if i < len(eans) else None,
                         localizacao=localizacoes[i] if i < len(localizacoes) else 'PRATELEIRA-A'
                     )
                     db.session.add(grade)
@@ -1236,6 +1725,7 @@ def editar_produto(id):
                             print(f"🗑️ Thumbnail removido: thumb_{produto.imagem}")
                     except Exception as e:
                         print(f"⚠️ Erro ao remover imagens: {e}")
+                    mapa_imagens.invalidar()
                 produto.imagem = None
             
             if 'imagem' in request.files:
@@ -1254,6 +1744,7 @@ def editar_produto(id):
                                 print(f"🗑️ Thumbnail antigo removido: thumb_{produto.imagem}")
                         except Exception as e:
                             print(f"⚠️ Erro ao remover arquivos antigos: {e}")
+                        mapa_imagens.invalidar()
                     
                     filename = secure_filename(file.filename)
                     import time
@@ -1262,6 +1753,7 @@ def editar_produto(id):
                     caminho_completo = os.path.join(app.config['UPLOAD_FOLDER'], 'produtos', nome_arquivo)
                     
                     file.save(caminho_completo)
+                    mapa_imagens.invalidar()
                     produto.imagem = nome_arquivo
                     print(f"✅ Nova imagem salva: {nome_arquivo}")
                     
@@ -1284,6 +1776,7 @@ def editar_produto(id):
             minimos = request.form.getlist('estoque_minimo[]')
             maximos = request.form.getlist('estoque_maximo[]')
             localizacoes = request.form.getlist('localizacao[]')
+            eans = request.form.getlist('ean[]')
             grades_remover = request.form.getlist('grade_remover[]')
             
             for grade_id_str in grades_remover:
@@ -1295,7 +1788,7 @@ def editar_produto(id):
             
             for i in range(len(cores)):
                 if cores[i] and tamanhos[i]:
-                    sku_grade = f"{produto.sku}-{cores[i].upper()}-{tamanhos[i]}"
+                    sku_grade = sku_da_grade(produto.sku, cores[i], tamanhos[i])
                     
                     if i < len(grade_ids) and grade_ids[i]:
                         grade = Grade.query.get(grade_ids[i])
@@ -1307,6 +1800,7 @@ def editar_produto(id):
                                 grade.estoque_minimo = int(minimos[i]) if i < len(minimos) and minimos[i] else 5
                                 grade.estoque_maximo = int(maximos[i]) if i < len(maximos) and maximos[i] else 50
                                 grade.sku_grade = sku_grade
+                                grade.ean = normalizar_ean(eans[i]) if i < len(eans) else grade.ean
                                 grade.localizacao = localizacoes[i] if i < len(localizacoes) else 'PRATELEIRA-A'
                     else:
                         grade = Grade(
@@ -1317,6 +1811,7 @@ def editar_produto(id):
                             estoque_minimo=int(minimos[i]) if i < len(minimos) and minimos[i] else 5,
                             estoque_maximo=int(maximos[i]) if i < len(maximos) and maximos[i] else 50,
                             sku_grade=sku_grade,
+                            ean=normalizar_ean(eans[i]) if i < len(eans) else None,
                             localizacao=localizacoes[i] if i < len(localizacoes) else 'PRATELEIRA-A'
                         )
                         db.session.add(grade)
@@ -1454,71 +1949,27 @@ def api_produto_grades_por_codigo(codigo):
 
 @app.route('/api/buscar-produtos/<termo>')
 def buscar_produtos(termo):
+    """Autocomplete de produtos: até 10, do mais para o menos relevante"""
+    if not termo or len(termo) < 2:
+        return jsonify([])
+    
     try:
-        print(f"🔍 Buscando produtos para: '{termo}'")
-        
-        if not termo or len(termo) < 2:
-            return jsonify([])
-        
-        termo_busca = f"%{termo.upper()}%"
-        
-        produtos_por_sku = Produto.query.filter(
-            Produto.sku.ilike(termo_busca),
-            Produto.ativo == True
-        ).limit(10).all()
-        
-        produtos_por_descricao = Produto.query.filter(
-            Produto.descricao.ilike(f"%{termo}%"),
-            Produto.ativo == True
-        ).limit(10).all()
-        
-        grades_por_sku = Grade.query.join(Produto).filter(
-            Grade.sku_grade.ilike(termo_busca)
-        ).limit(10).all()
-        
-        todos_produtos = {}
-        
-        for produto in produtos_por_sku:
-            if produto.sku not in todos_produtos:
-                todos_produtos[produto.sku] = {
-                    'codigo': produto.sku,
-                    'descricao': produto.descricao,
-                    'modelo': produto.modelo,
-                    'preco': produto.preco_venda
-                }
-        
-        for produto in produtos_por_descricao:
-            if produto.sku not in todos_produtos:
-                todos_produtos[produto.sku] = {
-                    'codigo': produto.sku,
-                    'descricao': produto.descricao,
-                    'modelo': produto.modelo,
-                    'preco': produto.preco_venda
-                }
-        
-        for grade in grades_por_sku:
-            produto = grade.produto
-            if produto.sku not in todos_produtos:
-                todos_produtos[produto.sku] = {
-                    'codigo': produto.sku,
-                    'descricao': produto.descricao,
-                    'modelo': produto.modelo,
-                    'preco': produto.preco_venda,
-                    'cor': grade.cor,
-                    'tamanho': grade.tamanho
-                }
-        
-        resultados = list(todos_produtos.values())
-        resultados = resultados[:10]
-        
-        print(f"✅ Encontrados {len(resultados)} produtos")
-        
+        resultados = []
+        for produto, grade in ranking_produtos(termo, limite=10):
+            item = {
+                'codigo': produto.sku,
+                'descricao': produto.descricao,
+                'modelo': produto.modelo,
+                'preco': produto.preco_venda
+            }
+            if grade is not None:
+                item['cor'] = grade.cor
+                item['tamanho'] = grade.tamanho
+            resultados.append(item)
         return jsonify(resultados)
         
     except Exception as e:
         print(f"❌ Erro na busca: {str(e)}")
-        import traceback
-        traceback.print_exc()
         return jsonify([])
 
 @app.route('/api/verificar-codigo/<codigo>')
@@ -1544,16 +1995,39 @@ def verificar_codigo(codigo):
 @app.route('/api/produto/imagem/<int:produto_id>')
 def api_produto_imagem(produto_id):
     try:
-        produto = db.session.get(Produto, produto_id)
-        if produto and produto.imagem:
-            caminho_imagem = os.path.join('uploads/produtos', produto.imagem)
-            if os.path.exists(caminho_imagem):
-                return jsonify({'imagem': produto.imagem})
+        imagem = db.session.query(Produto.imagem).filter(Produto.id == produto_id).scalar()
+        if mapa_imagens.existe(imagem):
+            return jsonify({'imagem': imagem})
         return jsonify({'imagem': None})
     except Exception as e:
         print(f"❌ Erro ao buscar imagem: {str(e)}")
         return jsonify({'imagem': None}), 500
 
+LIMITE_IMAGENS_LOTE = 500
+
+@app.route('/api/produtos/imagens')
+def api_produtos_imagens():
+    """Imagens de vários produtos numa só chamada: ?ids=1,2,3 -> {"1": "arquivo.jpg", "2": null}"""
+    try:
+        ids = {int(i) for i in request.args.get('ids', '').split(',') if i.strip()}
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Parâmetro ids inválido'}), 400
+    if len(ids) > LIMITE_IMAGENS_LOTE:
+        return jsonify({'success': False, 'error': f'Máximo de {LIMITE_IMAGENS_LOTE} produtos por chamada'}), 400
+
+    try:
+        imagens = dict.fromkeys(ids)
+        if ids:
+            existentes = mapa_imagens.arquivos()
+            for produto_id, imagem in db.session.query(Produto.id, Produto.imagem).filter(
+                    Produto.id.in_(ids), Produto.imagem.isnot(None)):
+                if imagem in existentes:
+                    imagens[produto_id] = imagem
+        return jsonify({'success': True, 'imagens': {str(k): v for k, v in imagens.items()}})
+    except Exception as e:
+        print(f"❌ Erro ao buscar imagens: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 # ========== ROTAS DE ESTOQUE ==========
 @app.route('/estoque')
 def estoque():
@@ -1562,12 +2036,8 @@ def estoque():
     query = Grade.query.join(Produto)
     
     if busca:
-        query = query.filter(
-            (Produto.descricao.contains(busca)) |
-            (Produto.sku.contains(busca)) |
-            (Grade.cor.contains(busca)) |
-            (Grade.tamanho.contains(busca))
-        )
+        query = filtrar_busca(query, busca_grade_fts, Grade.id, busca,
+                              [Produto.descricao, Produto.sku, Grade.cor, Grade.tamanho])
     
     grades = query.order_by(Produto.descricao, Grade.cor, Grade.tamanho).all()
     
@@ -1603,6 +2073,186 @@ def matriz_estoque(produto_id):
                          tamanhos=tamanhos,
                          matriz=matriz)
 
+# ========== MOTOR DE ENTRADA DE ESTOQUE ==========
+def chave_grade(produto_id, cor, tamanho):
+    """(produto_id, cor normalizada, tamanho) que identifica uma grade na entrada"""
+    return (int(produto_id), normalizar_busca(cor), str(tamanho).strip())
+
+def sku_da_grade(sku, cor, tamanho):
+    """SKU de grade nova, igual no cadastro do produto e na entrada: SKU-COR-TAMANHO"""
+    return f"{sku}-{str(cor).strip().upper()}-{str(tamanho).strip()}"
+
+class RecebimentoEstoque:
+    """Entrada de mercadoria em lote (nota do fornecedor, importação).
+    
+    Recebe linhas {'produto_id', 'cor', 'tamanho', 'quantidade'} e carrega os
+    produtos e as grades envolvidos com duas consultas; cada linha acha sua
+    grade pela chave_grade ou, se não achar, pelo sku_grade que a grade nova
+    teria (grade antiga com cor gravada de outro jeito). Quem já sabe a grade
+    (NF-e, planilha) manda também 'grade_id' e só essas grades são lidas, em
+    vez de todas as do produto.
+    Linhas incompletas ou de produto inexistente são ignoradas, como no
+    formulário antigo.
+    
+    `planejar()` só lê (serve de prévia). `aplicar()` soma o estoque das
+    grades existentes com um UPDATE agrupado, cria as que faltam com um
+    INSERT em lote e grava todas as movimentações com outro. Não faz commit.
+    """
+    
+    def __init__(self, itens):
+        self.linhas = []
+        for item in itens:
+            produto_id = item.get('produto_id')
+            cor = str(item.get('cor') or '').strip()
+            tamanho = str(item.get('tamanho') or '').strip()
+            quantidade = int(item.get('quantidade') or 0)
+            if not all([produto_id, cor, tamanho, quantidade > 0]):
+                continue
+            self.linhas.append({
+                'chave': chave_grade(produto_id, cor, tamanho),
+                'grade_id': item.get('grade_id'),
+                'cor': cor.title(),
+                'tamanho': tamanho,
+                'quantidade': quantidade
+            })
+        
+        produto_ids = {linha['chave'][0] for linha in self.linhas}
+        self.produtos = {}
+        self.grades = {}
+        if produto_ids:
+            self.produtos = {
+                p.id: p for p in db.session.query(Produto.id, Produto.sku, Produto.descricao)
+                .filter(Produto.id.in_(produto_ids))
+            }
+            self.linhas = [linha for linha in self.linhas if linha['chave'][0] in self.produtos]
+            for linha in self.linhas:
+                linha['sku_grade'] = sku_da_grade(self.produtos[linha['chave'][0]].sku, linha['cor'], linha['tamanho'])
+            
+            grade_ids = {linha['grade_id'] for linha in self.linhas if linha['grade_id']}
+            sem_grade = {linha['chave'][0] for linha in self.linhas if not linha['grade_id']}
+            # sku_grade é único (sem diferença de maiúsculas no índice NOCASE): quem ocupa o SKU
+            # que uma grade nova usaria vem na mesma consulta
+            previstos = {linha['sku_grade'] for linha in self.linhas}
+            filtros = [Grade.sku_grade.collate('NOCASE').in_(previstos)]
+            if grade_ids:
+                filtros.append(Grade.id.in_(grade_ids))
+            if sem_grade:
+                filtros.append(Grade.produto_id.in_(sem_grade))
+            por_sku = {}
+            for g in db.session.query(
+                Grade.id, Grade.produto_id, Grade.cor, Grade.tamanho, Grade.sku_grade, Grade.estoque_atual
+            ).filter(db.or_(*filtros)).order_by(Grade.id):
+                self.grades.setdefault(chave_grade(g.produto_id, g.cor, g.tamanho), g)
+                if g.sku_grade:
+                    por_sku.setdefault(g.sku_grade.upper(), g)
+            
+            for linha in self.linhas:
+                if linha['chave'] in self.grades:
+                    continue
+                grade = por_sku.get(linha['sku_grade'].upper())
+                if grade is None:
+                    continue
+                if grade.produto_id != linha['chave'][0]:
+                    raise ValueError(f"O SKU de grade {grade.sku_grade} já é de outro produto")
+                self.grades[linha['chave']] = grade
+    
+    def planejar(self):
+        """Uma entrada por grade: estoque atual e final, sem gravar nada"""
+        plano = {}
+        for linha in self.linhas:
+            chave = linha['chave']
+            item = plano.get(chave)
+            if item is None:
+                produto = self.produtos[chave[0]]
+                grade = self.grades.get(chave)
+                estoque = (grade.estoque_atual or 0) if grade else 0
+                item = plano[chave] = {
+                    'chave': chave,
+                    'produto_id': produto.id,
+                    'descricao': produto.descricao,
+                    'grade_id': grade.id if grade else None,
+                    'sku_grade': grade.sku_grade if grade else linha['sku_grade'],
+                    'cor': grade.cor if grade else linha['cor'],
+                    'tamanho': grade.tamanho if grade else linha['tamanho'],
+                    'nova': grade is None,
+                    'estoque_anterior': estoque,
+                    'quantidade': 0,
+                    'estoque_final': estoque
+                }
+            item['quantidade'] += linha['quantidade']
+            item['estoque_final'] += linha['quantidade']
+        return list(plano.values())
+    
+    def aplicar(self, fornecedor, nota_fiscal, usuario='Sistema', origem='FORNECEDOR'):
+        """Grava a entrada na sessão atual. Retorna o resumo para a tela de resultado"""
+        plano = self.planejar()
+        resumo = {'total_itens': 0, 'grades_atualizadas': 0, 'grades_criadas': 0, 'processadas': []}
+        if not plano:
+            return resumo
+        
+        somas = {item['grade_id']: item['quantidade'] for item in plano if not item['nova']}
+        if somas:
+            # executemany pela PK: o CASE com milhares de ramos fica quadrático em lotes grandes
+            db.session.connection().execute(
+                update(Grade.__table__)
+                .where(Grade.__table__.c.id == bindparam('b_id'))
+                .values(
+                    estoque_atual=func.coalesce(Grade.__table__.c.estoque_atual, 0) + bindparam('b_quantidade'),
+                    versao=Grade.__table__.c.versao + 1
+                ),
+                [{'b_id': grade_id, 'b_quantidade': quantidade} for grade_id, quantidade in somas.items()]
+            )
+            marcar_grades_alteradas(somas.keys())
+        
+        novas = [item for item in plano if item['nova']]
+        if novas:
+            # sku_grade é único: liga cada id devolvido à sua linha sem depender da ordem do RETURNING
+            criadas = db.session.execute(insert(Grade).returning(Grade.sku_grade, Grade.id), [{
+                'produto_id': item['produto_id'],
+                'cor': item['cor'],
+                'cor_busca': normalizar_busca(item['cor']),
+                'tamanho': item['tamanho'],
+                'estoque_atual': item['quantidade'],
+                'estoque_minimo': 5,
+                'estoque_maximo': 50,
+                'sku_grade': item['sku_grade'],
+                'localizacao': 'PRATELEIRA-A'
+            } for item in novas]).all()
+            ids = dict(criadas)
+            for item in novas:
+                item['grade_id'] = ids[item['sku_grade']]
+            marcar_grades_alteradas(ids.values(), criadas=True)
+        
+        grade_por_chave = {item['chave']: item for item in plano}
+        movimentacoes = []
+        for linha in self.linhas:
+            item = grade_por_chave[linha['chave']]
+            # A primeira linha de uma grade nova registra a criação, como no fluxo antigo
+            if item['nova'] and not item.get('criacao_registrada'):
+                item['criacao_registrada'] = True
+                observacao = f"Nova grade criada: {linha['quantidade']} un. Fornecedor: {fornecedor}"
+            else:
+                observacao = f"Entrada: {linha['quantidade']} un. Fornecedor: {fornecedor}"
+            movimentacoes.append({
+                'tipo': 'ENTRADA',
+                'grade_id': item['grade_id'],
+                'quantidade': linha['quantidade'],
+                'origem': origem,
+                'documento': nota_fiscal,
+                'observacao': observacao,
+                'usuario': usuario
+            })
+            resumo['total_itens'] += linha['quantidade']
+            resumo['processadas'].append(
+                f"{self.produtos[item['produto_id']].sku} {item['cor']} T{item['tamanho']}"
+                + (' (NOVA)' if item['nova'] else '')
+            )
+        db.session.execute(insert(Movimentacao), movimentacoes)
+        
+        resumo['grades_atualizadas'] = len(somas)
+        resumo['grades_criadas'] = len(novas)
+        return resumo
+
 @app.route('/estoque/entrada', methods=['GET', 'POST'])
 def entrada_estoque():
     if request.method == 'POST':
@@ -1624,104 +2274,15 @@ def entrada_estoque():
                 flash('❌ Informe o fornecedor!', 'danger')
                 return redirect(url_for('entrada_estoque'))
             
-            total_itens = 0
-            grades_processadas = []
-            
-            for item in dados:
-                produto_id = item.get('produto_id')
-                cor = item.get('cor', '').strip()
-                tamanho = str(item.get('tamanho', '')).strip()
-                quantidade = int(item.get('quantidade', 0))
-                
-                if not all([produto_id, cor, tamanho, quantidade > 0]):
-                    continue
-                
-                cor_normalizada = cor.title()
-                
-                produto = Produto.query.get(produto_id)
-                if not produto:
-                    continue
-                
-                sku_grade = f"{produto.sku}-{cor_normalizada}-{tamanho}"
-                
-                print(f"\n[ENTRADA] Processando: {produto.sku} {cor_normalizada} T{tamanho}")
-                
-                grade = None
-                
-                grade = Grade.query.filter_by(sku_grade=sku_grade).first()
-                
-                if not grade:
-                    from sqlalchemy import func
-                    grade = Grade.query.filter(
-                        Grade.produto_id == produto_id,
-                        func.lower(Grade.cor) == func.lower(cor_normalizada),
-                        Grade.tamanho == tamanho
-                    ).first()
-                
-                if not grade:
-                    todas_grades_produto = Grade.query.filter_by(produto_id=produto_id).all()
-                    for g in todas_grades_produto:
-                        if g.cor.lower() == cor_normalizada.lower() and str(g.tamanho) == str(tamanho):
-                            grade = g
-                            break
-                
-                if grade:
-                    print(f"[ENTRADA] Grade encontrada: {grade.sku_grade} (ID: {grade.id})")
-                    
-                    estoque_anterior = int(grade.estoque_atual) if grade.estoque_atual else 0
-                    grade.estoque_atual = estoque_anterior + quantidade
-                    
-                    print(f"[ENTRADA] Estoque atualizado: {estoque_anterior} → {grade.estoque_atual}")
-                    
-                    total_itens += quantidade
-                    grades_processadas.append(f"{produto.sku} {cor_normalizada} T{tamanho}")
-                    
-                    mov = Movimentacao(
-                        tipo='ENTRADA',
-                        grade_id=grade.id,
-                        quantidade=quantidade,
-                        origem='FORNECEDOR',
-                        documento=nota_fiscal,
-                        observacao=f"Entrada: {quantidade} un. Fornecedor: {fornecedor}",
-                        usuario='Sistema'
-                    )
-                    db.session.add(mov)
-                    
-                else:
-                    print(f"[ENTRADA] Criando nova grade: {sku_grade}")
-                    
-                    grade = Grade(
-                        produto_id=produto_id,
-                        cor=cor_normalizada,
-                        tamanho=tamanho,
-                        estoque_atual=quantidade,
-                        estoque_minimo=5,
-                        estoque_maximo=50,
-                        sku_grade=sku_grade,
-                        localizacao='PRATELEIRA-A'
-                    )
-                    db.session.add(grade)
-                    db.session.flush()
-                    
-                    total_itens += quantidade
-                    grades_processadas.append(f"{produto.sku} {cor_normalizada} T{tamanho} (NOVA)")
-                    
-                    mov = Movimentacao(
-                        tipo='ENTRADA',
-                        grade_id=grade.id,
-                        quantidade=quantidade,
-                        origem='FORNECEDOR',
-                        documento=nota_fiscal,
-                        observacao=f"Nova grade criada: {quantidade} un. Fornecedor: {fornecedor}",
-                        usuario='Sistema'
-                    )
-                    db.session.add(mov)
-            
+            recebimento = RecebimentoEstoque(dados)
+            resumo = recebimento.aplicar(fornecedor, nota_fiscal)
             db.session.commit()
             
+            total_itens = resumo['total_itens']
             if total_itens > 0:
                 flash(f'✅ {total_itens} itens adicionados ao estoque!', 'success')
-                print(f"[ENTRADA] Sucesso: {total_itens} itens processados")
+                print(f"[ENTRADA] Sucesso: {total_itens} itens em {len(resumo['processadas'])} linhas "
+                      f"({resumo['grades_criadas']} grades novas)")
             else:
                 flash('⚠️ Nenhum item foi processado', 'warning')
             
@@ -1746,6 +2307,1066 @@ def entrada_estoque():
     hoje = datetime.now().strftime('%Y-%m-%d')
     return render_template('estoque/entrada.html', produtos=produtos, hoje=hoje)
 
+# ========== IMPORTAÇÃO DE NF-e (XML) ==========
+def ler_nfe(arquivo):
+    """Lê o XML da NF-e em streaming (iterparse).
+    
+    Retorna (cabecalho, itens): chave de acesso, número, série, CNPJ e nome do
+    emitente e uma linha {'codigo', 'descricao', 'ean', 'quantidade'} por <det>. Cada <det>
+    sai da árvore assim que é lido, então a memória do parser não cresce com
+    o número de linhas. Aceita tanto <nfeProc> quanto <NFe> como raiz.
+    """
+    cabecalho = {'chave': '', 'numero': '', 'serie': '', 'cnpj': '', 'fornecedor': ''}
+    itens = []
+    pilha = []
+    for evento, elem in ET.iterparse(arquivo, events=('start', 'end')):
+        if evento == 'start':
+            pilha.append(elem)
+            continue
+        pilha.pop()
+        tag = elem.tag.rpartition('}')[2]
+        pai = pilha[-1].tag.rpartition('}')[2] if pilha else ''
+        
+        if tag == 'prod':
+            campos = {filho.tag.rpartition('}')[2]: (filho.text or '').strip() for filho in elem}
+            ean = apenas_digitos(campos.get('cEAN'))  # 'SEM GTIN' vira vazio
+            itens.append({
+                'codigo': campos.get('cProd', ''),
+                'descricao': campos.get('xProd', ''),
+                'ean': ean,
+                'quantidade': int(round(float(campos.get('qCom') or 0)))
+            })
+        elif tag == 'det':
+            pilha[-1].remove(elem)
+        elif pai == 'emit' and tag in ('CNPJ', 'CPF'):
+            cabecalho['cnpj'] = apenas_digitos(elem.text)
+        elif pai == 'emit' and tag == 'xNome':
+            cabecalho['fornecedor'] = (elem.text or '').strip()
+        elif pai == 'ide' and tag == 'nNF':
+            cabecalho['numero'] = (elem.text or '').strip()
+        elif pai == 'ide' and tag == 'serie':
+            cabecalho['serie'] = (elem.text or '').strip()
+        elif tag == 'infNFe' and not cabecalho['chave']:
+            cabecalho['chave'] = apenas_digitos(elem.get('Id'))  # Id="NFe<44 dígitos>"
+        elif tag == 'chNFe':
+            cabecalho['chave'] = apenas_digitos(elem.text)
+    return cabecalho, itens
+
+def chave_nfe(cabecalho):
+    """Identifica a nota entre fornecedores: chave de acesso ou, sem ela, CNPJ-série-número"""
+    if len(cabecalho['chave']) == 44:
+        return cabecalho['chave']
+    return f"{cabecalho['cnpj']}-{cabecalho['serie'] or '0'}-{cabecalho['numero']}"
+
+def vincular_itens_nfe(cnpj, itens):
+    """Preenche 'grade_id' e 'vinculo' de cada linha da nota.
+    
+    Ordem: código já vinculado a este fornecedor, EAN da grade e, por fim, o
+    próprio sku_grade (fornecedor que usa o nosso código). Uma consulta por
+    critério, para a nota inteira.
+    """
+    codigos = {item['codigo'] for item in itens if item['codigo']}
+    eans = {item['ean'] for item in itens if item['ean']}
+    
+    por_codigo = {}
+    if cnpj and codigos:
+        por_codigo = dict(db.session.query(CodigoFornecedor.codigo, CodigoFornecedor.grade_id).filter(
+            CodigoFornecedor.cnpj == cnpj, CodigoFornecedor.codigo.in_(codigos)
+        ))
+    por_ean = dict(db.session.query(Grade.ean, Grade.id).filter(Grade.ean.in_(eans))) if eans else {}
+    por_sku = dict(db.session.query(Grade.sku_grade, Grade.id).filter(Grade.sku_grade.in_(codigos))) if codigos else {}
+    
+    for item in itens:
+        for vinculo, mapa, chave in (('codigo', por_codigo, item['codigo']),
+                                     ('ean', por_ean, item['ean']),
+                                     ('sku', por_sku, item['codigo'])):
+            if chave and chave in mapa:
+                item['grade_id'], item['vinculo'] = mapa[chave], vinculo
+                break
+        else:
+            item['grade_id'], item['vinculo'] = None, None
+    return itens
+
+def linhas_recebimento(itens):
+    """Linhas da nota já vinculadas -> linhas do RecebimentoEstoque (uma consulta)"""
+    grade_ids = {item['grade_id'] for item in itens if item.get('grade_id')}
+    if not grade_ids:
+        return []
+    grades = {
+        g.id: g for g in db.session.query(Grade.id, Grade.produto_id, Grade.cor, Grade.tamanho)
+        .filter(Grade.id.in_(grade_ids))
+    }
+    return [{
+        'grade_id': item['grade_id'],
+        'produto_id': grades[item['grade_id']].produto_id,
+        'cor': grades[item['grade_id']].cor,
+        'tamanho': grades[item['grade_id']].tamanho,
+        'quantidade': item['quantidade']
+    } for item in itens if item.get('grade_id') in grades]
+
+@app.route('/estoque/entrada/nfe', methods=['POST'])
+def entrada_nfe():
+    """Recebe o XML da NF-e e mostra a prévia (estoque antes/depois) sem mexer no estoque.
+    
+    As linhas lidas ficam em NotaEntrada (uma por chave da nota); a confirmação
+    lança a partir dela, nunca do que o navegador devolve.
+    """
+    request.max_content_length = LIMITE_UPLOAD_IMPORTACAO
+    arquivo = request.files.get('arquivo')
+    if not arquivo or not arquivo.filename:
+        flash('❌ Selecione o XML da nota fiscal!', 'danger')
+        return redirect(url_for('entrada_estoque'))
+    
+    try:
+        inicio = time.perf_counter()
+        cabecalho, itens = ler_nfe(arquivo.stream)
+    except (ET.ParseError, ValueError) as e:
+        flash(f'❌ XML da NF-e inválido: {str(e)}', 'danger')
+        return redirect(url_for('entrada_estoque'))
+    
+    itens = [item for item in itens if item['quantidade'] > 0]
+    if not itens:
+        flash('⚠️ Nenhum produto encontrado na nota', 'warning')
+        return redirect(url_for('entrada_estoque'))
+    if not cabecalho['chave'] and not cabecalho['numero']:
+        flash('❌ XML da NF-e sem chave de acesso nem número da nota', 'danger')
+        return redirect(url_for('entrada_estoque'))
+    
+    nota = NotaEntrada.query.filter_by(chave=chave_nfe(cabecalho)).first()
+    ja_lancada = nota is not None and nota.status == 'lancada'
+    if not ja_lancada:
+        nota = nota or NotaEntrada(chave=chave_nfe(cabecalho))
+        nota.numero = cabecalho['numero']
+        nota.serie = cabecalho['serie']
+        nota.cnpj = cabecalho['cnpj']
+        nota.fornecedor = cabecalho['fornecedor'][:200]
+        nota.itens = json.dumps(itens, ensure_ascii=False)
+        nota.usuario = session.get('usuario_nome') or 'Sistema'
+        db.session.add(nota)
+        db.session.commit()
+    
+    vincular_itens_nfe(cabecalho['cnpj'], itens)
+    plano = RecebimentoEstoque(linhas_recebimento(itens)).planejar()
+    sem_vinculo = {}
+    for item in itens:
+        if not item['grade_id']:
+            pendente = sem_vinculo.setdefault(item['codigo'], dict(item, quantidade=0))
+            pendente['quantidade'] += item['quantidade']
+    sem_vinculo = list(sem_vinculo.values())
+    
+    if cabecalho['cnpj']:
+        cadastrado = db.session.query(Fornecedor.razao_social).filter(
+            Fornecedor.cnpj_digitos == cabecalho['cnpj']
+        ).scalar()
+        cabecalho['fornecedor'] = cadastrado or cabecalho['fornecedor']
+    print(f"[NF-e] Nota {cabecalho['numero']}: {len(itens)} linhas, {len(sem_vinculo)} sem vínculo "
+          f"({(time.perf_counter() - inicio) * 1000:.0f} ms)")
+    
+    return render_template('estoque/entrada_nfe.html',
+                         cabecalho=cabecalho,
+                         nota=nota,
+                         itens=itens,
+                         plano=plano,
+                         sem_vinculo=sem_vinculo,
+                         ja_lancada=ja_lancada,
+                         total_itens=sum(item['quantidade'] for item in itens))
+
+@app.route('/estoque/entrada/nfe/confirmar', methods=['POST'])
+def confirmar_entrada_nfe():
+    """Lança a NotaEntrada da prévia numa única transação, pelo RecebimentoEstoque.
+    
+    Linhas e quantidades vêm da nota guardada na prévia; do formulário só
+    entram o nome do fornecedor e os vínculos digitados para as linhas sem
+    grade. A nota passa de 'previa' para 'lancada' no começo da transação:
+    um segundo envio (duplo clique, F5) não acha mais a prévia e não soma
+    de novo. Os códigos vinculados (digitados ou achados por EAN/sku) ficam
+    gravados em CodigoFornecedor para a próxima nota.
+    """
+    try:
+        nota = db.session.get(NotaEntrada, request.form.get('nota_id', type=int) or 0)
+        fornecedor = request.form.get('fornecedor', '').strip()
+        
+        if not nota:
+            flash('❌ Prévia da NF-e não encontrada, envie o XML de novo', 'danger')
+            return redirect(url_for('entrada_estoque'))
+        if not fornecedor:
+            flash('❌ Informe o fornecedor!', 'danger')
+            return redirect(url_for('entrada_estoque'))
+        
+        lancou = db.session.execute(
+            update(NotaEntrada)
+            .where(NotaEntrada.id == nota.id, NotaEntrada.status == 'previa')
+            .values(status='lancada', data_lancamento=hora_brasil(), usuario=session.get('usuario_nome') or 'Sistema')
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        if not lancou:
+            db.session.rollback()
+            flash(f'⚠️ A NF-e {nota.numero} já foi lançada; nada foi somado ao estoque', 'warning')
+            return redirect(url_for('estoque'))
+        
+        cnpj = nota.cnpj
+        nota_fiscal = nota.numero
+        itens = vincular_itens_nfe(cnpj, json.loads(nota.itens))
+        
+        digitados = {
+            chave[len('vinculo-'):]: valor.strip()
+            for chave, valor in request.form.items()
+            if chave.startswith('vinculo-') and valor.strip()
+        }
+        if digitados:
+            valores = set(digitados.values())
+            achadas = {}
+            for g in db.session.query(Grade.id, Grade.sku_grade, Grade.ean).filter(
+                db.or_(Grade.sku_grade.in_(valores), Grade.ean.in_(valores))
+            ):
+                achadas[g.sku_grade] = g.id
+                if g.ean:
+                    achadas[g.ean] = g.id
+            for item in itens:
+                if not item.get('grade_id') and item['codigo'] in digitados:
+                    item['grade_id'] = achadas.get(digitados[item['codigo']])
+                    item['vinculo'] = 'manual' if item['grade_id'] else None
+        
+        vinculos = {
+            item['codigo']: item for item in itens
+            if item.get('grade_id') and item.get('vinculo') != 'codigo' and item['codigo']
+        }
+        if cnpj and vinculos:
+            db.session.execute(CodigoFornecedor.__table__.delete().where(
+                CodigoFornecedor.cnpj == cnpj, CodigoFornecedor.codigo.in_(vinculos.keys())
+            ))
+            db.session.execute(insert(CodigoFornecedor), [{
+                'cnpj': cnpj,
+                'codigo': codigo,
+                'descricao': (item.get('descricao') or '')[:200],
+                'grade_id': item['grade_id']
+            } for codigo, item in vinculos.items()])
+        
+        resumo = RecebimentoEstoque(linhas_recebimento(itens)).aplicar(fornecedor, nota_fiscal)
+        db.session.commit()
+        
+        ignoradas = sum(1 for item in itens if not item.get('grade_id'))
+        if resumo['total_itens'] > 0:
+            flash(f"✅ NF-e {nota_fiscal}: {resumo['total_itens']} itens adicionados ao estoque!", 'success')
+        else:
+            flash('⚠️ Nenhum item foi processado', 'warning')
+        if ignoradas:
+            flash(f'⚠️ {ignoradas} linha(s) da nota sem vínculo ficaram de fora', 'warning')
+        print(f"[NF-e] Nota {nota_fiscal} lançada: {resumo['total_itens']} itens, "
+              f"{len(vinculos)} vínculos gravados, {ignoradas} linhas ignoradas")
+        return redirect(url_for('estoque'))
+    
+    except Exception as e:
+        db.session.rollback()
+        flash(f'❌ Erro ao lançar a NF-e: {str(e)}', 'danger')
+        print(f"[NF-e] ERRO: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return redirect(url_for('entrada_estoque'))
+
+# ========== IMPORTAÇÃO DE PLANILHA DE ESTOQUE ==========
+IMPORTACAO_LOTE = 1000          # linhas por transação
+IMPORTACAO_MAX_ERROS = 200      # rejeições guardadas para mostrar na tela
+IMPORTACAO_EXTENSOES = {'xlsx', 'csv'}
+IMPORTACAO_MAX_QUANTIDADE = 1_000_000  # por linha; acima disso é erro de digitação
+IMPORTACAO_CODIFICACOES = ('utf-8-sig', 'cp1252')  # UTF-8 (com ou sem BOM) ou o CSV do Excel em português
+
+# Cabeçalhos aceitos (já normalizados) para cada campo. A quantidade é sempre uma ENTRADA
+# somada ao estoque: colunas de saldo ('estoque', 'saldo') não são aceitas, acerto de saldo
+# é pelo inventário
+COLUNAS_IMPORTACAO = {
+    'sku': ('sku', 'codigo', 'sku grade', 'sku_grade', 'referencia'),
+    'cor': ('cor',),
+    'tamanho': ('tamanho', 'tam', 'numeracao'),
+    'quantidade': ('quantidade', 'qtd', 'qtde'),
+}
+COLUNAS_SALDO = ('estoque', 'saldo')
+
+def texto_celula(valor):
+    """Célula da planilha como texto: 38.0 -> '38', None -> ''"""
+    if valor is None:
+        return ''
+    if isinstance(valor, float) and valor.is_integer():
+        valor = int(valor)
+    return str(valor).strip()
+
+def resumo_arquivo(caminho):
+    """(SHA-256, codificação, nº de linhas) do arquivo numa única leitura em blocos.
+    
+    A codificação é a primeira de IMPORTACAO_CODIFICACOES que decodifica o arquivo
+    inteiro (None se nenhuma); só faz sentido para CSV.
+    """
+    resumo = hashlib.sha256()
+    decodificadores = {c: codecs.getincrementaldecoder(c)() for c in IMPORTACAO_CODIFICACOES}
+    linhas, ultimo = 0, b'\n'
+    with open(caminho, 'rb') as arquivo:
+        for bloco in iter(lambda: arquivo.read(1 << 20), b''):
+            resumo.update(bloco)
+            linhas += bloco.count(b'\n')
+            ultimo = bloco[-1:]
+            for codificacao, decodificador in list(decodificadores.items()):
+                try:
+                    decodificador.decode(bloco)
+                except UnicodeDecodeError:
+                    del decodificadores[codificacao]
+    for codificacao, decodificador in list(decodificadores.items()):
+        try:
+            decodificador.decode(b'', final=True)
+        except UnicodeDecodeError:
+            del decodificadores[codificacao]
+    if ultimo != b'\n':
+        linhas += 1  # última linha sem quebra
+    return resumo.hexdigest(), next(iter(decodificadores), None), linhas
+
+def validar_planilha(caminho, codificacao, linhas_arquivo):
+    """Confere o cabeçalho e estima as linhas de dados, sem ler a planilha inteira.
+    
+    XLSX usa a dimensão gravada na própria planilha (None se ela não tiver);
+    CSV, as linhas contadas no upload (campos com quebra de linha contam a
+    mais). As linhas com erro aparecem depois no progresso da importação.
+    """
+    leitura = ler_planilha_estoque(caminho, codificacao)
+    try:
+        next(leitura, None)
+    finally:
+        leitura.close()
+    
+    if not caminho.lower().endswith('.xlsx'):
+        return max(0, linhas_arquivo - 1)
+    from openpyxl import load_workbook
+    livro = load_workbook(caminho, read_only=True)
+    try:
+        ultima = livro.active.max_row
+    finally:
+        livro.close()
+    return max(0, ultima - 1) if ultima else None
+
+def ler_planilha_estoque(caminho, codificacao='utf-8-sig'):
+    """Gera (nº da linha de dados, {'sku', 'cor', 'tamanho', 'quantidade'}) em streaming.
+    
+    XLSX é aberto com openpyxl em read_only (lê a planilha aos poucos, sem
+    montar o workbook na memória); CSV aceita ';' ou ',' na `codificacao`
+    detectada no upload (resumo_arquivo). A primeira linha é o cabeçalho.
+    """
+    if caminho.lower().endswith('.xlsx'):
+        from openpyxl import load_workbook
+        livro = load_workbook(caminho, read_only=True, data_only=True)
+        try:
+            yield from _linhas_importacao(livro.active.iter_rows(values_only=True))
+        finally:
+            livro.close()
+    else:
+        with open(caminho, newline='', encoding=codificacao) as arquivo:
+            amostra = arquivo.readline()
+            arquivo.seek(0)
+            delimitador = ';' if amostra.count(';') >= amostra.count(',') else ','
+            yield from _linhas_importacao(csv.reader(arquivo, delimiter=delimitador))
+
+def _linhas_importacao(linhas):
+    cabecalho = [normalizar_busca(texto_celula(c)) for c in next(linhas, ())]
+    posicoes = {}
+    for campo, nomes in COLUNAS_IMPORTACAO.items():
+        for nome in nomes:
+            if nome in cabecalho:
+                posicoes[campo] = cabecalho.index(nome)
+                break
+    if 'quantidade' not in posicoes and any(nome in cabecalho for nome in COLUNAS_SALDO):
+        raise ValueError('A coluna Quantidade é somada ao estoque (entrada); para acertar o saldo use o inventário')
+    if 'sku' not in posicoes or 'quantidade' not in posicoes:
+        raise ValueError('A planilha precisa das colunas SKU e Quantidade (e Cor/Tamanho se o SKU for do produto)')
+    
+    for numero, linha in enumerate(linhas, 1):
+        yield numero, {
+            campo: texto_celula(linha[posicao]) if posicao < len(linha) else ''
+            for campo, posicao in posicoes.items()
+        }
+
+def mapa_chaves_grades(normalizar=normalizar_busca):
+    """Chaves normalizadas -> grade, para validar a planilha sem consultas por linha.
+    
+    Cada grade entra por (SKU do produto, cor, tamanho) e pelo próprio sku_grade.
+    """
+    mapa = {}
+    for g in db.session.query(
+        Grade.id, Grade.produto_id, Grade.cor, Grade.tamanho, Grade.sku_grade, Produto.sku
+    ).join(Produto, Grade.produto_id == Produto.id):
+        mapa.setdefault((normalizar(g.sku), normalizar(g.cor), normalizar(g.tamanho)), g)
+        if g.sku_grade:
+            mapa.setdefault(normalizar_busca(g.sku_grade), g)
+    return mapa
+
+def importacao_para_json(importacao):
+    total = importacao.total_linhas
+    return {
+        'id': importacao.id,
+        'arquivo': importacao.arquivo,
+        'status': importacao.status,
+        'total_linhas': total,
+        'linhas_lidas': importacao.linhas_lidas,
+        'linhas_aplicadas': importacao.linhas_aplicadas,
+        'linhas_rejeitadas': importacao.linhas_rejeitadas,
+        'itens': importacao.itens,
+        'percentual': min(100.0, round(100 * (importacao.linhas_lidas or 0) / total, 1)) if total else None,
+        'erros': json.loads(importacao.erros) if importacao.erros else [],
+        'mensagem': importacao.mensagem,
+        'data_criacao': importacao.data_criacao.isoformat() if importacao.data_criacao else None,
+        'data_conclusao': importacao.data_conclusao.isoformat() if importacao.data_conclusao else None
+    }
+
+class ImportadorEstoque:
+    """Processa as importações de planilha numa única thread, em lotes.
+    
+    Cada lote de IMPORTACAO_LOTE linhas vira uma transação curta pelo
+    RecebimentoEstoque, com o progresso da importação gravado no mesmo
+    commit; o PDV continua vendendo entre um lote e outro. Se o servidor
+    cair no meio, retomar() continua da última linha confirmada.
+    """
+    
+    def __init__(self):
+        self.fila = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.retomado = False
+    
+    def despachar(self, importacao_id):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._trabalhar, name='importador-estoque', daemon=True)
+                self.thread.start()
+        self.fila.put(importacao_id)
+    
+    def retomar(self):
+        """Reenfileira importações interrompidas (ex.: servidor reiniciado)"""
+        with self.lock:
+            if self.retomado:
+                return
+            self.retomado = True
+        
+        ids = [i for (i,) in db.session.query(ImportacaoEstoque.id).filter(
+            ImportacaoEstoque.status.in_(['pendente', 'processando'])
+        ).order_by(ImportacaoEstoque.id)]
+        for importacao_id in ids:
+            self.despachar(importacao_id)
+        if ids:
+            print(f"📥 Importador: {len(ids)} importação(ões) retomada(s)")
+    
+    def _trabalhar(self):
+        while True:
+            importacao_id = self.fila.get()
+            with app.app_context():
+                try:
+                    self._importar(importacao_id)
+                except Exception as e:
+                    db.session.rollback()
+                    db.session.execute(
+                        update(ImportacaoEstoque).where(ImportacaoEstoque.id == importacao_id)
+                        .values(status='erro', mensagem=str(e), data_conclusao=hora_brasil())
+                    )
+                    db.session.commit()
+                    print(f"❌ Importador: erro na importação #{importacao_id}: {e}")
+                finally:
+                    db.session.remove()
+    
+    def _importar(self, importacao_id):
+        importacao = db.session.get(ImportacaoEstoque, importacao_id)
+        if not importacao or importacao.status not in ('pendente', 'processando'):
+            return
+        importacao.status = 'processando'
+        db.session.commit()
+        
+        inicio = time.perf_counter()
+        # SKU, cor e tamanho se repetem muito: normaliza cada texto uma vez só
+        normalizar = lru_cache(maxsize=1 << 16)(normalizar_busca)
+        mapa = mapa_chaves_grades(normalizar)
+        erros = json.loads(importacao.erros) if importacao.erros else []
+        ja_lidas = importacao.linhas_lidas or 0
+        lote, rejeitadas, ultima = [], 0, ja_lidas
+        
+        for numero, linha in ler_planilha_estoque(importacao.caminho, importacao.codificacao or 'utf-8-sig'):
+            if numero <= ja_lidas:
+                continue
+            ultima = numero
+            if not any(linha.values()):
+                continue
+            
+            if linha.get('cor') or linha.get('tamanho'):
+                chave = (normalizar(linha['sku']), normalizar(linha.get('cor')), normalizar(linha.get('tamanho')))
+            else:
+                chave = normalizar(linha['sku'])
+            grade = mapa.get(chave)
+            try:
+                quantidade = int(float(linha['quantidade'].replace(',', '.')))
+            except (ValueError, OverflowError):  # texto, 'nan', '1e400'
+                quantidade = 0
+            
+            motivo = None
+            if grade is None:
+                motivo = 'grade não encontrada'
+            elif not 0 < quantidade <= IMPORTACAO_MAX_QUANTIDADE:
+                motivo = f"quantidade inválida ({linha['quantidade'] or 'vazia'})"
+            if motivo:
+                rejeitadas += 1
+                if len(erros) < IMPORTACAO_MAX_ERROS:
+                    erros.append({'linha': numero + 1, 'motivo': motivo, 'sku': linha['sku']})
+            else:
+                lote.append({'grade_id': grade.id, 'produto_id': grade.produto_id, 'cor': grade.cor,
+                             'tamanho': grade.tamanho, 'quantidade': quantidade})
+            
+            if len(lote) + rejeitadas >= IMPORTACAO_LOTE:
+                self._gravar_lote(importacao, lote, rejeitadas, ultima, erros)
+                lote, rejeitadas = [], 0
+        
+        self._gravar_lote(importacao, lote, rejeitadas, ultima, erros)
+        importacao.total_linhas = ultima  # no upload era estimativa
+        importacao.status = 'concluido'
+        importacao.data_conclusao = hora_brasil()
+        db.session.commit()
+        
+        try:
+            os.remove(importacao.caminho)
+        except OSError:
+            pass
+        print(f"📥 Importador: #{importacao.id} concluída, {importacao.linhas_aplicadas} linhas aplicadas, "
+              f"{importacao.linhas_rejeitadas} rejeitadas ({time.perf_counter() - inicio:.1f}s)")
+    
+    def _gravar_lote(self, importacao, lote, rejeitadas, ultima, erros):
+        """Aplica um lote e avança o progresso na mesma transação"""
+        resumo = RecebimentoEstoque(lote).aplicar(
+            importacao.origem, f'IMP-{importacao.id}', importacao.usuario, origem='IMPORTACAO'
+        )
+        importacao.linhas_lidas = ultima
+        importacao.linhas_aplicadas = (importacao.linhas_aplicadas or 0) + len(lote)
+        importacao.linhas_rejeitadas = (importacao.linhas_rejeitadas or 0) + rejeitadas
+        importacao.itens = (importacao.itens or 0) + resumo['total_itens']
+        importacao.erros = json.dumps(erros, ensure_ascii=False) if erros else None
+        db.session.commit()
+
+importador_estoque = ImportadorEstoque()
+
+@app.route('/api/estoque/importacao', methods=['POST'])
+@login_required
+def iniciar_importacao_estoque():
+    """Recebe a planilha (XLSX ou CSV) e agenda a importação; o progresso sai em GET .../<id>.
+    
+    Antes de aceitar só o cabeçalho é lido; a codificação do CSV e a estimativa de linhas
+    saem da mesma leitura em blocos que calcula o hash. Linhas com erro aparecem no progresso.
+    A mesma planilha não entra enquanto a importação anterior dela não terminar: se parou
+    com erro, continua por POST .../<id>/retomar sem repetir as linhas já gravadas.
+    """
+    request.max_content_length = LIMITE_UPLOAD_IMPORTACAO
+    arquivo = request.files.get('arquivo')
+    if not arquivo or not arquivo.filename:
+        return jsonify({'success': False, 'error': 'Selecione a planilha'}), 400
+    
+    extensao = arquivo.filename.rsplit('.', 1)[-1].lower() if '.' in arquivo.filename else ''
+    if extensao not in IMPORTACAO_EXTENSOES:
+        return jsonify({'success': False, 'error': 'Formato não suportado (use .xlsx ou .csv)'}), 400
+    
+    try:
+        pasta = os.path.join(instance_path, 'importacoes')
+        os.makedirs(pasta, exist_ok=True)
+        nome = secure_filename(arquivo.filename) or f'planilha.{extensao}'
+        caminho = os.path.join(pasta, f"{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}_{nome}")
+        arquivo.save(caminho)
+        
+        hash_arquivo, codificacao, linhas_arquivo = resumo_arquivo(caminho)
+        anterior = ImportacaoEstoque.query.filter(
+            ImportacaoEstoque.hash_arquivo == hash_arquivo,
+            ImportacaoEstoque.status.in_(['pendente', 'processando', 'erro'])
+        ).order_by(ImportacaoEstoque.id.desc()).first()
+        if anterior:
+            os.remove(caminho)
+            acao = 'use Retomar nela' if anterior.status == 'erro' else 'aguarde terminar'
+            return jsonify({
+                'success': False,
+                'error': f'Esta planilha já está na importação #{anterior.id} ({anterior.status}): {acao}',
+                'importacao': importacao_para_json(anterior)
+            }), 409
+        
+        try:
+            if extensao != 'csv':
+                codificacao = None
+            elif codificacao is None:
+                raise ValueError('codificação do CSV não reconhecida (salve como UTF-8)')
+            total_linhas = validar_planilha(caminho, codificacao or 'utf-8-sig', linhas_arquivo)
+        except Exception as e:
+            os.remove(caminho)
+            return jsonify({'success': False, 'error': f'Planilha inválida: {e}'}), 400
+        
+        importacao = ImportacaoEstoque(
+            arquivo=arquivo.filename,
+            caminho=caminho,
+            codificacao=codificacao,
+            hash_arquivo=hash_arquivo,
+            origem=(request.form.get('origem') or '').strip() or 'Importação de planilha',
+            status='pendente',
+            total_linhas=total_linhas,
+            usuario=session.get('usuario_nome') or 'Sistema'
+        )
+        db.session.add(importacao)
+        db.session.commit()
+        importador_estoque.despachar(importacao.id)
+        
+        print(f"📥 Importação #{importacao.id} agendada: {arquivo.filename} ({importacao.total_linhas} linhas)")
+        return jsonify({'success': True, 'importacao': importacao_para_json(importacao)}), 202
+    
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/estoque/importacao/<int:importacao_id>', methods=['GET'])
+@login_required
+def progresso_importacao_estoque(importacao_id):
+    importacao = db.session.get(ImportacaoEstoque, importacao_id)
+    if not importacao:
+        return jsonify({'success': False, 'error': 'Importação não encontrada'}), 404
+    return jsonify({'success': True, 'importacao': importacao_para_json(importacao)})
+
+@app.route('/api/estoque/importacao/<int:importacao_id>/retomar', methods=['POST'])
+@login_required
+def retomar_importacao_estoque(importacao_id):
+    """Importação que parou com erro continua da última linha gravada (linhas_lidas)"""
+    importacao = db.session.get(ImportacaoEstoque, importacao_id)
+    if not importacao:
+        return jsonify({'success': False, 'error': 'Importação não encontrada'}), 404
+    if importacao.status != 'erro':
+        return jsonify({'success': False, 'error': 'Só importações com erro podem ser retomadas'}), 400
+    if not importacao.caminho or not os.path.exists(importacao.caminho):
+        return jsonify({'success': False, 'error': 'A planilha desta importação não está mais no servidor'}), 410
+    
+    importacao.status = 'pendente'
+    importacao.mensagem = None
+    importacao.data_conclusao = None
+    db.session.commit()
+    importador_estoque.despachar(importacao.id)
+    
+    print(f"📥 Importação #{importacao.id} retomada a partir da linha {importacao.linhas_lidas}")
+    return jsonify({'success': True, 'importacao': importacao_para_json(importacao)}), 202
+
+# ========== FECHAMENTO DIÁRIO DO ESTOQUE ==========
+# Saldo numa data = fechamento mais próximo + movimentações entre os dois. Alterações de
+# estoque sem movimentação (edição da grade no cadastro do produto) ficam certas a partir
+# do fechamento seguinte, que grava o estoque_atual de verdade.
+
+def quantidade_com_sinal(mov=Movimentacao):
+    """Quantidade da movimentação com o sentido no estoque (AJUSTE guarda o valor absoluto e o sentido em `sinal`)"""
+    return case(
+        (mov.tipo == 'SAIDA', -mov.quantidade),
+        (db.and_(mov.tipo == 'AJUSTE', mov.sinal < 0), -mov.quantidade),
+        else_=mov.quantidade
+    )
+
+def saldos_vigentes(fechamento_id=None, grades=None):
+    """Subconsulta (grade_id, estoque) com o último saldo gravado de cada grade até o fechamento"""
+    # no SQLite as colunas soltas de um GROUP BY com max() vêm da linha do máximo:
+    # uma passada só pelo índice (grade_id, fechamento_id, estoque), sem juntar de volta
+    consulta = db.select(
+        SaldoFechamento.grade_id, SaldoFechamento.estoque, func.max(SaldoFechamento.fechamento_id)
+    )
+    if fechamento_id is not None:
+        consulta = consulta.where(SaldoFechamento.fechamento_id <= fechamento_id)
+    if grades is not None:
+        consulta = consulta.where(SaldoFechamento.grade_id.in_(grades))
+    return consulta.group_by(SaldoFechamento.grade_id).subquery()
+
+def registrar_fechamento(usuario='Sistema'):
+    """Grava o saldo atual das grades que mudaram desde o último fechamento (o primeiro grava todas)"""
+    fechamento = FechamentoEstoque(usuario=usuario)
+    db.session.add(fechamento)
+    db.session.flush()
+    # o INSERT acima já segura a escrita no SQLite: nenhuma venda entra entre o momento e a leitura
+    fechamento.momento = hora_brasil()
+    
+    colunas = ['fechamento_id', 'grade_id', 'estoque']
+    vigente = saldos_vigentes()
+    atual = func.coalesce(Grade.estoque_atual, 0)
+    mudaram = db.select(db.literal(fechamento.id), Grade.id, atual).outerjoin(
+        vigente, vigente.c.grade_id == Grade.id
+    ).where(db.or_(vigente.c.grade_id.is_(None), vigente.c.estoque != atual))
+    # grade apagada: zera o saldo para as datas seguintes não herdarem o último valor
+    apagadas = db.select(db.literal(fechamento.id), vigente.c.grade_id, db.literal(0)).where(
+        vigente.c.estoque != 0,
+        ~db.exists().where(Grade.id == vigente.c.grade_id)
+    )
+    gravadas = db.session.execute(insert(SaldoFechamento).from_select(colunas, mudaram)).rowcount
+    gravadas += db.session.execute(insert(SaldoFechamento).from_select(colunas, apagadas)).rowcount
+    fechamento.grades = gravadas
+    db.session.commit()
+    return fechamento
+
+def estoque_na_data(momento, grades=None):
+    """{grade_id: estoque} em `momento`, partindo do fechamento mais próximo antes dele.
+    
+    Antes do primeiro fechamento volta a partir dele (ou do estoque atual, se ainda não houver
+    nenhum) descontando as movimentações do intervalo. `grades` filtra por lista ou subconsulta de ids.
+    """
+    base = FechamentoEstoque.query.filter(FechamentoEstoque.momento <= momento)\
+        .order_by(FechamentoEstoque.momento.desc()).first()
+    if base is None:
+        base = FechamentoEstoque.query.order_by(FechamentoEstoque.momento).first()
+    
+    if base:
+        vigente = saldos_vigentes(base.id, grades)
+        saldos = dict(db.session.execute(db.select(vigente.c.grade_id, vigente.c.estoque)).all())
+        referencia = base.momento
+    else:
+        consulta = db.select(Grade.id, func.coalesce(Grade.estoque_atual, 0))
+        if grades is not None:
+            consulta = consulta.where(Grade.id.in_(grades))
+        saldos = dict(db.session.execute(consulta).all())
+        referencia = hora_brasil()
+    
+    sentido = 1 if momento >= referencia else -1
+    inicio, fim = sorted((referencia, momento))
+    mov = movimentacoes_do_periodo(inicio)
+    movimentos = db.select(mov.grade_id, func.sum(quantidade_com_sinal(mov))).where(
+        mov.data > inicio, mov.data <= fim
+    )
+    if grades is not None:
+        movimentos = movimentos.where(mov.grade_id.in_(grades))
+    for grade_id, quantidade in db.session.execute(movimentos.group_by(mov.grade_id)):
+        saldos[grade_id] = saldos.get(grade_id, 0) + sentido * (quantidade or 0)
+    return saldos, base
+
+def fechamento_para_json(fechamento):
+    return {
+        'id': fechamento.id,
+        'momento': fechamento.momento.strftime('%d/%m/%Y %H:%M:%S'),
+        'grades': fechamento.grades,
+        'usuario': fechamento.usuario
+    }
+
+class FechamentoDiario:
+    """Rotina diária: grava o saldo de abertura, arquiva as movimentações que passaram do
+    horizonte e apaga as chaves de idempotência vencidas.
+    
+    No servidor, uma thread confere a virada do dia a cada INTERVALO segundos (a primeira
+    conferência já é depois do primeiro intervalo, para não pesar na subida do app); o
+    comando `flask fechar-estoque` roda a mesma rotina na hora.
+    """
+    INTERVALO = 300
+    
+    def __init__(self):
+        self.dia = None
+        self.trava = threading.Lock()
+        self.thread = None
+    
+    def iniciar(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._vigiar, name='fechamento-estoque', daemon=True)
+            self.thread.start()
+    
+    def _vigiar(self):
+        while True:
+            time.sleep(self.INTERVALO)
+            self.verificar()
+    
+    def verificar(self):
+        hoje = hora_brasil().date()
+        if self.dia == hoje or not self.trava.acquire(blocking=False):
+            return
+        try:
+            with app.app_context():
+                self.executar(hoje)
+            self.dia = hoje
+        except Exception as e:
+            print(f"❌ Erro no fechamento diário do estoque: {e}")
+        finally:
+            self.trava.release()
+    
+    def executar(self, hoje, forcar=False):
+        """Fechamento + arquivo + limpeza; sem `forcar`, só se ainda não houver fechamento hoje"""
+        try:
+            ultimo = db.session.query(func.max(FechamentoEstoque.momento)).scalar()
+            if not forcar and ultimo is not None and ultimo.date() >= hoje:
+                return
+            inicio = time.perf_counter()
+            fechamento = registrar_fechamento()
+            print(f"📸 Fechamento #{fechamento.id}: {fechamento.grades} saldo(s) em {time.perf_counter() - inicio:.1f}s")
+            movidas = arquivar_movimentacoes()
+            if movidas:
+                print(f"🗄️ {movidas} movimentação(ões) arquivada(s) em {time.perf_counter() - inicio:.1f}s")
+            apagadas = limpar_chaves_idempotencia()
+            if apagadas:
+                print(f"🧹 {apagadas} chave(s) de idempotência vencida(s) apagada(s)")
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            db.session.remove()
+
+fechamento_diario = FechamentoDiario()
+
+@app.cli.command('fechar-estoque')
+def comando_fechar_estoque():
+    """Grava um fechamento do estoque agora e arquiva as movimentações antigas (para agendar fora do horário da loja)"""
+    fechamento_diario.executar(hora_brasil().date(), forcar=True)
+    print("✅ Fechamento diário concluído")
+
+@app.route('/api/estoque/fechamentos', methods=['GET', 'POST'])
+@login_required
+def api_fechamentos_estoque():
+    """GET lista os fechamentos do período; POST grava um fechamento agora"""
+    if request.method == 'POST':
+        if not session.get('usuario_admin'):
+            return jsonify({'success': False, 'error': 'Acesso restrito a administradores'}), 403
+        try:
+            fechamento = registrar_fechamento(session.get('usuario_nome') or 'Sistema')
+            print(f"📸 Fechamento #{fechamento.id} sob demanda: {fechamento.grades} saldo(s)")
+            return jsonify({'success': True, 'fechamento': fechamento_para_json(fechamento)}), 201
+        except Exception as e:
+            db.session.rollback()
+            return jsonify({'success': False, 'error': str(e)}), 500
+    
+    query = FechamentoEstoque.query
+    try:
+        if request.args.get('data_inicio'):
+            query = query.filter(FechamentoEstoque.momento >= datetime.strptime(request.args['data_inicio'], '%Y-%m-%d'))
+        if request.args.get('data_fim'):
+            query = query.filter(FechamentoEstoque.momento <= datetime.strptime(request.args['data_fim'] + ' 23:59:59', '%Y-%m-%d %H:%M:%S'))
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Data inválida (use AAAA-MM-DD)'}), 400
+    fechamentos = query.order_by(FechamentoEstoque.momento.desc()).limit(400).all()
+    return jsonify({'success': True, 'fechamentos': [fechamento_para_json(f) for f in fechamentos]})
+
+@app.route('/api/estoque/saldo', methods=['GET'])
+@login_required
+def api_estoque_na_data():
+    """Saldo por grade no fim do dia: ?data=AAAA-MM-DD[&grade_id=][&produto_id=]"""
+    try:
+        momento = datetime.strptime(request.args.get('data', ''), '%Y-%m-%d') + timedelta(days=1) - timedelta(microseconds=1)
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Informe a data (AAAA-MM-DD)'}), 400
+    
+    grades = None
+    if request.args.get('grade_id', type=int):
+        grades = [request.args.get('grade_id', type=int)]
+    elif request.args.get('produto_id', type=int):
+        grades = db.select(Grade.id).where(Grade.produto_id == request.args.get('produto_id', type=int))
+    
+    saldos, base = estoque_na_data(momento, grades)
+    
+    consulta = db.select(Grade.id, Grade.sku_grade, Grade.produto_id, Grade.cor, Grade.tamanho)
+    if grades is not None:
+        consulta = consulta.where(Grade.id.in_(grades))
+    cadastro = {linha[0]: linha for linha in db.session.execute(consulta)}
+    
+    itens = []
+    for grade_id, estoque in sorted(saldos.items()):
+        _, sku_grade, produto_id, cor, tamanho = cadastro.get(grade_id) or (grade_id, None, None, None, None)
+        itens.append({
+            'grade_id': grade_id,
+            'sku_grade': sku_grade,
+            'produto_id': produto_id,
+            'cor': cor,
+            'tamanho': tamanho,
+            'estoque': estoque
+        })
+    
+    return jsonify({
+        'success': True,
+        'data': momento.strftime('%d/%m/%Y'),
+        'fechamento_base': fechamento_para_json(base) if base else None,
+        'total': sum(saldos.values()),
+        'grades': itens
+    })
+
+# ========== ARQUIVO DE MOVIMENTAÇÕES ==========
+# Movimentações mais antigas que o horizonte saem de `movimentacao` para instance/archive_AAAA.db
+# (um banco por ano). A tabela quente fica pequena; os relatórios só anexam os arquivos quando
+# o período pedido começa antes da movimentação mais antiga que ficou nela.
+ARQUIVO_LOTE = 5000  # cada lote segura o banco por uma fração de segundo
+ARQUIVO_MAX_ANEXOS = 9  # o SQLite anexa até 10 bancos por conexão; período com mais anos é recusado
+COLUNAS_MOVIMENTACAO = ', '.join(c.name for c in Movimentacao.__table__.columns)
+
+# Mesmas colunas de `movimentacao`, sem a FK (a grade está no banco principal)
+DDL_ARQUIVO_MOVIMENTACAO = [
+    """CREATE TABLE IF NOT EXISTS {banco}.movimentacao (
+        id INTEGER PRIMARY KEY, tipo VARCHAR(10), grade_id INTEGER, quantidade INTEGER, data DATETIME,
+        origem VARCHAR(100), documento VARCHAR(100), observacao TEXT, usuario VARCHAR(100), sinal INTEGER
+    )""",
+    'CREATE INDEX IF NOT EXISTS {banco}.ix_movimentacao_data ON movimentacao (data)',
+    'CREATE INDEX IF NOT EXISTS {banco}.ix_movimentacao_documento ON movimentacao (documento)',
+    'CREATE INDEX IF NOT EXISTS {banco}.ix_movimentacao_grade_id ON movimentacao (grade_id)',
+]
+
+def caminho_arquivo_movimentacoes(ano):
+    return os.path.join(instance_path, f'archive_{ano}.db')
+
+def anos_arquivados():
+    anos = []
+    for nome in os.listdir(instance_path):
+        achado = re.fullmatch(r'archive_(\d{4})\.db', nome)
+        if achado:
+            anos.append(int(achado.group(1)))
+    return sorted(anos)
+
+def anexar_arquivos(conexao, anos):
+    """ATTACH dos arquivos dos anos como arquivo_AAAA (fora de transação; os já anexados ficam)"""
+    anexados = [linha[1] for linha in conexao.exec_driver_sql('PRAGMA database_list') if linha[1].startswith('arquivo_')]
+    novos = [ano for ano in anos if f'arquivo_{ano}' not in anexados]
+    if len(anexados) + len(novos) > ARQUIVO_MAX_ANEXOS:
+        for banco in anexados:
+            if int(banco[8:]) in anos:
+                continue
+            conexao.exec_driver_sql(f'DETACH DATABASE {banco}')
+    for ano in novos:
+        banco = f'arquivo_{ano}'
+        conexao.exec_driver_sql(f'ATTACH DATABASE ? AS {banco}', (caminho_arquivo_movimentacoes(ano),))
+        for ddl in DDL_ARQUIVO_MOVIMENTACAO:
+            conexao.exec_driver_sql(ddl.format(banco=banco))
+
+def tabela_arquivo(banco):
+    return db.Table(
+        'movimentacao', db.MetaData(),
+        *(db.Column(c.name, c.type, primary_key=c.primary_key) for c in Movimentacao.__table__.columns),
+        schema=banco
+    )
+
+def anos_do_periodo(inicio=None, fim=None):
+    """Anos arquivados que o período alcança (None = sem limite), do mais antigo ao mais novo"""
+    return [ano for ano in anos_arquivados()
+            if (inicio is None or ano >= inicio.year) and (fim is None or ano <= fim.year)]
+
+def movimentacoes_do_periodo(inicio=None, fim=None):
+    """Entidade para consultar as movimentações entre `inicio` e `fim` (None = sem limite).
+    
+    Enquanto a tabela quente cobre o período devolve o próprio Movimentacao. Senão anexa na
+    conexão da sessão os arquivos dos anos necessários e devolve um alias sobre o UNION ALL
+    deles com a tabela quente (o SQLite empurra o WHERE para cada parte e usa os índices).
+    Período que alcança mais de ARQUIVO_MAX_ANEXOS anos arquivados levanta ValueError;
+    para percorrer o histórico inteiro use movimentacoes_do_ano, um ano por vez.
+    """
+    anos = anos_do_periodo(inicio, fim)
+    if inicio is not None and anos:
+        mais_antiga = db.session.query(func.min(Movimentacao.data)).scalar()
+        if mais_antiga is not None and inicio >= mais_antiga:
+            return Movimentacao
+    if not anos:
+        return Movimentacao
+    
+    if len(anos) > ARQUIVO_MAX_ANEXOS:
+        raise ValueError(
+            f'O período alcança {len(anos)} anos arquivados ({anos[0]} a {anos[-1]}); '
+            f'consulte no máximo {ARQUIVO_MAX_ANEXOS} anos por vez'
+        )
+    anexar_arquivos(db.session.connection(), anos)
+    partes = [db.select(Movimentacao.__table__)] + [db.select(tabela_arquivo(f'arquivo_{ano}')) for ano in anos]
+    return aliased(Movimentacao, db.union_all(*partes).subquery('movimentacao_historico'))
+
+def movimentacoes_do_ano(ano):
+    """Entidade sobre só o arquivo de `ano` (sem a tabela quente), anexado na conexão da sessão"""
+    anexar_arquivos(db.session.connection(), [ano])
+    return aliased(Movimentacao, tabela_arquivo(f'arquivo_{ano}'), adapt_on_names=True)
+
+def arquivar_movimentacoes(dias=None):
+    """Move para os arquivos anuais as movimentações anteriores ao horizonte; devolve quantas"""
+    dias = dias or app.config['HORIZONTE_MOVIMENTACOES_DIAS']
+    limite = datetime.combine((hora_brasil() - timedelta(days=dias)).date(), datetime.min.time())
+    movidas = 0
+    with db.engine.connect() as conexao:
+        # a mais nova nunca sai: o SQLite reaproveitaria o id dela e o arquivo ficaria com ids repetidos
+        maior_id = conexao.execute(db.select(func.max(Movimentacao.id))).scalar()
+        while maior_id is not None:
+            mais_antiga = conexao.execute(
+                db.select(func.min(Movimentacao.data)).where(Movimentacao.id < maior_id)
+            ).scalar()
+            if mais_antiga is None or mais_antiga >= limite:
+                break
+            # um lote nunca atravessa o ano: só um arquivo anexado por vez
+            ano = mais_antiga.year
+            parametros = {'corte': min(limite, datetime(ano + 1, 1, 1)), 'maior_id': maior_id, 'lote': ARQUIVO_LOTE}
+            parametros['ate'] = conexao.execute(text(
+                'SELECT max(id) FROM (SELECT id FROM movimentacao WHERE data < :corte AND id < :maior_id '
+                'ORDER BY id LIMIT :lote)'
+            ), parametros).scalar()
+            
+            anexar_arquivos(conexao, [ano])
+            # cópia e remoção no mesmo commit (atômico entre os bancos anexados). EXCLUSIVE já no
+            # início trava os dois na mesma ordem das leituras: sem ele o lote travava o arquivo no
+            # meio da transação e um relatório lendo os dois bancos ficava em deadlock até o timeout
+            conexao.exec_driver_sql('BEGIN EXCLUSIVE')
+            conexao.execute(text(
+                f'INSERT INTO arquivo_{ano}.movimentacao ({COLUNAS_MOVIMENTACAO}) '
+                f'SELECT {COLUNAS_MOVIMENTACAO} FROM main.movimentacao WHERE id <= :ate AND data < :corte'
+            ), parametros)
+            movidas += conexao.execute(text(
+                'DELETE FROM main.movimentacao WHERE id <= :ate AND data < :corte'
+            ), parametros).rowcount
+            conexao.commit()
+    return movidas
+
+# No backup os arquivos viajam dentro da cópia do banco, como tabelas arquivo_movimentacao_AAAA
+# (um arquivo só para baixar e restaurar). `backup_arquivos` marca os backups que já os levam.
+PREFIXO_BACKUP_ARQUIVO = 'arquivo_movimentacao_'
+
+def incluir_arquivos_no_backup(caminho_backup):
+    """Copia as movimentações arquivadas para dentro do backup recém-copiado do banco"""
+    conexao = sqlite3.connect(caminho_backup)
+    try:
+        conexao.execute('CREATE TABLE IF NOT EXISTS backup_arquivos (ano INTEGER PRIMARY KEY)')
+        for ano in anos_arquivados():
+            conexao.execute('ATTACH DATABASE ? AS arquivo', (caminho_arquivo_movimentacoes(ano),))
+            conexao.execute(f'CREATE TABLE {PREFIXO_BACKUP_ARQUIVO}{ano} AS SELECT * FROM arquivo.movimentacao')
+            # arquivada entre a cópia do banco e a dos arquivos: já está na tabela quente do backup
+            conexao.execute(f'DELETE FROM {PREFIXO_BACKUP_ARQUIVO}{ano} WHERE id IN (SELECT id FROM movimentacao)')
+            conexao.execute('INSERT INTO backup_arquivos (ano) VALUES (?)', (ano,))
+            conexao.commit()
+            conexao.execute('DETACH DATABASE arquivo')
+    finally:
+        conexao.close()
+
+def restaurar_arquivos_do_backup(caminho_banco):
+    """Depois de copiar um backup sobre o banco, refaz os archive_AAAA.db a partir dele.
+    
+    Backup com `backup_arquivos`: os arquivos ficam exatamente os do backup (os de anos que
+    ele não tem são apagados; o backup automático pré-restauração guarda tudo). Backup antigo,
+    sem os arquivos: mantém os atuais e tira deles o que voltou para a tabela quente, senão
+    os relatórios somariam essas movimentações duas vezes.
+    """
+    conexao = sqlite3.connect(caminho_banco)
+    try:
+        tabelas = {linha[0] for linha in conexao.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        if 'backup_arquivos' not in tabelas:
+            for ano in anos_arquivados():
+                conexao.execute('ATTACH DATABASE ? AS arquivo', (caminho_arquivo_movimentacoes(ano),))
+                conexao.execute('DELETE FROM arquivo.movimentacao WHERE id IN (SELECT id FROM main.movimentacao)')
+                conexao.commit()
+                conexao.execute('DETACH DATABASE arquivo')
+            return
+        
+        anos = [linha[0] for linha in conexao.execute('SELECT ano FROM backup_arquivos ORDER BY ano')]
+        for ano in anos:
+            origem = f'{PREFIXO_BACKUP_ARQUIVO}{ano}'
+            colunas = ', '.join(linha[1] for linha in conexao.execute(f'PRAGMA table_info({origem})'))
+            caminho = caminho_arquivo_movimentacoes(ano)
+            if os.path.exists(caminho + '.tmp'):
+                os.remove(caminho + '.tmp')
+            conexao.execute('ATTACH DATABASE ? AS arquivo', (caminho + '.tmp',))
+            for ddl in DDL_ARQUIVO_MOVIMENTACAO:
+                conexao.execute(ddl.format(banco='arquivo'))
+            conexao.execute(f'INSERT INTO arquivo.movimentacao ({colunas}) SELECT {colunas} FROM {origem}')
+            conexao.commit()
+            conexao.execute('DETACH DATABASE arquivo')
+            os.replace(caminho + '.tmp', caminho)
+        for ano in anos_arquivados():
+            if ano not in anos:
+                os.remove(caminho_arquivo_movimentacoes(ano))
+        
+        for ano in anos:
+            conexao.execute(f'DROP TABLE {PREFIXO_BACKUP_ARQUIVO}{ano}')
+        conexao.execute('DROP TABLE backup_arquivos')
+        conexao.commit()
+    finally:
+        conexao.close()
+
+@app.cli.command('arquivar-movimentacoes')
+@click.option('--dias', type=int, help='Horizonte em dias (padrão: HORIZONTE_MOVIMENTACOES_DIAS)')
+def comando_arquivar_movimentacoes(dias):
+    """Move as movimentações antigas para instance/archive_AAAA.db"""
+    movidas = arquivar_movimentacoes(dias)
+    print(f"✅ {movidas} movimentação(ões) arquivada(s)")
+
 # ========== ROTAS PDV ==========
 @app.route('/pdv')
 def pdv():
@@ -1764,6 +3385,563 @@ def pdv():
     
     return render_template('pdv/index.html')
 
+# ========== ÍNDICE DE BUSCA DO PDV ==========
+class LinhaBuscaPDV:
+    """Linha do catálogo mantida no índice de busca do PDV"""
+    __slots__ = ('id', 'produto_id', 'sku', 'descricao_produto', 'sku_produto', 'modelo', 'cor',
+                 'tamanho', 'estoque', 'preco', 'localizacao', 'ean', 'textos', 'texto', 'palavras')
+    
+    def __init__(self, linha):
+        self.id = linha.id
+        self.produto_id = linha.produto_id
+        self.sku = linha.sku_grade
+        self.descricao_produto = linha.descricao
+        self.sku_produto = linha.sku
+        self.modelo = linha.modelo
+        self.cor = linha.cor
+        self.tamanho = linha.tamanho
+        self.estoque = linha.estoque_atual or 0
+        self.preco = linha.preco_venda
+        self.localizacao = linha.localizacao
+        self.ean = linha.ean
+        self.textos = tuple(
+            IndiceBuscaPDV.normalizar(v)
+            for v in (self.sku, self.descricao_produto, self.cor, self.sku_produto, self.modelo)
+        )
+        # \x00 separa os campos para um termo nunca casar atravessando dois deles
+        self.texto = '\x00'.join(self.textos)
+        # Palavras de descrição, cor e modelo (não SKUs) para o dicionário da busca aproximada
+        self.palavras = frozenset(
+            palavra for texto in self.textos[1:3] + self.textos[4:] for palavra in texto.split()
+        )
+    
+    def para_json(self):
+        return {
+            'id': self.id,
+            'sku': self.sku,
+            'descricao': f"{self.descricao_produto} {self.cor} T{self.tamanho}",
+            'preco': self.preco,
+            'estoque': self.estoque,
+            'produto_id': self.produto_id,
+            'cor': self.cor,
+            'tamanho': self.tamanho,
+            'localizacao': self.localizacao
+        }
+
+class IndiceBuscaPDV:
+    """Índice de trigramas em memória para a busca do PDV.
+    
+    Indexa sku_grade, descrição, cor, SKU e modelo do produto. Cada texto
+    distinto é indexado uma única vez e aponta para as grades que o usam, então
+    cores e descrições repetidas não multiplicam a memória. Termos comuns (ou
+    de 2 letras) varrem as grades em ordem de id e param no limite; termos
+    seletivos usam a interseção dos trigramas.
+    
+    Quando a busca exata não acha nada, `buscar_aproximado` tenta corrigir
+    cada palavra do termo contra um dicionário das palavras de descrição, cor
+    e modelo (mais os cadastros de Modelo e Cor), por trigramas e distância
+    de edição, dentro de um orçamento de tempo fixo.
+    
+    Também mantém o mapa código -> grade (EAN e sku_grade) usado pelo leitor
+    de código de barras. Alterações de grades/produtos só marcam os ids como
+    pendentes; a próxima busca recarrega esses ids com uma única consulta.
+    """
+    
+    LIMITE_VARREDURA = 500  # acima disso a varredura com parada antecipada é mais barata
+    ORCAMENTO_APROXIMADO = 0.05   # segundos por busca aproximada; estourou, devolve o que tiver
+    CANDIDATAS_PALAVRA = 30       # palavras do dicionário avaliadas por distância de edição
+    ALTERNATIVAS_PALAVRA = 3      # correções aceitas por palavra digitada
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.construido = False
+        self.grades = {}            # grade_id -> LinhaBuscaPDV
+        self.ids_ordenados = []     # grade_ids em ordem crescente
+        self.por_produto = {}       # produto_id -> set(grade_id)
+        self.valores = {}           # texto normalizado -> set(grade_id)
+        self.trigramas = {}         # trigrama -> set(texto normalizado)
+        self.por_codigo = {}        # EAN ou sku_grade normalizado -> grade_id
+        self.dicionario = {}        # palavra -> nº de grades/cadastros que a usam
+        self.palavras_ordenadas = []  # chaves de `dicionario` em ordem, para teste de prefixo
+        self.trigramas_palavras = {}  # trigrama (com bordas) -> set(palavra)
+        self.palavras_catalogo = set()  # palavras vindas das tabelas Modelo e Cor
+        self.grades_pendentes = set()
+        self.produtos_pendentes = set()
+        self.catalogo_pendente = False
+    
+    @staticmethod
+    def normalizar(texto):
+        return normalizar_busca(texto)
+    
+    @staticmethod
+    def gerar_trigramas(texto):
+        return {texto[i:i + 3] for i in range(len(texto) - 2)}
+    
+    @staticmethod
+    def trigramas_palavra(palavra):
+        # Bordas com espaço: palavras curtas também têm trigramas e o começo pesa mais
+        return IndiceBuscaPDV.gerar_trigramas(f' {palavra} ')
+    
+    @staticmethod
+    def distancia_edicao(a, b, maximo):
+        """Levenshtein entre a e b, ou maximo + 1 assim que passar de `maximo`"""
+        if abs(len(a) - len(b)) > maximo:
+            return maximo + 1
+        anterior = list(range(len(b) + 1))
+        for i, ca in enumerate(a, 1):
+            atual = [i]
+            for j, cb in enumerate(b, 1):
+                atual.append(min(anterior[j] + 1, atual[j - 1] + 1, anterior[j - 1] + (ca != cb)))
+            if min(atual) > maximo:
+                return maximo + 1
+            anterior = atual
+        return anterior[-1]
+    
+    @staticmethod
+    def distancia_maxima(palavra):
+        return 1 if len(palavra) <= 4 else 2 if len(palavra) <= 8 else 3
+    
+    def _consulta_linhas(self):
+        return db.session.query(
+            Grade.id, Grade.produto_id, Grade.sku_grade, Grade.cor, Grade.tamanho,
+            Grade.estoque_atual, Grade.localizacao, Grade.ean,
+            Produto.descricao, Produto.sku, Produto.preco_venda, Produto.modelo
+        ).join(Produto, Grade.produto_id == Produto.id)
+    
+    def _consulta_catalogo(self):
+        nomes = db.session.query(Modelo.nome).union_all(db.session.query(Cor.nome))
+        return {palavra for (nome,) in nomes for palavra in self.normalizar(nome).split()}
+    
+    def _incluir_palavra(self, palavra, ordenar=True):
+        contagem = self.dicionario.get(palavra, 0)
+        self.dicionario[palavra] = contagem + 1
+        if contagem:
+            return
+        if ordenar:
+            bisect.insort(self.palavras_ordenadas, palavra)
+        for trigrama in self.trigramas_palavra(palavra):
+            self.trigramas_palavras.setdefault(trigrama, set()).add(palavra)
+    
+    def _excluir_palavra(self, palavra):
+        contagem = self.dicionario.get(palavra, 0)
+        if contagem > 1:
+            self.dicionario[palavra] = contagem - 1
+            return
+        self.dicionario.pop(palavra, None)
+        posicao = bisect.bisect_left(self.palavras_ordenadas, palavra)
+        if posicao < len(self.palavras_ordenadas) and self.palavras_ordenadas[posicao] == palavra:
+            self.palavras_ordenadas.pop(posicao)
+        for trigrama in self.trigramas_palavra(palavra):
+            palavras = self.trigramas_palavras.get(trigrama)
+            if palavras is not None:
+                palavras.discard(palavra)
+                if not palavras:
+                    del self.trigramas_palavras[trigrama]
+    
+    def _trocar_catalogo(self, palavras, ordenar=True):
+        for palavra in self.palavras_catalogo - palavras:
+            self._excluir_palavra(palavra)
+        for palavra in palavras - self.palavras_catalogo:
+            self._incluir_palavra(palavra, ordenar)
+        self.palavras_catalogo = palavras
+    
+    def _adicionar(self, linha, ordenar=True):
+        grade = LinhaBuscaPDV(linha)
+        self.grades[grade.id] = grade
+        if ordenar:
+            bisect.insort(self.ids_ordenados, grade.id)
+        self.por_produto.setdefault(grade.produto_id, set()).add(grade.id)
+        for codigo in (grade.ean, self.normalizar(grade.sku)):
+            if codigo:
+                self.por_codigo[codigo] = grade.id
+        for palavra in grade.palavras:
+            self._incluir_palavra(palavra, ordenar)
+        for texto in grade.textos:
+            if not texto:
+                continue
+            grades = self.valores.get(texto)
+            if grades is None:
+                grades = self.valores[texto] = set()
+                for trigrama in self.gerar_trigramas(texto):
+                    self.trigramas.setdefault(trigrama, set()).add(texto)
+            grades.add(grade.id)
+    
+    def _remover(self, grade_id):
+        grade = self.grades.pop(grade_id, None)
+        if not grade:
+            return
+        posicao = bisect.bisect_left(self.ids_ordenados, grade_id)
+        if posicao < len(self.ids_ordenados) and self.ids_ordenados[posicao] == grade_id:
+            self.ids_ordenados.pop(posicao)
+        irmas = self.por_produto.get(grade.produto_id)
+        if irmas is not None:
+            irmas.discard(grade_id)
+            if not irmas:
+                del self.por_produto[grade.produto_id]
+        for codigo in (grade.ean, self.normalizar(grade.sku)):
+            if codigo and self.por_codigo.get(codigo) == grade_id:
+                del self.por_codigo[codigo]
+        for palavra in grade.palavras:
+            self._excluir_palavra(palavra)
+        for texto in grade.textos:
+            grades = self.valores.get(texto)
+            if grades is None:
+                continue
+            grades.discard(grade_id)
+            if not grades:
+                del self.valores[texto]
+                for trigrama in self.gerar_trigramas(texto):
+                    textos = self.trigramas.get(trigrama)
+                    if textos is not None:
+                        textos.discard(texto)
+                        if not textos:
+                            del self.trigramas[trigrama]
+    
+    def construir(self):
+        """(Re)constrói o índice inteiro a partir do banco"""
+        linhas = self._consulta_linhas().all()
+        catalogo = self._consulta_catalogo()
+        with self.lock:
+            pendentes = (self.grades_pendentes, self.produtos_pendentes)
+            self.__init__()
+            self.grades_pendentes, self.produtos_pendentes = pendentes
+            for linha in linhas:
+                self._adicionar(linha, ordenar=False)
+            self._trocar_catalogo(catalogo, ordenar=False)
+            self.ids_ordenados = sorted(self.grades)
+            self.palavras_ordenadas = sorted(self.dicionario)
+            self.construido = True
+        print(f"🔎 Índice de busca do PDV: {len(self.grades)} grades, {len(self.valores)} textos, "
+              f"{len(self.dicionario)} palavras")
+    
+    def invalidar(self, grade_ids=(), produto_ids=(), catalogo=False):
+        """Marca grades/produtos (ou os cadastros de Modelo/Cor) alterados para recarga na próxima busca"""
+        with self.lock:
+            self.grades_pendentes.update(i for i in grade_ids if i is not None)
+            self.produtos_pendentes.update(i for i in produto_ids if i is not None)
+            self.catalogo_pendente = self.catalogo_pendente or catalogo
+    
+    def _aplicar_pendentes(self):
+        with self.lock:
+            grade_ids, self.grades_pendentes = self.grades_pendentes, set()
+            produto_ids, self.produtos_pendentes = self.produtos_pendentes, set()
+            catalogo, self.catalogo_pendente = self.catalogo_pendente, False
+        if catalogo:
+            palavras = self._consulta_catalogo()
+            with self.lock:
+                self._trocar_catalogo(palavras)
+        if not grade_ids and not produto_ids:
+            return
+        
+        filtros = []
+        if grade_ids:
+            filtros.append(Grade.id.in_(grade_ids))
+        if produto_ids:
+            filtros.append(Grade.produto_id.in_(produto_ids))
+        linhas = self._consulta_linhas().filter(db.or_(*filtros)).all()
+        
+        with self.lock:
+            afetadas = set(grade_ids)
+            for produto_id in produto_ids:
+                afetadas.update(self.por_produto.get(produto_id, ()))
+            for grade_id in afetadas - {linha.id for linha in linhas}:
+                self._remover(grade_id)
+            for linha in linhas:
+                atual = self.grades.get(linha.id)
+                nova = LinhaBuscaPDV(linha)
+                if (atual is not None and atual.textos == nova.textos
+                        and atual.ean == nova.ean and atual.produto_id == nova.produto_id):
+                    # Só estoque/preço/localização mudaram: as entradas do índice continuam valendo
+                    self.grades[linha.id] = nova
+                    continue
+                self._remover(linha.id)
+                self._adicionar(linha)
+    
+    def _varrer(self, termo, limite, permitidas=None):
+        resultados = []
+        for grade_id in self.ids_ordenados:
+            if permitidas is not None and grade_id not in permitidas:
+                continue
+            grade = self.grades[grade_id]
+            if grade.estoque > 0 and termo in grade.texto:
+                resultados.append(grade)
+                if len(resultados) >= limite:
+                    break
+        return resultados
+    
+    def buscar_linhas(self, termo, limite=20):
+        """Retorna até `limite` LinhaBuscaPDV com estoque cujo texto contém `termo`"""
+        if not self.construido:
+            self.construir()
+        self._aplicar_pendentes()
+        
+        termo = self.normalizar(termo)
+        with self.lock:
+            if len(termo) < 3:
+                return self._varrer(termo, limite)
+            
+            postagens = []
+            for trigrama in self.gerar_trigramas(termo):
+                textos = self.trigramas.get(trigrama)
+                if not textos:
+                    return []
+                postagens.append(textos)
+            postagens.sort(key=len)
+            if len(postagens[0]) > self.LIMITE_VARREDURA:
+                return self._varrer(termo, limite)
+            
+            textos = [texto for texto in postagens[0] if termo in texto]
+            if sum(len(self.valores[texto]) for texto in textos) > self.LIMITE_VARREDURA:
+                return self._varrer(termo, limite)
+            
+            candidatas = set()
+            for texto in textos:
+                candidatas |= self.valores[texto]
+            
+            resultados = []
+            for grade_id in sorted(candidatas):
+                grade = self.grades[grade_id]
+                if grade.estoque > 0:
+                    resultados.append(grade)
+                    if len(resultados) >= limite:
+                        break
+            return resultados
+    
+    def _corrigir_palavra(self, palavra, prazo):
+        """{palavra do dicionário: distância} aceitas como leitura de `palavra`.
+        
+        Prefixo de alguma palavra conhecida vale como está (distância 0). Senão
+        as palavras com mais trigramas em comum passam pela distância de edição,
+        comparada com a palavra inteira e com o prefixo do mesmo tamanho (o
+        caixa ainda pode estar digitando).
+        """
+        posicao = bisect.bisect_left(self.palavras_ordenadas, palavra)
+        if posicao < len(self.palavras_ordenadas) and self.palavras_ordenadas[posicao].startswith(palavra):
+            return {palavra: 0}
+        
+        trigramas = self.trigramas_palavra(palavra)
+        comuns = {}
+        for trigrama in trigramas:
+            for candidata in self.trigramas_palavras.get(trigrama, ()):
+                comuns[candidata] = comuns.get(candidata, 0) + 1
+        minimo = max(1, len(trigramas) // 3)
+        candidatas = sorted((c for c in comuns.items() if c[1] >= minimo), key=lambda c: (-c[1], c[0]))
+        
+        maximo = self.distancia_maxima(palavra)
+        aceitas = {}
+        for candidata, _ in candidatas[:self.CANDIDATAS_PALAVRA]:
+            if time.perf_counter() > prazo:
+                break
+            distancia = min(
+                self.distancia_edicao(palavra, candidata, maximo),
+                self.distancia_edicao(palavra, candidata[:len(palavra)], maximo)
+            )
+            if distancia <= maximo:
+                aceitas[candidata] = distancia
+        melhores = sorted(aceitas.items(), key=lambda a: (a[1], a[0]))[:self.ALTERNATIVAS_PALAVRA]
+        return dict(melhores)
+    
+    def _textos_contendo(self, trecho):
+        """Textos indexados que contêm `trecho` (pela menor lista de trigramas)"""
+        menor = None
+        for trigrama in self.gerar_trigramas(trecho):
+            textos = self.trigramas.get(trigrama)
+            if not textos:
+                return []
+            if menor is None or len(textos) < len(menor):
+                menor = textos
+        return [texto for texto in menor if trecho in texto]
+    
+    def buscar_aproximado(self, termo, limite=20):
+        """Busca tolerante a erros de digitação: todas as palavras (corrigidas) devem aparecer.
+        
+        Palavras com menos de 3 letras ou sem nenhuma correção possível são
+        ignoradas. As grades saem ordenadas pela soma das distâncias das
+        correções usadas; a varredura para quando já tem `limite` grades com a
+        menor soma possível. Passado ORCAMENTO_APROXIMADO devolve o que já
+        tiver (ou nada).
+        """
+        if not self.construido:
+            self.construir()
+        self._aplicar_pendentes()
+        
+        prazo = time.perf_counter() + self.ORCAMENTO_APROXIMADO
+        palavras = [p for p in dict.fromkeys(self.normalizar(termo).split()) if len(p) >= 3]
+        with self.lock:
+            # Por palavra digitada: texto indexado -> menor distância de uma correção contida nele
+            exigencias = []
+            for palavra in palavras:
+                correcoes = self._corrigir_palavra(palavra, prazo)
+                if not correcoes:
+                    continue
+                textos = {}
+                for correcao, distancia in correcoes.items():
+                    for texto in self._textos_contendo(correcao):
+                        if distancia < textos.get(texto, distancia + 1):
+                            textos[texto] = distancia
+                if not textos:
+                    continue
+                exigencias.append(textos)
+                if time.perf_counter() > prazo:
+                    return []
+            if not exigencias:
+                return []
+            
+            # Parte da palavra com menos textos e confere as outras nos textos de cada grade
+            exigencias.sort(key=len)
+            primeira, demais = exigencias[0], exigencias[1:]
+            piso = sum(min(textos.values()) for textos in exigencias)
+            pontuadas, no_piso = [], 0
+            for indice, (texto, distancia) in enumerate(sorted(primeira.items(), key=lambda t: t[1])):
+                if no_piso >= limite or (indice % 64 == 0 and time.perf_counter() > prazo):
+                    break
+                for grade_id in self.valores[texto]:
+                    grade = self.grades[grade_id]
+                    if grade.estoque <= 0:
+                        continue
+                    total = distancia
+                    for textos in demais:
+                        melhor = min((textos[t] for t in grade.textos if t in textos), default=None)
+                        if melhor is None:
+                            break
+                        total += melhor
+                    else:
+                        pontuadas.append((total, grade_id))
+                        no_piso += total == piso
+            pontuadas = sorted(set(pontuadas))
+            
+            resultados, vistas = [], set()
+            for _, grade_id in pontuadas:
+                if grade_id not in vistas:
+                    vistas.add(grade_id)
+                    resultados.append(self.grades[grade_id])
+                    if len(resultados) >= limite:
+                        break
+            return resultados
+    
+    def buscar(self, termo, limite=20):
+        """Busca do PDV já no formato JSON de /api/pdv/buscar.
+        
+        Só cai na busca aproximada quando a exata não acha nada; esses
+        resultados vêm marcados com 'aproximado': True.
+        """
+        linhas = self.buscar_linhas(termo, limite)
+        if linhas:
+            return [grade.para_json() for grade in linhas]
+        return [dict(grade.para_json(), aproximado=True) for grade in self.buscar_aproximado(termo, limite)]
+    
+    def buscar_codigo(self, codigo):
+        """Grade pelo EAN ou, na falta dele, pelo sku_grade exato (O(1))"""
+        if not self.construido:
+            self.construir()
+        self._aplicar_pendentes()
+        
+        codigo = str(codigo).strip()
+        with self.lock:
+            grade_id = self.por_codigo.get(codigo)
+            if grade_id is None:
+                grade_id = self.por_codigo.get(self.normalizar(codigo))
+            grade = self.grades.get(grade_id)
+            return grade.para_json() if grade else None
+
+indice_pdv = IndiceBuscaPDV()
+
+def marcar_grades_alteradas(grade_ids, criadas=False):
+    """Registra na sessão grades alteradas por UPDATE/INSERT em lote (sem ORM)"""
+    grade_ids = set(grade_ids)
+    db.session.info.setdefault('grades_alteradas', set()).update(grade_ids)
+    if criadas:
+        db.session.info.setdefault('grades_criadas', set()).update(grade_ids)
+
+@event.listens_for(SessaoORM, 'after_flush')
+def coletar_alteracoes_catalogo(session, flush_context):
+    grades = session.info.setdefault('grades_alteradas', set())
+    produtos = session.info.setdefault('produtos_alterados', set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Grade):
+            grades.add(obj.id)
+        elif isinstance(obj, Produto):
+            produtos.add(obj.id)
+        elif isinstance(obj, (Modelo, Cor)):
+            session.info['catalogo_alterado'] = True
+    
+    for obj in session.new:
+        if isinstance(obj, Grade):
+            session.info.setdefault('grades_criadas', set()).add(obj.id)
+    for obj in session.deleted:
+        if isinstance(obj, Grade):
+            session.info.setdefault('grades_removidas', set()).add(obj.id)
+
+@event.listens_for(SessaoORM, 'before_commit')
+def versionar_catalogo(session):
+    """Carimba grades/produtos alterados com uma nova versão do catálogo.
+    
+    Roda dentro da transação que está sendo confirmada. O SQLite só tem um
+    escritor por vez, então as versões ficam na mesma ordem dos commits e um
+    terminal que já leu a versão N nunca perde uma alteração com versão > N.
+    """
+    session.flush()
+    grades = {i for i in session.info.get('grades_alteradas', ()) if i is not None}
+    produtos = {i for i in session.info.get('produtos_alterados', ()) if i is not None}
+    if not grades and not produtos:
+        return
+    
+    versao = session.execute(
+        update(ContadorCatalogo).where(ContadorCatalogo.id == 1)
+        .values(valor=ContadorCatalogo.valor + 1).returning(ContadorCatalogo.valor)
+    ).scalar()
+    if versao is None:
+        versao = 1
+        session.execute(insert(ContadorCatalogo).values(id=1, valor=versao))
+    
+    if grades:
+        session.execute(
+            update(Grade).where(Grade.id.in_(grades)).values(alteracao=versao)
+            .execution_options(synchronize_session=False)
+        )
+    if produtos:
+        session.execute(
+            update(Produto).where(Produto.id.in_(produtos)).values(alteracao=versao)
+            .execution_options(synchronize_session=False)
+        )
+    
+    # Estoque novo para quem está ouvindo o stream (publicado depois do commit)
+    if grades and canal_estoque.tem_assinantes():
+        session.info['estoque_publicar'] = (versao, session.execute(
+            db.select(Grade.id, Grade.estoque_atual).where(Grade.id.in_(grades))
+        ).all())
+    
+    # O SQLite pode reaproveitar o id de uma grade apagada: a marca antiga sai
+    criadas = session.info.pop('grades_criadas', set())
+    removidas = session.info.pop('grades_removidas', set())
+    if criadas or removidas:
+        session.execute(GradeRemovida.__table__.delete().where(GradeRemovida.grade_id.in_(criadas | removidas)))
+    if removidas:
+        session.execute(insert(GradeRemovida), [
+            {'grade_id': grade_id, 'alteracao': versao} for grade_id in removidas
+        ])
+
+@event.listens_for(SessaoORM, 'after_commit')
+def publicar_alteracoes_catalogo(session):
+    grades = session.info.pop('grades_alteradas', set())
+    produtos = session.info.pop('produtos_alterados', set())
+    catalogo = session.info.pop('catalogo_alterado', False)
+    if grades or produtos or catalogo:
+        indice_pdv.invalidar(grades, produtos, catalogo)
+    
+    estoque = session.info.pop('estoque_publicar', None)
+    if estoque:
+        versao, linhas = estoque
+        canal_estoque.publicar(versao, [
+            {'grade_id': grade_id, 'estoque_atual': estoque_atual} for grade_id, estoque_atual in linhas
+        ])
+
+@event.listens_for(SessaoORM, 'after_rollback')
+def descartar_alteracoes_catalogo(session):
+    for chave in ('grades_alteradas', 'produtos_alterados', 'grades_criadas', 'grades_removidas',
+                  'estoque_publicar', 'catalogo_alterado'):
+        session.info.pop(chave, None)
+
 @app.route('/api/pdv/buscar', methods=['GET'])
 def pdv_buscar():
     termo = request.args.get('q', '').upper()
@@ -1771,28 +3949,321 @@ def pdv_buscar():
     if not termo or len(termo) < 2:
         return jsonify([])
     
-    grades = Grade.query.join(Produto).filter(
-        (Grade.sku_grade.contains(termo)) |
-        (Produto.descricao.contains(termo)) |
-        (Grade.cor.contains(termo)) |
-        (Produto.sku.contains(termo))
-    ).filter(Grade.estoque_atual > 0).limit(20).all()
+    return jsonify(indice_pdv.buscar(termo, limite=20))
+
+@app.route('/api/pdv/scan/<path:codigo>', methods=['GET'])
+def pdv_scan(codigo):
+    """Leitura do código de barras: devolve a linha pronta para o carrinho"""
+    linha = indice_pdv.buscar_codigo(codigo)
+    if not linha:
+        return jsonify({'success': False, 'error': f'Código {codigo} não encontrado'}), 404
+    return jsonify(linha)
+
+@app.route('/api/pdv/catalogo', methods=['GET'])
+def pdv_catalogo():
+    """Catálogo do PDV para busca local no terminal.
+    
+    Sem ?since (ou com uma versão que o servidor não conhece) devolve o
+    catálogo inteiro; com ?since=<versao> só as grades alteradas depois dela
+    e as removidas. As linhas vêm como listas na ordem de 'campos'.
+    """
+    since = request.args.get('since', 0, type=int)
+    
+    versao = db.session.query(ContadorCatalogo.valor).filter(ContadorCatalogo.id == 1).scalar() or 0
+    completo = since <= 0 or since > versao  # versão desconhecida (ex.: backup restaurado)
+    
+    query = db.session.query(
+        Grade.id, Grade.sku_grade, Produto.descricao, Grade.cor, Grade.tamanho,
+        Produto.preco_venda, Grade.estoque_atual, Produto.imagem, Grade.ean
+    ).join(Produto, Grade.produto_id == Produto.id)
+    
+    removidos = []
+    if not completo:
+        query = query.filter(db.or_(Grade.alteracao > since, Produto.alteracao > since))
+        removidos = [i for (i,) in db.session.query(GradeRemovida.grade_id).filter(GradeRemovida.alteracao > since)]
+    
+    grades = [
+        [g.id, g.sku_grade, g.descricao, g.cor, g.tamanho, g.preco_venda, g.estoque_atual,
+         f'thumb_{g.imagem}' if g.imagem else None, g.ean]
+        for g in query.order_by(Grade.id)
+    ]
+    
+    resposta = jsonify({
+        'success': True,
+        'versao': versao,
+        'completo': completo,
+        'campos': ['id', 'sku', 'descricao', 'cor', 'tamanho', 'preco', 'estoque', 'thumb', 'ean'],
+        'grades': grades,
+        'removidos': removidos
+    })
+    resposta.headers['Cache-Control'] = 'no-cache'
+    return resposta
+
+# ========== STREAM DE ESTOQUE (SSE) ==========
+class CanalEstoque:
+    """Pub/sub em processo das mudanças de estoque para os streams SSE.
     
-    resultados = []
-    for grade in grades:
-        resultados.append({
-            'id': grade.id,
-            'sku': grade.sku_grade,
-            'descricao': f"{grade.produto.descricao} {grade.cor} T{grade.tamanho}",
-            'preco': grade.produto.preco_venda,
-            'estoque': grade.estoque_atual,
-            'produto_id': grade.produto_id,
-            'cor': grade.cor,
-            'tamanho': grade.tamanho,
-            'localizacao': grade.localizacao
-        })
+    Cada cliente tem uma fila limitada. Quem não consome a tempo (fila cheia)
+    é desligado e recebe 'reconectar' para se ressincronizar pelo catálogo,
+    em vez de travar quem publica ou acumular memória.
+    """
+    TAMANHO_FILA = 100
     
-    return jsonify(resultados)
+    def __init__(self):
+        self.assinantes = set()
+        self.lock = threading.Lock()
+    
+    def tem_assinantes(self):
+        return bool(self.assinantes)
+    
+    def assinar(self):
+        fila = queue.Queue(maxsize=self.TAMANHO_FILA)
+        with self.lock:
+            self.assinantes.add(fila)
+        return fila
+    
+    def cancelar(self, fila):
+        with self.lock:
+            self.assinantes.discard(fila)
+    
+    def ativo(self, fila):
+        return fila in self.assinantes
+    
+    def publicar(self, versao, mudancas):
+        with self.lock:
+            assinantes = list(self.assinantes)
+        
+        evento = (versao, json.dumps(mudancas, separators=(',', ':')))
+        for fila in assinantes:
+            try:
+                fila.put_nowait(evento)
+            except queue.Full:
+                self.cancelar(fila)
+                print("⚠️ Stream de estoque: cliente lento desligado")
+
+canal_estoque = CanalEstoque()
+
+@app.route('/api/estoque/stream')
+def stream_estoque():
+    """Server-Sent Events com {grade_id, estoque_atual} a cada commit que muda estoque.
+    
+    O id de cada evento é a versão do catálogo; ao receber 'reconectar', o
+    cliente busca /api/pdv/catalogo?since=<último id> e abre o stream de novo.
+    """
+    from flask import Response
+    fila = canal_estoque.assinar()
+    
+    def eventos():
+        try:
+            yield 'retry: 3000\n\n'
+            while True:
+                if not canal_estoque.ativo(fila):
+                    yield 'event: reconectar\ndata: {}\n\n'
+                    return
+                try:
+                    versao, dados = fila.get(timeout=15)
+                except queue.Empty:
+                    yield ': ping\n\n'  # mantém a conexão aberta em proxies
+                    continue
+                yield f'id: {versao}\nevent: estoque\ndata: {dados}\n\n'
+        finally:
+            canal_estoque.cancelar(fila)
+    
+    return Response(eventos(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+# ========== MOTOR DE CHECKOUT DO PDV ==========
+CHECKOUT_TENTATIVAS = 5
+CHECKOUT_ESPERA_BASE = 0.05  # segundos, dobra a cada nova tentativa
+
+class ConflitoEstoque(Exception):
+    """Grade alterada por outro terminal entre a leitura e a baixa"""
+    pass
+
+def banco_ocupado(erro):
+    """Indica se o erro é SQLITE_BUSY / 'database is locked'"""
+    mensagem = str(getattr(erro, 'orig', erro)).lower()
+    return isinstance(erro, OperationalError) and ('locked' in mensagem or 'busy' in mensagem)
+
+def executar_com_retentativa(operacao):
+    """Executa operacao() re-tentando em conflito de versão ou banco ocupado.
+    
+    A cada falha a transação é desfeita e a espera dobra (com jitter) até
+    CHECKOUT_TENTATIVAS; na última tentativa o erro é registrado e repassado.
+    As tentativas intermediárias não imprimem nada: sob disputa elas são
+    rotina e o print a cada uma só pesava no checkout.
+    """
+    for tentativa in range(CHECKOUT_TENTATIVAS):
+        try:
+            return operacao()
+        except (ConflitoEstoque, StaleDataError, OperationalError) as e:
+            db.session.rollback()
+            if isinstance(e, OperationalError) and not banco_ocupado(e):
+                raise
+            if tentativa == CHECKOUT_TENTATIVAS - 1:
+                print(f"⏳ Conflito no estoque ({type(e).__name__}) após {CHECKOUT_TENTATIVAS} tentativas")
+                raise
+            espera = CHECKOUT_ESPERA_BASE * (2 ** tentativa)
+            time.sleep(espera + random.uniform(0, CHECKOUT_ESPERA_BASE))
+
+def registrar_itens_venda(venda, itens, usuario):
+    """Baixa o estoque e grava itens e movimentações da venda em lote.
+    
+    Carrega todas as grades do carrinho com um único IN e baixa o estoque com
+    um UPDATE compare-and-swap sobre Grade.versao (e estoque_atual >= quantidade).
+    Itens e movimentações entram com um INSERT cada. Não faz commit: roda dentro
+    da transação da venda e levanta ConflitoEstoque se outro terminal alterou
+    alguma grade no meio do caminho.
+    
+    Retorna {grade_id: linha} com SKU, cor, tamanho e descrição das grades
+    vendidas, usado para montar o comprovante sem novas consultas.
+    """
+    grade_ids = {int(item['grade_id']) for item in itens}
+    if not grade_ids:
+        return {}
+    
+    grades = {
+        g.id: g for g in db.session.query(
+            Grade.id, Grade.sku_grade, Grade.estoque_atual, Grade.versao,
+            Grade.cor, Grade.tamanho, Produto.descricao
+        ).join(Produto, Grade.produto_id == Produto.id).filter(Grade.id.in_(grade_ids)).all()
+    }
+    
+    # Grades inexistentes são ignoradas, como no fluxo antigo
+    linhas = [item for item in itens if int(item['grade_id']) in grades]
+    if not linhas:
+        return {}
+    
+    quantidades = {}
+    for item in linhas:
+        grade_id = int(item['grade_id'])
+        quantidades[grade_id] = quantidades.get(grade_id, 0) + int(item['quantidade'])
+    
+    for item in linhas:
+        grade = grades[int(item['grade_id'])]
+        if (grade.estoque_atual or 0) < quantidades[grade.id]:
+            raise Exception(f'Estoque insuficiente para {grade.sku_grade}')
+    
+    qtd_por_grade = case(quantidades, value=Grade.id)
+    versao_lida = case({grade_id: grades[grade_id].versao for grade_id in quantidades}, value=Grade.id)
+    resultado = db.session.execute(
+        update(Grade)
+        .where(
+            Grade.id.in_(quantidades.keys()),
+            Grade.versao == versao_lida,
+            Grade.estoque_atual >= qtd_por_grade
+        )
+        .values(estoque_atual=Grade.estoque_atual - qtd_por_grade, versao=Grade.versao + 1)
+        .execution_options(synchronize_session=False)
+    )
+    
+    if resultado.rowcount != len(quantidades):
+        raise ConflitoEstoque('Estoque alterado por outro terminal durante a venda')
+    marcar_grades_alteradas(quantidades.keys())
+    
+    db.session.execute(insert(ItemVenda), [{
+        'venda_id': venda.id,
+        'grade_id': int(item['grade_id']),
+        'quantidade': item['quantidade'],
+        'preco_unitario': item['preco']
+    } for item in linhas])
+    
+    db.session.execute(insert(Movimentacao), [{
+        'tipo': 'SAIDA',
+        'grade_id': int(item['grade_id']),
+        'quantidade': item['quantidade'],
+        'origem': 'VENDA',
+        'documento': f'V-{venda.id}',
+        'observacao': 'Venda no PDV',
+        'usuario': usuario
+    } for item in linhas])
+    
+    return grades
+
+def estornar_venda(venda_id, usuario='Sistema'):
+    """Desfaz uma venda: devolve o estoque, apaga itens e a venda e registra o estorno.
+    
+    O estoque volta com um único UPDATE agrupado por grade e cada grade
+    ganha uma ENTRADA de origem ESTORNO com o mesmo documento (V-<venda>)
+    das saídas. As movimentações só crescem: o saldo numa data (fechamento
+    + movimentações) continua certo depois do cancelamento. Itens são
+    achados pelo índice de item_venda.venda_id, então o custo depende só do
+    tamanho da venda. A chave de idempotência da venda também é apagada:
+    reenvio depois do cancelamento grava uma venda nova em vez de devolver
+    a que não existe mais. Não faz commit. Retorna {grade_id: quantidade devolvida}.
+    """
+    devolver = dict(
+        db.session.query(ItemVenda.grade_id, func.sum(ItemVenda.quantidade))
+        .filter(ItemVenda.venda_id == venda_id)
+        .group_by(ItemVenda.grade_id).all()
+    )
+    
+    if devolver:
+        db.session.execute(
+            update(Grade)
+            .where(Grade.id.in_(devolver.keys()))
+            .values(
+                estoque_atual=func.coalesce(Grade.estoque_atual, 0) + case(devolver, value=Grade.id),
+                versao=Grade.versao + 1
+            )
+            .execution_options(synchronize_session=False)
+        )
+        marcar_grades_alteradas(devolver.keys())
+        db.session.execute(insert(Movimentacao), [{
+            'tipo': 'ENTRADA',
+            'grade_id': grade_id,
+            'quantidade': quantidade,
+            'origem': 'ESTORNO',
+            'documento': f'V-{venda_id}',
+            'observacao': f'Estorno da venda #{venda_id}',
+            'usuario': usuario
+        } for grade_id, quantidade in devolver.items()])
+    
+    db.session.execute(ItemVenda.__table__.delete().where(ItemVenda.venda_id == venda_id))
+    db.session.execute(ChaveIdempotencia.__table__.delete().where(ChaveIdempotencia.venda_id == venda_id))
+    db.session.execute(Venda.__table__.delete().where(Venda.id == venda_id))
+    
+    return devolver
+
+# Terminal só reenvia a venda enquanto espera a resposta; depois disso a chave não serve mais
+RETENCAO_IDEMPOTENCIA = timedelta(days=7)
+
+def hash_corpo_venda(dados):
+    """SHA-256 do corpo da venda, independente da ordem das chaves e dos espaços do JSON"""
+    return hashlib.sha256(json.dumps(dados, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+def resposta_idempotente(chave, hash_corpo):
+    """Resposta já gravada para a chave de idempotência, ou None.
+    
+    A mesma chave com outro corpo é erro do terminal (chave reaproveitada) e
+    volta 422 em vez da venda antiga.
+    """
+    gravada = db.session.query(ChaveIdempotencia.resposta, ChaveIdempotencia.hash_corpo)\
+        .filter(ChaveIdempotencia.chave == chave).first()
+    if gravada is None:
+        return None
+    
+    if gravada.hash_corpo and gravada.hash_corpo != hash_corpo:
+        print(f"⚠️ Chave {chave} reenviada com outra venda")
+        return jsonify({
+            'success': False,
+            'error': 'Chave de idempotência já usada por outra venda'
+        }), 422
+    
+    print(f"🔁 Venda reenviada com a chave {chave}, devolvendo o resultado original")
+    retorno = app.response_class(gravada.resposta, mimetype='application/json')
+    retorno.headers['Idempotent-Replay'] = 'true'
+    return retorno
+
+def limpar_chaves_idempotencia():
+    """Apaga as chaves mais antigas que RETENCAO_IDEMPOTENCIA; roda na rotina diária"""
+    apagadas = db.session.execute(
+        ChaveIdempotencia.__table__.delete().where(ChaveIdempotencia.data_criacao < hora_brasil() - RETENCAO_IDEMPOTENCIA)
+    ).rowcount
+    db.session.commit()
+    return apagadas
 
 @app.route('/api/pdv/venda', methods=['POST'])
 def pdv_venda():
@@ -1800,6 +4271,14 @@ def pdv_venda():
         data = request.json
         itens = data['itens']
         
+        # Terminal reenviando a mesma venda (queda de rede, timeout): devolve o resultado original
+        chave = (request.headers.get('Idempotency-Key') or data.get('chave_idempotencia') or '').strip()[:64]
+        hash_corpo = hash_corpo_venda(data) if chave else None
+        if chave:
+            resposta_gravada = resposta_idempotente(chave, hash_corpo)
+            if resposta_gravada:
+                return resposta_gravada
+        
         print("📥 DADOS RECEBIDOS DA VENDA:", {
             'cliente': data.get('cliente'),
             'cpf': data.get('cpf'),
@@ -1813,149 +4292,168 @@ def pdv_venda():
         desconto_valor = subtotal * (desconto_percentual / 100)
         total = subtotal - desconto_valor
         
-        venda = Venda(
-            total=total,
-            forma_pagamento=data['forma_pagamento'],
-            cliente=data.get('cliente', ''),
-            cliente_cpf=data.get('cpf', data.get('cliente_cpf', '')),
-            desconto=desconto_valor,
-            vendedor=data.get('vendedor', 'PDV'),
-            subtotal=subtotal,
-            desconto_percentual=desconto_percentual
-        )
-        db.session.add(venda)
-        db.session.flush()
+        def gravar_venda():
+            venda = Venda(
+                total=total,
+                forma_pagamento=data['forma_pagamento'],
+                cliente=data.get('cliente', ''),
+                cliente_cpf=data.get('cpf', data.get('cliente_cpf', '')),
+                desconto=desconto_valor,
+                vendedor=data.get('vendedor', 'PDV'),
+                subtotal=subtotal,
+                desconto_percentual=desconto_percentual
+            )
+            db.session.add(venda)
+            db.session.flush()
+            
+            grades = registrar_itens_venda(venda, itens, data.get('vendedor', 'PDV'))
+            
+            itens_comprovante = []
+            for item in itens:
+                grade = grades.get(int(item['grade_id']))
+                if grade:
+                    itens_comprovante.append(item_comprovante(
+                        f"{grade.descricao} {grade.cor}", grade.sku_grade, grade.cor, grade.tamanho,
+                        item['quantidade'], item['preco']
+                    ))
+            empresa = Empresa.query.first()
+            venda.comprovante_json = serializar_comprovante(montar_comprovante(
+                venda, itens_comprovante, empresa, ConfigComprovante.query.first()
+            ))
+            
+            # Impressão automática vai para a fila na mesma transação da venda
+            trabalho = None
+            if empresa and empresa.impressao_tipo == 'auto':
+                trabalho = criar_trabalho_impressao(venda)
+            
+            resposta = {
+                'success': True,
+                'venda_id': venda.id,
+                'total': venda.total,
+                'data': venda.data.strftime('%d/%m/%Y %H:%M'),
+                'cliente': venda.cliente,
+                'cliente_cpf': venda.cliente_cpf,
+                'trabalho_impressao_id': trabalho.id if trabalho else None
+            }
+            
+            # A chave entra na mesma transação: ou a venda e a chave existem, ou nenhuma
+            if chave:
+                db.session.add(ChaveIdempotencia(chave=chave, venda_id=venda.id, hash_corpo=hash_corpo,
+                                                 resposta=json.dumps(resposta)))
+            
+            db.session.commit()
+            return venda, trabalho, resposta
         
-        for item in itens:
-            grade = Grade.query.get(item['grade_id'])
-            if grade:
-                if grade.estoque_atual < item['quantidade']:
-                    raise Exception(f'Estoque insuficiente para {grade.sku_grade}')
-                
-                grade.estoque_atual -= item['quantidade']
-                
-                item_venda = ItemVenda(
-                    venda_id=venda.id,
-                    grade_id=grade.id,
-                    quantidade=item['quantidade'],
-                    preco_unitario=item['preco']
-                )
-                db.session.add(item_venda)
-                
-                mov = Movimentacao(
-                    tipo='SAIDA',
-                    grade_id=grade.id,
-                    quantidade=item['quantidade'],
-                    origem='VENDA',
-                    documento=f'V-{venda.id}',
-                    observacao='Venda no PDV',
-                    usuario=data.get('vendedor', 'PDV')
-                )
-                db.session.add(mov)
+        try:
+            venda, trabalho, resposta = executar_com_retentativa(gravar_venda)
+        except IntegrityError:
+            # Dois envios da mesma chave ao mesmo tempo: o outro gravou primeiro
+            db.session.rollback()
+            resposta_gravada = resposta_idempotente(chave, hash_corpo) if chave else None
+            if resposta_gravada:
+                return resposta_gravada
+            raise
         
-        db.session.commit()
+        if trabalho:
+            spooler.despachar(trabalho)
         
         print(f"✅ VENDA #{venda.id} SALVA:")
         print(f"   Cliente: {venda.cliente}")
         print(f"   CPF: {venda.cliente_cpf}")
         print(f"   Total: R$ {venda.total:.2f}")
         
-        return jsonify({
-            'success': True,
-            'venda_id': venda.id,
-            'total': venda.total,
-            'data': venda.data.strftime('%d/%m/%Y %H:%M'),
-            'cliente': venda.cliente,
-            'cliente_cpf': venda.cliente_cpf
-        })
+        return jsonify(resposta)
         
     except Exception as e:
         db.session.rollback()
+        # Só conflito de versão e banco ocupado valem "tente novamente"; os outros erros
+        # do banco (disco, somente leitura, coluna faltando) saem com a mensagem real
+        if isinstance(e, (ConflitoEstoque, StaleDataError)) or banco_ocupado(e):
+            print(f"❌ ERRO AO SALVAR VENDA (concorrência): {str(e)}")
+            return jsonify({
+                'success': False,
+                'error': 'Estoque em uso por outro terminal, tente novamente'
+            }), 409
         print(f"❌ ERRO AO SALVAR VENDA: {str(e)}")
         return jsonify({'success': False, 'error': str(e)}), 400
 
 @app.route('/api/pdv/vendas', methods=['GET'])
 def pdv_vendas():
+    """Histórico de vendas do PDV, da mais recente para a mais antiga.
+    
+    Filtros: numero, data (dia inteiro), de/ate (YYYY-MM-DD ou YYYY-MM-DDTHH:MM),
+    forma_pagamento e limite. A página seguinte vem do cabeçalho
+    X-Proximo-Cursor, repassado como ?cursor=; cada página custa o mesmo
+    independente de quanto histórico já foi percorrido.
+    """
     try:
-        numero = request.args.get('numero')
-        data_str = request.args.get('data')
-        
-        print(f"🔍 BUSCANDO VENDAS - Número: {numero}, Data: {data_str}")
-        
-        query = Venda.query
+        numero = request.args.get('numero', '').strip()
+        data_str = request.args.get('data', '').strip()
+        de_str = request.args.get('de', '').strip() or data_str
+        ate_str = request.args.get('ate', '').strip() or data_str
+        forma_pagamento = request.args.get('forma_pagamento', '').strip()
+        cursor = request.args.get('cursor', '').strip()
+        limite = request.args.get('limite', 50 if (de_str or ate_str) else 20, type=int)
+        limite = max(1, min(limite, 200))
+        
+        print(f"🔍 BUSCANDO VENDAS - Número: {numero}, De: {de_str}, Até: {ate_str}, Pagamento: {forma_pagamento}")
+        
+        query = db.session.query(
+            Venda.id, Venda.data, Venda.cliente, Venda.cliente_cpf, Venda.vendedor,
+            Venda.total, Venda.subtotal, Venda.desconto, Venda.forma_pagamento
+        )
         
-        if numero and numero.strip():
+        if numero:
             try:
-                venda_id = int(numero)
-                venda = Venda.query.get(venda_id)
-                if venda:
-                    vendas = [venda]
-                else:
-                    vendas = []
-                    print(f"⚠️ Venda #{venda_id} não encontrada")
+                query = query.filter(Venda.id == int(numero))
             except ValueError:
-                vendas = []
                 print(f"⚠️ Número de venda inválido: {numero}")
+                return jsonify([])
         
-        elif data_str and data_str.strip():
-            try:
-                data_inicio = datetime.strptime(data_str, '%Y-%m-%d')
-                data_fim = data_inicio + timedelta(days=1)
-                vendas = Venda.query.filter(
-                    Venda.data >= data_inicio,
-                    Venda.data < data_fim
-                ).order_by(Venda.data.desc()).limit(50).all()
-                print(f"📅 Encontradas {len(vendas)} vendas na data {data_str}")
-            except ValueError as e:
-                vendas = []
-                print(f"❌ Data inválida: {data_str} - {str(e)}")
-        
-        else:
-            vendas = Venda.query.order_by(Venda.data.desc()).limit(20).all()
-            print(f"📊 Últimas {len(vendas)} vendas")
-        
-        resultados = []
-        for venda in vendas:
-            try:
-                venda_data = {
-                    'id': venda.id,
-                    'venda_id': venda.id,
-                    'id_formatado': f"{venda.id:03d}",
-                    'data_criacao': venda.data.isoformat() if venda.data else '',
-                    'cliente_nome': str(venda.cliente) if venda.cliente else '---',
-                    'cliente_cpf': str(venda.cliente_cpf) if hasattr(venda, 'cliente_cpf') and venda.cliente_cpf else '',
-                    'vendedor': str(venda.vendedor) if venda.vendedor else 'Sistema',
-                    'total': float(venda.total) if venda.total else 0.0,
-                    'forma_pagamento': str(venda.forma_pagamento) if venda.forma_pagamento else ''
-                }
-                
-                if hasattr(venda, 'subtotal') and venda.subtotal:
-                    venda_data['subtotal'] = float(venda.subtotal)
-                else:
-                    venda_data['subtotal'] = float(venda.total + venda.desconto) if venda.desconto else float(venda.total)
-                
-                if hasattr(venda, 'desconto'):
-                    venda_data['desconto_valor'] = float(venda.desconto)
-                else:
-                    venda_data['desconto_valor'] = 0.0
-                
-                resultados.append(venda_data)
-                
-            except Exception as e:
-                print(f"⚠️ Erro ao processar venda #{venda.id}: {str(e)}")
-                resultados.append({
-                    'id': venda.id,
-                    'venda_id': venda.id,
-                    'data_criacao': '',
-                    'cliente_nome': '---',
-                    'cliente_cpf': '',
-                    'vendedor': 'Sistema',
-                    'total': 0.0,
-                    'forma_pagamento': ''
-                })
+        try:
+            if de_str:
+                query = query.filter(Venda.data >= datetime.fromisoformat(de_str))
+            if ate_str:
+                ate = datetime.fromisoformat(ate_str)
+                if len(ate_str) == 10:
+                    ate += timedelta(days=1)  # data sem hora inclui o dia inteiro
+                query = query.filter(Venda.data < ate)
+            if cursor:
+                cursor_data, cursor_id = cursor.rsplit('_', 1)
+                query = query.filter(tuple_(Venda.data, Venda.id) < (datetime.fromisoformat(cursor_data), int(cursor_id)))
+        except ValueError as e:
+            print(f"❌ Filtro inválido: {str(e)}")
+            return jsonify({'error': f'Filtro inválido: {str(e)}'}), 400
+        
+        if forma_pagamento:
+            query = query.filter(Venda.forma_pagamento == forma_pagamento)
+        
+        linhas = query.order_by(Venda.data.desc(), Venda.id.desc()).limit(limite + 1).all()
+        proximo_cursor = None
+        if len(linhas) > limite:
+            linhas = linhas[:limite]
+            ultima = linhas[-1]
+            proximo_cursor = f"{ultima.data.isoformat()}_{ultima.id}"
+        
+        resultados = [{
+            'id': venda.id,
+            'venda_id': venda.id,
+            'id_formatado': f"{venda.id:03d}",
+            'data_criacao': venda.data.isoformat() if venda.data else '',
+            'cliente_nome': venda.cliente or '---',
+            'cliente_cpf': venda.cliente_cpf or '',
+            'vendedor': venda.vendedor or 'Sistema',
+            'total': float(venda.total or 0),
+            'forma_pagamento': venda.forma_pagamento or '',
+            'subtotal': float(venda.subtotal) if venda.subtotal else float((venda.total or 0) + (venda.desconto or 0)),
+            'desconto_valor': float(venda.desconto or 0)
+        } for venda in linhas]
         
         print(f"✅ Retornando {len(resultados)} vendas")
-        return jsonify(resultados)
+        resposta = jsonify(resultados)
+        if proximo_cursor:
+            resposta.headers['X-Proximo-Cursor'] = proximo_cursor
+        return resposta
         
     except Exception as e:
         print(f"❌ ERRO CRÍTICO em /api/pdv/vendas: {str(e)}")
@@ -1963,141 +4461,402 @@ def pdv_vendas():
         traceback.print_exc()
         return jsonify({'error': str(e), 'details': 'Erro interno no servidor'}), 500
 
-@app.route('/api/pdv/venda/<int:venda_id>/comprovante', methods=['GET'])
-def pdv_comprovante(venda_id):
-    try:
-        venda = Venda.query.get_or_404(venda_id)
-        
-        print(f"📄 GERANDO COMPROVANTE VENDA #{venda_id}:")
-        venda_id_formatado = f"{venda.id:03d}"
-        print(f"   Cliente: {venda.cliente}")
-        print(f"   CPF: {venda.cliente_cpf}")
-        
-        empresa = Empresa.query.first()
-        config_comprovante = ConfigComprovante.query.first()
-        
-        if not empresa:
-            empresa = Empresa(
-                razao_social='Havaianas Store',
-                nome_fantasia='Havaianas',
-                logo=None,
-                logo_login=None
-            )
-        
-        if not config_comprovante:
-            config_comprovante = ConfigComprovante()
-        
-        config_impressao = {
-            'tipo': empresa.impressao_tipo or 'dialogo',
-            'papel': empresa.impressao_papel or '80mm',
-            'vias': empresa.impressao_vias or 1,
-            'copiar': empresa.impressao_copiar or False,
-            'mensagem': empresa.impressao_mensagem or config_comprovante.rodape or 'Obrigado pela preferência!'
+# ========== AUDITORIA ==========
+class Auditoria:
+    """Log de auditoria de ações sensíveis (reimpressão, exclusão de venda,
+    inventário, backup).
+    
+    registrar() só coloca a entrada numa fila; uma thread grava em lote as
+    linhas JSON em instance/auditoria/auditoria.log e o índice (ação, venda,
+    usuário → arquivo e posição) em instance/auditoria/indice.db. O índice
+    fica fora do banco principal para não se perder quando um backup é
+    restaurado. O arquivo ativo é girado e comprimido (.gz) quando passa do
+    tamanho máximo ou muda o dia.
+    """
+    ARQUIVO_ATIVO = 'auditoria.log'
+    TAMANHO_MAXIMO = 5 * 1024 * 1024
+    LOTE_MAXIMO = 500
+    INTERVALO_LOTE = 1.0
+    
+    def __init__(self, pasta):
+        self.pasta = pasta
+        self.fila = queue.Queue(maxsize=50000)
+        self.descartadas = 0
+        self.thread = None
+        self.lock = threading.Lock()
+    
+    def registrar(self, acao, venda_id=None, usuario=None, **detalhes):
+        entrada = {
+            'data': hora_brasil().isoformat(timespec='seconds'),
+            'acao': acao,
+            'venda_id': venda_id,
+            'usuario': usuario
         }
+        if has_request_context():
+            entrada['usuario'] = usuario or session.get('usuario_nome') or 'Sistema'
+            entrada['ip'] = request.remote_addr
+        entrada.update(detalhes)
         
-        print(f"📋 CONFIGURAÇÃO DE IMPRESSÃO: {config_impressao}")
-        
-        itens_detalhes = []
-        for item in venda.itens:
-            grade = Grade.query.get(item.grade_id)
-            if grade:
-                produto = Produto.query.get(grade.produto_id)
-                descricao = f"{produto.descricao} {grade.cor}" if produto else f"Produto #{grade.id}"
-                sku = grade.sku_grade if grade else f"GRADE-{item.grade_id}"
-                cor = grade.cor if grade else ''
-                tamanho = grade.tamanho if grade else ''
-            else:
-                descricao = f"Produto #{item.grade_id}"
-                sku = f"GRADE-{item.grade_id}"
-                cor = ''
-                tamanho = ''
+        self._iniciar()
+        try:
+            self.fila.put_nowait(entrada)
+        except queue.Full:
+            self.descartadas += 1
+            print(f"⚠️ Auditoria: fila cheia, entrada descartada ({acao})")
+    
+    def _iniciar(self):
+        if self.thread is not None:
+            return
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._gravar, name='auditoria', daemon=True)
+                self.thread.start()
+                atexit.register(self.encerrar)
+    
+    def encerrar(self, espera=5):
+        """Grava o que ainda está na fila (chamado na saída do processo)"""
+        if self.thread is not None and self.thread.is_alive():
+            self.fila.put(None)
+            self.thread.join(espera)
+    
+    def _conectar(self):
+        os.makedirs(self.pasta, exist_ok=True)
+        conexao = sqlite3.connect(os.path.join(self.pasta, 'indice.db'), timeout=10)
+        conexao.executescript("""
+            CREATE TABLE IF NOT EXISTS indice (
+                id INTEGER PRIMARY KEY,
+                data TEXT NOT NULL,
+                acao TEXT NOT NULL,
+                venda_id INTEGER,
+                usuario TEXT,
+                arquivo TEXT NOT NULL,
+                posicao INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS ix_indice_venda ON indice (venda_id, id);
+            CREATE INDEX IF NOT EXISTS ix_indice_usuario ON indice (usuario, id);
+            CREATE INDEX IF NOT EXISTS ix_indice_acao ON indice (acao, id);
+            CREATE INDEX IF NOT EXISTS ix_indice_arquivo ON indice (arquivo);
+        """)
+        return conexao
+    
+    def _gravar(self):
+        conexao = self._conectar()
+        while True:
+            lote = [self.fila.get()]
+            prazo = time.monotonic() + self.INTERVALO_LOTE
+            while lote[-1] is not None and len(lote) < self.LOTE_MAXIMO:
+                restante = prazo - time.monotonic()
+                if restante <= 0:
+                    break
+                try:
+                    lote.append(self.fila.get(timeout=restante))
+                except queue.Empty:
+                    break
             
-            itens_detalhes.append({
-                'descricao': descricao,
-                'sku': sku,
-                'cor': cor,
-                'tamanho': tamanho,
-                'quantidade': item.quantidade,
-                'preco': float(item.preco_unitario),
-                'subtotal': float(item.quantidade * item.preco_unitario)
-            })
+            encerrar = lote[-1] is None
+            lote = [entrada for entrada in lote if entrada is not None]
+            if lote:
+                try:
+                    self._escrever(conexao, lote)
+                except Exception as e:
+                    print(f"❌ Auditoria: erro ao gravar {len(lote)} entrada(s): {e}")
+            if encerrar:
+                conexao.close()
+                return
+    
+    def _escrever(self, conexao, lote):
+        caminho = os.path.join(self.pasta, self.ARQUIVO_ATIVO)
+        self._girar_se_preciso(conexao, caminho, lote[0]['data'][:10])
+        
+        linhas_indice = []
+        with open(caminho, 'ab') as f:
+            for entrada in lote:
+                linhas_indice.append((
+                    entrada['data'], entrada['acao'], entrada.get('venda_id'),
+                    entrada.get('usuario'), self.ARQUIVO_ATIVO, f.tell()
+                ))
+                f.write(json.dumps(entrada, ensure_ascii=False, default=str).encode('utf-8') + b'\n')
+        
+        conexao.executemany(
+            'INSERT INTO indice (data, acao, venda_id, usuario, arquivo, posicao) VALUES (?, ?, ?, ?, ?, ?)',
+            linhas_indice
+        )
+        conexao.commit()
+    
+    def _girar_se_preciso(self, conexao, caminho, dia_lote):
+        if not os.path.exists(caminho):
+            return
         
-        if hasattr(venda, 'subtotal') and venda.subtotal:
-            subtotal = float(venda.subtotal)
-        else:
-            subtotal = sum(item['quantidade'] * item['preco'] for item in itens_detalhes)
+        # Mesmo relógio das entradas (hora_brasil)
+        dia_arquivo = (datetime.fromtimestamp(os.path.getmtime(caminho), timezone.utc) - timedelta(hours=3)).strftime('%Y-%m-%d')
+        if os.path.getsize(caminho) < self.TAMANHO_MAXIMO and dia_arquivo >= dia_lote:
+            return
         
-        if hasattr(venda, 'desconto_percentual') and venda.desconto_percentual:
-            desconto_percentual = float(venda.desconto_percentual)
-        else:
-            desconto_percentual = (float(venda.desconto) / subtotal * 100) if subtotal > 0 else 0.0
-        
-        endereco_completo = ''
-        if empresa and config_comprovante.mostrar_endereco:
-            endereco_parts = []
-            if empresa.endereco:
-                endereco_parts.append(empresa.endereco)
-            if empresa.numero:
-                endereco_parts.append(f"nº {empresa.numero}")
-            if empresa.bairro:
-                endereco_parts.append(empresa.bairro)
-            if empresa.cidade and empresa.uf:
-                endereco_parts.append(f"{empresa.cidade}/{empresa.uf}")
-            if empresa.cep:
-                endereco_parts.append(f"CEP: {empresa.cep}")
-            endereco_completo = ' - '.join(endereco_parts)
-        
-        contato = []
-        if empresa and config_comprovante.mostrar_telefone:
-            if empresa.telefone:
-                contato.append(f"Tel: {empresa.telefone}")
-            if empresa.celular:
-                contato.append(f"Cel: {empresa.celular}")
-        contato_texto = ' | '.join(contato)
-        
-        cnpj_formatado = ''
-        if empresa and empresa.cnpj and config_comprovante.mostrar_cnpj:
-            cnpj = empresa.cnpj.replace('.', '').replace('-', '').replace('/', '')
-            if len(cnpj) == 14:
-                cnpj_formatado = f"CNPJ: {cnpj[:2]}.{cnpj[2:5]}.{cnpj[5:8]}/{cnpj[8:12]}-{cnpj[12:]}"
-        
-        comprovante = {
+        nome = f"auditoria-{dia_arquivo.replace('-', '')}-{datetime.now().strftime('%H%M%S%f')}.log.gz"
+        with open(caminho, 'rb') as origem, gzip.open(os.path.join(self.pasta, nome), 'wb') as destino:
+            shutil.copyfileobj(origem, destino)
+        
+        conexao.execute('UPDATE indice SET arquivo = ? WHERE arquivo = ?', (nome, self.ARQUIVO_ATIVO))
+        conexao.commit()
+        os.remove(caminho)
+        print(f"🗜️ Auditoria: arquivo girado para {nome}")
+    
+    def consultar(self, acao=None, venda_id=None, usuario=None, de=None, ate=None, antes_de=None, limite=100):
+        """Entradas mais recentes primeiro; antes_de é o id do índice da última entrada já vista"""
+        filtros, parametros = [], []
+        for coluna, valor in (('acao', acao), ('venda_id', venda_id), ('usuario', usuario)):
+            if valor is not None:
+                filtros.append(f'{coluna} = ?')
+                parametros.append(valor)
+        if de:
+            filtros.append('data >= ?')
+            parametros.append(de)
+        if ate:
+            filtros.append('data <= ?')
+            parametros.append(ate if 'T' in ate else ate + 'T23:59:59')
+        if antes_de:
+            filtros.append('id < ?')
+            parametros.append(antes_de)
+        
+        conexao = self._conectar()
+        try:
+            sql = 'SELECT id, arquivo, posicao FROM indice'
+            if filtros:
+                sql += ' WHERE ' + ' AND '.join(filtros)
+            linhas = conexao.execute(sql + ' ORDER BY id DESC LIMIT ?', parametros + [limite]).fetchall()
+        finally:
+            conexao.close()
+        
+        # Lê cada arquivo uma vez, em ordem de posição
+        por_arquivo = {}
+        for indice_id, arquivo, posicao in linhas:
+            por_arquivo.setdefault(arquivo, []).append((posicao, indice_id))
+        
+        entradas = {}
+        for arquivo, posicoes in por_arquivo.items():
+            caminho = os.path.join(self.pasta, arquivo)
+            abrir = gzip.open if arquivo.endswith('.gz') else open
+            try:
+                with abrir(caminho, 'rb') as f:
+                    for posicao, indice_id in sorted(posicoes):
+                        f.seek(posicao)
+                        entradas[indice_id] = json.loads(f.readline())
+            except FileNotFoundError:
+                print(f"⚠️ Auditoria: arquivo {arquivo} não encontrado")
+        
+        return [dict(entradas[indice_id], id=indice_id) for indice_id, _, _ in linhas if indice_id in entradas]
+
+auditoria = Auditoria(os.path.join(instance_path, 'auditoria'))
+
+@app.route('/api/auditoria', methods=['GET'])
+@login_required
+@admin_required
+def api_auditoria():
+    """Consulta o log de auditoria por ação, venda, usuário e período"""
+    try:
+        limite = max(1, min(request.args.get('limite', 100, type=int), 500))
+        registros = auditoria.consultar(
+            acao=request.args.get('acao') or None,
+            venda_id=request.args.get('venda_id', type=int),
+            usuario=request.args.get('usuario') or None,
+            de=request.args.get('de') or None,
+            ate=request.args.get('ate') or None,
+            antes_de=request.args.get('cursor', type=int),
+            limite=limite
+        )
+        return jsonify({
             'success': True,
-            'comprovante': {
-                'id': venda.id,
-                'venda_id': venda.id,
-                'venda_id_formatado': venda_id_formatado,
-                'data_criacao': venda.data.isoformat(),
-                'cliente_nome': venda.cliente or 'CONSUMIDOR',
-                'cliente_cpf': venda.cliente_cpf or '',
-                'vendedor': venda.vendedor,
-                'itens': itens_detalhes,
-                'subtotal': subtotal,
-                'desconto_percentual': desconto_percentual,
-                'desconto_valor': float(venda.desconto),
-                'total': float(venda.total),
-                'forma_pagamento': venda.forma_pagamento,
-                
-                'empresa': {
-                    'razao_social': empresa.razao_social or 'Havaianas Store',
-                    'nome_fantasia': empresa.nome_fantasia or 'Havaianas',
-                    'logo': empresa.logo,
-                    'logo_login': empresa.logo_login,
-                    'cnpj_formatado': cnpj_formatado,
-                    'endereco': endereco_completo,
-                    'contato': contato_texto,
-                    'cabecalho': config_comprovante.cabecalho if config_comprovante else '',
-                    'rodape': config_comprovante.rodape if config_comprovante else 'Obrigado pela preferência!',
-                    'mostrar_logo': config_comprovante.mostrar_logo if config_comprovante else True
-                },
-                
-                'config_impressao': config_impressao
-            }
+            'registros': registros,
+            'proximo_cursor': registros[-1]['id'] if len(registros) == limite else None
+        })
+    except Exception as e:
+        print(f"❌ Erro ao consultar auditoria: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+# ========== COMPROVANTE DA VENDA ==========
+def item_comprovante(descricao, sku, cor, tamanho, quantidade, preco):
+    """Linha de item no formato do comprovante"""
+    return {
+        'descricao': descricao,
+        'sku': sku,
+        'cor': cor or '',
+        'tamanho': tamanho or '',
+        'quantidade': quantidade,
+        'preco': float(preco),
+        'subtotal': float(quantidade * preco)
+    }
+
+def config_impressao_atual(empresa=None, config_comprovante=None):
+    """Tipo, papel, vias e mensagem da impressão, sempre da configuração vigente.
+    
+    Fica fora do comprovante congelado: mudar o papel ou as vias vale também
+    para a reimpressão de vendas antigas.
+    """
+    empresa = empresa or Empresa.query.first() or Empresa()
+    config_comprovante = config_comprovante or ConfigComprovante.query.first() or ConfigComprovante()
+    return {
+        'tipo': empresa.impressao_tipo or 'dialogo',
+        'papel': empresa.impressao_papel or '80mm',
+        'vias': empresa.impressao_vias or 1,
+        'copiar': empresa.impressao_copiar or False,
+        'mensagem': empresa.impressao_mensagem or config_comprovante.rodape or 'Obrigado pela preferência!'
+    }
+
+def montar_comprovante(venda, itens_detalhes, empresa, config_comprovante):
+    """Monta o documento do comprovante (itens, cabeçalho da empresa e totais).
+    
+    Chamado na gravação da venda; o resultado é congelado em
+    Venda.comprovante_json, então reimpressões mostram os nomes e dados da
+    empresa do momento da venda. A configuração de impressão não entra no
+    documento (veja config_impressao_atual).
+    """
+    if not empresa:
+        empresa = Empresa(
+            razao_social='Havaianas Store',
+            nome_fantasia='Havaianas',
+            logo=None,
+            logo_login=None
+        )
+    
+    if not config_comprovante:
+        config_comprovante = ConfigComprovante()
+    
+    if venda.subtotal:
+        subtotal = float(venda.subtotal)
+    else:
+        subtotal = sum(item['quantidade'] * item['preco'] for item in itens_detalhes)
+    
+    if venda.desconto_percentual:
+        desconto_percentual = float(venda.desconto_percentual)
+    else:
+        desconto_percentual = (float(venda.desconto or 0) / subtotal * 100) if subtotal > 0 else 0.0
+    
+    endereco_completo = ''
+    if config_comprovante.mostrar_endereco:
+        endereco_parts = []
+        if empresa.endereco:
+            endereco_parts.append(empresa.endereco)
+        if empresa.numero:
+            endereco_parts.append(f"nº {empresa.numero}")
+        if empresa.bairro:
+            endereco_parts.append(empresa.bairro)
+        if empresa.cidade and empresa.uf:
+            endereco_parts.append(f"{empresa.cidade}/{empresa.uf}")
+        if empresa.cep:
+            endereco_parts.append(f"CEP: {empresa.cep}")
+        endereco_completo = ' - '.join(endereco_parts)
+    
+    contato = []
+    if config_comprovante.mostrar_telefone:
+        if empresa.telefone:
+            contato.append(f"Tel: {empresa.telefone}")
+        if empresa.celular:
+            contato.append(f"Cel: {empresa.celular}")
+    contato_texto = ' | '.join(contato)
+    
+    cnpj_formatado = ''
+    if empresa.cnpj and config_comprovante.mostrar_cnpj:
+        cnpj = empresa.cnpj.replace('.', '').replace('-', '').replace('/', '')
+        if len(cnpj) == 14:
+            cnpj_formatado = f"CNPJ: {cnpj[:2]}.{cnpj[2:5]}.{cnpj[5:8]}/{cnpj[8:12]}-{cnpj[12:]}"
+    
+    return {
+        'id': venda.id,
+        'venda_id': venda.id,
+        'venda_id_formatado': f"{venda.id:03d}",
+        'data_criacao': venda.data.isoformat(),
+        'cliente_nome': venda.cliente or 'CONSUMIDOR',
+        'cliente_cpf': venda.cliente_cpf or '',
+        'vendedor': venda.vendedor,
+        'itens': itens_detalhes,
+        'subtotal': subtotal,
+        'desconto_percentual': desconto_percentual,
+        'desconto_valor': float(venda.desconto or 0),
+        'total': float(venda.total or 0),
+        'forma_pagamento': venda.forma_pagamento,
+        
+        'empresa': {
+            'razao_social': empresa.razao_social or 'Havaianas Store',
+            'nome_fantasia': empresa.nome_fantasia or 'Havaianas',
+            'logo': empresa.logo,
+            'logo_login': empresa.logo_login,
+            'cnpj': format_cnpj(empresa.cnpj),
+            'cnpj_formatado': cnpj_formatado,
+            'endereco': endereco_completo,
+            'contato': contato_texto,
+            'cabecalho': config_comprovante.cabecalho or '',
+            'rodape': config_comprovante.rodape or 'Obrigado pela preferência!',
+            'mostrar_logo': config_comprovante.mostrar_logo if config_comprovante.mostrar_logo is not None else True
         }
+    }
+
+def serializar_comprovante(comprovante):
+    return json.dumps(comprovante, ensure_ascii=False, separators=(',', ':'))
+
+def carregar_comprovante(venda_id):
+    """JSON do comprovante com uma leitura por chave primária.
+    
+    Vendas gravadas antes do comprovante congelado são montadas a partir
+    das tabelas a cada pedido, sem gravar nada (as rotas que chamam são GET).
+    Retorna None se a venda não existir.
+    """
+    comprovante_json = db.session.query(Venda.comprovante_json).filter(Venda.id == venda_id).scalar()
+    if comprovante_json:
+        return comprovante_json
+    
+    venda = db.session.get(Venda, venda_id)
+    if not venda:
+        return None
+    
+    linhas = db.session.query(
+        ItemVenda.quantidade, ItemVenda.preco_unitario, ItemVenda.grade_id,
+        Grade.sku_grade, Grade.cor, Grade.tamanho, Produto.descricao
+    ).outerjoin(Grade, ItemVenda.grade_id == Grade.id)\
+     .outerjoin(Produto, Grade.produto_id == Produto.id)\
+     .filter(ItemVenda.venda_id == venda_id).order_by(ItemVenda.id).all()
+    
+    itens_detalhes = []
+    for linha in linhas:
+        if linha.sku_grade is not None:
+            descricao = f"{linha.descricao} {linha.cor}" if linha.descricao is not None else f"Produto #{linha.grade_id}"
+            itens_detalhes.append(item_comprovante(
+                descricao, linha.sku_grade, linha.cor, linha.tamanho,
+                linha.quantidade, linha.preco_unitario
+            ))
+        else:
+            itens_detalhes.append(item_comprovante(
+                f"Produto #{linha.grade_id}", f"GRADE-{linha.grade_id}", '', '',
+                linha.quantidade, linha.preco_unitario
+            ))
+    
+    return serializar_comprovante(montar_comprovante(
+        venda, itens_detalhes, Empresa.query.first(), ConfigComprovante.query.first()
+    ))
+
+def comprovante_para_impressao(comprovante_json):
+    """Comprovante congelado com a configuração de impressão vigente"""
+    comprovante = json.loads(comprovante_json)
+    comprovante['config_impressao'] = config_impressao_atual()
+    return comprovante
+
+def etag_comprovante(comprovante_json):
+    return hashlib.md5(comprovante_json.encode('utf-8')).hexdigest()
+
+@app.route('/api/pdv/venda/<int:venda_id>/comprovante', methods=['GET'])
+def pdv_comprovante(venda_id):
+    try:
+        comprovante_json = carregar_comprovante(venda_id)
+        if comprovante_json is None:
+            return jsonify({'success': False, 'error': f'Venda #{venda_id} não encontrada'}), 404
         
-        return jsonify(comprovante)
+        corpo = json.dumps({'success': True, 'comprovante': comprovante_para_impressao(comprovante_json)},
+                           ensure_ascii=False, separators=(',', ':'))
+        resposta = app.response_class(corpo, mimetype='application/json')
+        resposta.set_etag(etag_comprovante(corpo))
+        return resposta.make_conditional(request)
         
     except Exception as e:
+        db.session.rollback()
         print(f"❌ ERRO AO GERAR COMPROVANTE: {str(e)}")
         import traceback
         traceback.print_exc()
@@ -2106,27 +4865,13 @@ def pdv_comprovante(venda_id):
 @app.route('/api/pdv/venda/<int:venda_id>/reimprimir', methods=['POST'])
 def reimprimir_venda(venda_id):
     try:
-        venda = Venda.query.get(venda_id)
+        venda = db.session.query(Venda.vendedor, Venda.total).filter(Venda.id == venda_id).first()
         if not venda:
             return jsonify({'success': False, 'error': 'Venda não encontrada'}), 404
         
-        log_entry = {
-            'timestamp': datetime.now().isoformat(),
-            'acao': 'reimpressao',
-            'venda_id': venda_id,
-            'vendedor': venda.vendedor,
-            'total': float(venda.total),
-            'ip': request.remote_addr
-        }
-        
-        with open('reimpressoes.log', 'a') as f:
-            f.write(json.dumps(log_entry) + '\n')
+        auditoria.registrar('reimpressao', venda_id=venda_id, vendedor=venda.vendedor, total=float(venda.total))
         
         print(f"=== VENDA #{venda_id} REIMPRESSA ===")
-        print(f"Data: {datetime.now()}")
-        print(f"Vendedor: {venda.vendedor}")
-        print(f"Total: R$ {venda.total:.2f}")
-        print("=" * 40)
         
         return jsonify({
             'success': True,
@@ -2144,7 +4889,7 @@ def excluir_venda_pdv(venda_id):
         print(f"📤 Método: DELETE")
         print(f"🕐 Data/Hora: {datetime.now()}")
         
-        venda = Venda.query.get(venda_id)
+        venda = db.session.query(Venda.cliente, Venda.total, Venda.vendedor).filter(Venda.id == venda_id).first()
         if not venda:
             print(f"❌ VENDA #{venda_id} NÃO ENCONTRADA NO BANCO")
             return jsonify({
@@ -2155,29 +4900,17 @@ def excluir_venda_pdv(venda_id):
         print(f"📋 DADOS DA VENDA #{venda_id}:")
         print(f"   Cliente: {venda.cliente}")
         print(f"   Total: R$ {venda.total:.2f}")
-        print(f"   Itens: {len(venda.itens)}")
         print(f"   Vendedor: {venda.vendedor}")
         
-        for item in venda.itens:
-            grade = Grade.query.get(item.grade_id)
-            if grade:
-                print(f"   ↪️ {grade.sku_grade}: +{item.quantidade} unidades")
-                grade.estoque_atual += item.quantidade
-            else:
-                print(f"   ⚠️ Grade {item.grade_id} não encontrada")
-        
-        movimentacoes = Movimentacao.query.filter_by(documento=f'V-{venda_id}').all()
-        print(f"🗑️ REMOVENDO {len(movimentacoes)} MOVIMENTAÇÕES")
-        for mov in movimentacoes:
-            db.session.delete(mov)
-        
-        itens_count = ItemVenda.query.filter_by(venda_id=venda_id).count()
-        print(f"🗑️ REMOVENDO {itens_count} ITENS DA VENDA")
-        ItemVenda.query.filter_by(venda_id=venda_id).delete()
-        
-        db.session.delete(venda)
+        devolvido = estornar_venda(venda_id, session.get('usuario_nome') or 'Sistema')
         db.session.commit()
         
+        auditoria.registrar(
+            'venda_excluida', venda_id=venda_id, cliente=venda.cliente, vendedor=venda.vendedor,
+            total=float(venda.total), estoque_devolvido={str(k): v for k, v in devolvido.items()}
+        )
+        
+        print(f"↪️ ESTOQUE DEVOLVIDO: {sum(devolvido.values())} unidades em {len(devolvido)} grades")
         print(f"✅ VENDA #{venda_id} EXCLUÍDA COM SUCESSO")
         print("=========================================")
         
@@ -2293,43 +5026,55 @@ def relatorio_produtos_parados():
         Produto.ativo == True
     ).all()
     
+    # produtos com saída nos últimos 30 dias em alguma grade que ainda tem estoque
+    mov = movimentacoes_do_periodo(trinta_dias_atras)
+    com_venda_recente = {produto_id for (produto_id,) in db.session.query(Grade.produto_id).join(
+        mov, mov.grade_id == Grade.id
+    ).filter(
+        mov.tipo == 'SAIDA',
+        mov.data >= trinta_dias_atras,
+        Grade.estoque_atual > 0
+    ).distinct()}
+    parados = [produto for produto in produtos_com_estoque if produto.id not in com_venda_recente]
+    
+    def ultimas_saidas(mov, produto_ids=None):
+        query = db.session.query(Grade.produto_id, func.max(mov.data)).join(
+            mov, mov.grade_id == Grade.id
+        ).filter(mov.tipo == 'SAIDA')
+        if produto_ids is not None:
+            query = query.filter(Grade.produto_id.in_(produto_ids))
+        return dict(query.group_by(Grade.produto_id).all())
+    
+    ultima_saida = ultimas_saidas(Movimentacao)
+    sem_saida = {produto.id for produto in parados if produto.id not in ultima_saida}
+    # só vai ao arquivo pelos produtos sem nenhuma saída na tabela quente, do ano mais novo
+    # para trás e só até achar a última saída de todos
+    for ano in reversed(anos_arquivados()):
+        if not sem_saida:
+            break
+        achadas = ultimas_saidas(movimentacoes_do_ano(ano), sem_saida)
+        ultima_saida.update(achadas)
+        sem_saida -= achadas.keys()
+    
     produtos_parados = []
     valor_total_parado = 0
     
-    for produto in produtos_com_estoque:
-        venda_recente = False
-        for grade in produto.grades:
-            if grade.estoque_atual > 0:
-                mov_saida = Movimentacao.query.filter(
-                    Movimentacao.grade_id == grade.id,
-                    Movimentacao.tipo == 'SAIDA',
-                    Movimentacao.data >= trinta_dias_atras
-                ).first()
-                if mov_saida:
-                    venda_recente = True
-                    break
-        
-        if not venda_recente:
-            total_estoque = sum(g.estoque_atual for g in produto.grades)
-            custo_total = total_estoque * (produto.custo or 15.00)
-            valor_total_parado += custo_total
-            
-            ultima_mov = Movimentacao.query.join(Grade).filter(
-                Grade.produto_id == produto.id,
-                Movimentacao.tipo == 'SAIDA'
-            ).order_by(Movimentacao.data.desc()).first()
-            
-            dias_sem_venda = 30
-            if ultima_mov:
-                dias_sem_venda = (datetime.utcnow() - ultima_mov.data).days
-            
-            produtos_parados.append({
-                'produto': produto,
-                'total_estoque': total_estoque,
-                'custo_total': custo_total,
-                'dias_sem_venda': dias_sem_venda,
-                'valor_estoque': total_estoque * (produto.custo or 15.00)
-            })
+    for produto in parados:
+        total_estoque = sum(g.estoque_atual for g in produto.grades)
+        custo_total = total_estoque * (produto.custo or 15.00)
+        valor_total_parado += custo_total
+        
+        dias_sem_venda = 30
+        if produto.id in ultima_saida:
+            dias_sem_venda = (datetime.utcnow() - ultima_saida[produto.id]).days
+        
+        produtos_parados.append({
+            'produto': produto,
+            'total_estoque': total_estoque,
+            'custo_total': custo_total,
+            'dias_sem_venda': dias_sem_venda,
+            'valor_estoque': total_estoque * (produto.custo or 15.00)
+        })
     
     produtos_parados.sort(key=lambda x: x['dias_sem_venda'], reverse=True)
     
@@ -2349,16 +5094,27 @@ def relatorio_movimentacoes():
     data_fim = request.args.get('data_fim')
     tipo = request.args.get('tipo')
     
-    query = Movimentacao.query.join(Grade).join(Produto).order_by(Movimentacao.data.desc())
-    
-    if data_inicio:
-        query = query.filter(Movimentacao.data >= datetime.strptime(data_inicio, '%Y-%m-%d'))
-    if data_fim:
-        query = query.filter(Movimentacao.data <= datetime.strptime(data_fim + ' 23:59:59', '%Y-%m-%d %H:%M:%S'))
-    if tipo and tipo != 'TODOS':
-        query = query.filter(Movimentacao.tipo == tipo)
-    
-    movimentacoes = query.limit(200).all()
+    inicio = datetime.strptime(data_inicio, '%Y-%m-%d') if data_inicio else None
+    fim = datetime.strptime(data_fim + ' 23:59:59', '%Y-%m-%d %H:%M:%S') if data_fim else None
+    
+    def consultar(mov, limite=200):
+        query = db.session.query(mov).join(Grade, mov.grade_id == Grade.id).join(Produto).order_by(mov.data.desc())
+        if inicio:
+            query = query.filter(mov.data >= inicio)
+        if fim:
+            query = query.filter(mov.data <= fim)
+        if tipo and tipo != 'TODOS':
+            query = query.filter(mov.tipo == tipo)
+        return query.limit(limite).all()
+    
+    movimentacoes = consultar(Movimentacao)
+    # a tabela quente não encheu a página: completa com os arquivos dos anos do período, do mais
+    # novo para trás, anexando um por vez e parando quando a página enche
+    for ano in reversed(anos_do_periodo(inicio, fim)):
+        if len(movimentacoes) >= 200:
+            break
+        movimentacoes += consultar(movimentacoes_do_ano(ano), 200 - len(movimentacoes))
+    movimentacoes.sort(key=lambda m: m.data, reverse=True)
     
     total_entradas = sum(m.quantidade for m in movimentacoes if m.tipo == 'ENTRADA')
     total_saidas = sum(m.quantidade for m in movimentacoes if m.tipo == 'SAIDA')
@@ -2373,85 +5129,104 @@ def relatorio_movimentacoes():
                          data_fim=data_fim,
                          tipo=tipo)
 
+# ========== PAGINAÇÃO DAS LISTAS DE CADASTRO ==========
+ITENS_POR_PAGINA = 50
+
+def paginar_por_cursor(query, chave, coluna_id, descendente, cursor, limite=ITENS_POR_PAGINA):
+    """Uma página de `query` ordenada por (chave, id), continuando depois de `cursor`.
+    
+    O cursor é o par [chave, id] da última linha já mostrada (JSON), então
+    cada página custa o mesmo não importa quão longe a lista já foi. A chave
+    não pode ser NULL (use coalesce nas colunas opcionais). Devolve
+    (linhas, proximo_cursor), com proximo_cursor None na última página.
+    """
+    if cursor:
+        try:
+            valor, ultimo_id = json.loads(cursor)
+            posicao = tuple_(chave, coluna_id)
+            query = query.filter(posicao < (valor, ultimo_id) if descendente else posicao > (valor, ultimo_id))
+        except (ValueError, TypeError):
+            print(f"⚠️ Cursor inválido ignorado: {cursor}")
+    
+    ordem = (chave.desc(), coluna_id.desc()) if descendente else (chave.asc(), coluna_id.asc())
+    linhas = query.add_columns(chave).order_by(*ordem).limit(limite + 1).all()
+    
+    proximo_cursor = None
+    if len(linhas) > limite:
+        linhas = linhas[:limite]
+        ultimo, valor = linhas[-1]
+        proximo_cursor = json.dumps([valor, ultimo.id])
+    return [linha[0] for linha in linhas], proximo_cursor
+
 # ========== ROTAS PARA CLIENTES ==========
+# ordenar -> (chave do cursor, descendente)
+ORDENACAO_CLIENTES = {
+    'id': (Cliente.id, False),
+    'id_desc': (Cliente.id, True),
+    'nome': (Cliente.nome_busca, False),
+    'nome_desc': (Cliente.nome_busca, True),
+    'documento': (func.coalesce(Cliente.cpf_cnpj_digitos, ''), False),
+    'documento_desc': (func.coalesce(Cliente.cpf_cnpj_digitos, ''), True),
+    'contato': (func.coalesce(Cliente.email, ''), False),
+    'contato_desc': (func.coalesce(Cliente.email, ''), True),
+    'localizacao': (func.coalesce(Cliente.cidade, ''), False),
+    'localizacao_desc': (func.coalesce(Cliente.cidade, ''), True),
+    'status': (Cliente.ativo, True),
+    'status_desc': (Cliente.ativo, False),
+}
+
 @app.route('/clientes')
 def listar_clientes():
     busca = request.args.get('q', '')
     tipo_pessoa = request.args.get('tipo_pessoa', 'TODOS')
     status = request.args.get('status', 'ATIVOS')
     ordenar = request.args.get('ordenar', 'id')
+    cursor = request.args.get('cursor', '')
     
-    query = Cliente.query
-    
+    filtros = []
     if busca:
-        query = query.filter(
-            (Cliente.nome.contains(busca)) |
-            (Cliente.cpf_cnpj.contains(busca)) |
-            (Cliente.email.contains(busca)) |
-            (Cliente.celular.contains(busca)) |
-            (Cliente.telefone.contains(busca)) |
-            (Cliente.logradouro.contains(busca)) |
-            (Cliente.bairro.contains(busca)) |
-            (Cliente.cidade.contains(busca)) |
-            (Cliente.estado.contains(busca)) |
-            (Cliente.cep.contains(busca))
-        )
+        filtros.append(db.or_(
+            Cliente.nome_busca.contains(normalizar_busca(busca)),
+            Cliente.email.contains(busca),
+            Cliente.logradouro.contains(busca),
+            Cliente.bairro.contains(busca),
+            Cliente.cidade.contains(busca),
+            Cliente.estado.contains(busca),
+            Cliente.cep.contains(busca),
+            *condicoes_digitos(busca, Cliente.cpf_cnpj_digitos, Cliente.celular_digitos, Cliente.telefone_digitos)
+        ))
     
     if tipo_pessoa in ['FISICA', 'JURIDICA']:
-        query = query.filter_by(tipo=tipo_pessoa)
+        filtros.append(Cliente.tipo == tipo_pessoa)
     
     if status == 'ATIVOS':
-        query = query.filter_by(ativo=True)
+        filtros.append(Cliente.ativo == True)
     elif status == 'INATIVOS':
-        query = query.filter_by(ativo=False)
+        filtros.append(Cliente.ativo == False)
     elif status == 'WHATSAPP':
-        query = query.filter_by(whatsapp=True, ativo=True)
-    
-    if ordenar == 'id':
-        query = query.order_by(Cliente.id.asc())
-    elif ordenar == 'id_desc':
-        query = query.order_by(Cliente.id.desc())
-    elif ordenar == 'nome':
-        query = query.order_by(Cliente.nome.asc())
-    elif ordenar == 'nome_desc':
-        query = query.order_by(Cliente.nome.desc())
-    elif ordenar == 'documento':
-        query = query.order_by(Cliente.cpf_cnpj.asc())
-    elif ordenar == 'documento_desc':
-        query = query.order_by(Cliente.cpf_cnpj.desc())
-    elif ordenar == 'contato':
-        query = query.order_by(Cliente.email.asc(), Cliente.celular.asc())
-    elif ordenar == 'contato_desc':
-        query = query.order_by(Cliente.email.desc(), Cliente.celular.desc())
-    elif ordenar == 'localizacao':
-        query = query.order_by(Cliente.cidade.asc(), Cliente.estado.asc(), Cliente.bairro.asc())
-    elif ordenar == 'localizacao_desc':
-        query = query.order_by(Cliente.cidade.desc(), Cliente.estado.desc(), Cliente.bairro.desc())
-    elif ordenar == 'status':
-        query = query.order_by(Cliente.ativo.desc())
-    elif ordenar == 'status_desc':
-        query = query.order_by(Cliente.ativo.asc())
-    else:
-        query = query.order_by(Cliente.id.asc())
+        filtros.extend([Cliente.whatsapp == True, Cliente.ativo == True])
     
-    clientes = query.all()
-    
-    total_clientes = Cliente.query.count()
-    clientes_ativos = Cliente.query.filter_by(ativo=True).count()
-    clientes_inativos = Cliente.query.filter_by(ativo=False).count()
-    clientes_whatsapp = Cliente.query.filter_by(whatsapp=True, ativo=True).count()
+    chave, descendente = ORDENACAO_CLIENTES.get(ordenar, ORDENACAO_CLIENTES['id'])
+    clientes, proximo_cursor = paginar_por_cursor(
+        Cliente.query.filter(*filtros), chave, Cliente.id, descendente, cursor
+    )
     
+    # Todos os números dos cards numa única passada pela tabela
     inicio_mes = datetime.utcnow().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-    novos_mes = Cliente.query.filter(Cliente.data_cadastro >= inicio_mes).count()
-    
-    top_clientes = Cliente.query.filter_by(ativo=True)\
-        .order_by(Cliente.total_gasto.desc())\
-        .limit(5).all()
+    estatisticas = db.session.query(
+        func.count(Cliente.id),
+        func.sum(case((Cliente.ativo == True, 1), else_=0)),
+        func.sum(case((Cliente.ativo == False, 1), else_=0)),
+        func.sum(case((db.and_(Cliente.whatsapp == True, Cliente.ativo == True), 1), else_=0)),
+        func.sum(case((Cliente.data_cadastro >= inicio_mes, 1), else_=0)),
+        func.sum(Cliente.total_vendas),
+        func.sum(Cliente.total_gasto),
+        func.sum(case((db.and_(*filtros), 1), else_=0)) if filtros else func.count(Cliente.id),
+    ).one()
+    (total_clientes, clientes_ativos, clientes_inativos, clientes_whatsapp,
+     novos_mes, total_vendas, total_gasto, total_resultados) = [valor or 0 for valor in estatisticas]
     
-    total_vendas = db.session.query(db.func.sum(Cliente.total_vendas)).scalar() or 0
-    total_gasto = db.session.query(db.func.sum(Cliente.total_gasto)).scalar() or 0
     ticket_medio = total_gasto / total_vendas if total_vendas > 0 else 0
-    
     percentual_whatsapp = (clientes_whatsapp / clientes_ativos * 100) if clientes_ativos > 0 else 0
     percentual_clientes = (clientes_ativos / total_clientes * 100) if total_clientes > 0 else 0
     
@@ -2461,12 +5236,14 @@ def listar_clientes():
                          tipo_pessoa=tipo_pessoa,
                          status=status,
                          ordenar=ordenar,
+                         cursor=cursor,
+                         proximo_cursor=proximo_cursor,
+                         total_resultados=total_resultados,
                          total_clientes=total_clientes,
                          clientes_ativos=clientes_ativos,
                          clientes_inativos=clientes_inativos,
                          clientes_whatsapp=clientes_whatsapp,
                          novos_mes=novos_mes,
-                         top_clientes=top_clientes,
                          ticket_medio=format_number(ticket_medio),
                          percentual_whatsapp=round(percentual_whatsapp, 1),
                          percentual_clientes=round(percentual_clientes, 1),
@@ -2623,15 +5400,13 @@ def api_buscar_clientes():
         query = Cliente.query.filter_by(ativo=True)
         
         if termo:
-            termo_busca = f'%{termo}%'
-            query = query.filter(
-                db.or_(
-                    Cliente.nome.ilike(termo_busca),
-                    Cliente.cpf_cnpj.ilike(termo_busca)
-                )
-            )
+            # Nome pelo começo; CPF/CNPJ e telefones pelos números digitados (tudo por índice)
+            query = query.filter(db.or_(
+                filtro_prefixo(Cliente.nome_busca, normalizar_busca(termo)),
+                *condicoes_digitos(termo, Cliente.cpf_cnpj_digitos, Cliente.celular_digitos, Cliente.telefone_digitos)
+            ))
         
-        clientes = query.order_by(Cliente.nome).limit(100).all()
+        clientes = query.order_by(Cliente.nome_busca).limit(100).all()
         
         resultados = []
         for c in clientes:
@@ -2654,72 +5429,69 @@ def api_buscar_clientes():
         return jsonify({'error': str(e)}), 500
 
 # ========== ROTAS PARA FORNECEDORES ==========
+# ordenar -> (chave do cursor, descendente)
+ORDENACAO_FORNECEDORES = {
+    'id': (Fornecedor.id, False),
+    'id_desc': (Fornecedor.id, True),
+    'razao_social': (Fornecedor.razao_social_busca, False),
+    'razao_social_desc': (Fornecedor.razao_social_busca, True),
+    'cnpj': (func.coalesce(Fornecedor.cnpj_digitos, ''), False),
+    'cnpj_desc': (func.coalesce(Fornecedor.cnpj_digitos, ''), True),
+    'contato': (func.coalesce(Fornecedor.email, ''), False),
+    'contato_desc': (func.coalesce(Fornecedor.email, ''), True),
+    'localizacao': (func.coalesce(Fornecedor.cidade, ''), False),
+    'localizacao_desc': (func.coalesce(Fornecedor.cidade, ''), True),
+    'status': (Fornecedor.ativo, True),
+    'status_desc': (Fornecedor.ativo, False),
+}
+
 @app.route('/fornecedores')
 def lista_fornecedores():
     busca = request.args.get('q', '')
     status = request.args.get('status', 'ativos')
     ordenar = request.args.get('ordenar', 'razao_social')
+    cursor = request.args.get('cursor', '')
     
-    if status == 'todos':
-        query = Fornecedor.query
-    elif status == 'inativos':
-        query = Fornecedor.query.filter_by(ativo=False)
-    else:
-        query = Fornecedor.query.filter_by(ativo=True)
+    filtros = []
+    if status == 'inativos':
+        filtros.append(Fornecedor.ativo == False)
+    elif status != 'todos':
+        filtros.append(Fornecedor.ativo == True)
     
     if busca:
-        query = query.filter(
-            (Fornecedor.razao_social.contains(busca)) |
-            (Fornecedor.nome_fantasia.contains(busca)) |
-            (Fornecedor.cnpj.contains(busca)) |
-            (Fornecedor.cidade.contains(busca)) |
-            (Fornecedor.responsavel.contains(busca)) |
-            (Fornecedor.email.contains(busca)) |
-            (Fornecedor.telefone.contains(busca)) |
-            (Fornecedor.celular.contains(busca))
-        )
-    
-    if ordenar == 'id':
-        query = query.order_by(Fornecedor.id.asc())
-    elif ordenar == 'id_desc':
-        query = query.order_by(Fornecedor.id.desc())
-    elif ordenar == 'razao_social':
-        query = query.order_by(Fornecedor.razao_social.asc())
-    elif ordenar == 'razao_social_desc':
-        query = query.order_by(Fornecedor.razao_social.desc())
-    elif ordenar == 'cnpj':
-        query = query.order_by(Fornecedor.cnpj.asc())
-    elif ordenar == 'cnpj_desc':
-        query = query.order_by(Fornecedor.cnpj.desc())
-    elif ordenar == 'contato':
-        query = query.order_by(Fornecedor.email.asc(), Fornecedor.telefone.asc())
-    elif ordenar == 'contato_desc':
-        query = query.order_by(Fornecedor.email.desc(), Fornecedor.telefone.desc())
-    elif ordenar == 'localizacao':
-        query = query.order_by(Fornecedor.cidade.asc(), Fornecedor.estado.asc())
-    elif ordenar == 'localizacao_desc':
-        query = query.order_by(Fornecedor.cidade.desc(), Fornecedor.estado.desc())
-    elif ordenar == 'status':
-        query = query.order_by(Fornecedor.ativo.desc())
-    elif ordenar == 'status_desc':
-        query = query.order_by(Fornecedor.ativo.asc())
-    else:
-        query = query.order_by(Fornecedor.razao_social.asc())
-    
-    fornecedores = query.all()
+        filtros.append(db.or_(
+            Fornecedor.razao_social_busca.contains(normalizar_busca(busca)),
+            Fornecedor.nome_fantasia.contains(busca),
+            Fornecedor.cidade.contains(busca),
+            Fornecedor.responsavel.contains(busca),
+            Fornecedor.email.contains(busca),
+            *condicoes_digitos(busca, Fornecedor.cnpj_digitos, Fornecedor.telefone_digitos, Fornecedor.celular_digitos)
+        ))
+    
+    chave, descendente = ORDENACAO_FORNECEDORES.get(ordenar, ORDENACAO_FORNECEDORES['razao_social'])
+    fornecedores, proximo_cursor = paginar_por_cursor(
+        Fornecedor.query.filter(*filtros), chave, Fornecedor.id, descendente, cursor
+    )
     
-    total_fornecedores = Fornecedor.query.count()
-    ativos = Fornecedor.query.filter_by(ativo=True).count()
-    inativos = Fornecedor.query.filter_by(ativo=False).count()
+    # Números dos cards e total da busca numa única passada pela tabela
+    total_fornecedores, ativos, inativos, total_resultados = [valor or 0 for valor in db.session.query(
+        func.count(Fornecedor.id),
+        func.sum(case((Fornecedor.ativo == True, 1), else_=0)),
+        func.sum(case((Fornecedor.ativo == False, 1), else_=0)),
+        func.sum(case((db.and_(*filtros), 1), else_=0)) if filtros else func.count(Fornecedor.id),
+    ).one()]
     
     return render_template('cadastros/fornecedores/lista.html',
                          fornecedores=fornecedores,
                          total_fornecedores=total_fornecedores,
                          ativos=ativos,
                          inativos=inativos,
+                         total_resultados=total_resultados,
                          busca=busca,
                          status=status,
-                         ordenar=ordenar)
+                         ordenar=ordenar,
+                         cursor=cursor,
+                         proximo_cursor=proximo_cursor)
 
 @app.route('/fornecedor/novo', methods=['GET', 'POST'])
 @login_required
@@ -2887,10 +5659,10 @@ def api_buscar_fornecedores():
     if len(termo) < 2:
         return jsonify([])
     
-    fornecedores = Fornecedor.query.filter(
-        (Fornecedor.razao_social.contains(termo)) |
-        (Fornecedor.cnpj.contains(termo))
-    ).filter_by(ativo=True).limit(10).all()
+    fornecedores = Fornecedor.query.filter(db.or_(
+        filtro_prefixo(Fornecedor.razao_social_busca, normalizar_busca(termo)),
+        *condicoes_digitos(termo, Fornecedor.cnpj_digitos)
+    )).filter_by(ativo=True).order_by(Fornecedor.razao_social_busca).limit(10).all()
     
     resultados = []
     for f in fornecedores:
@@ -3252,6 +6024,7 @@ def finalizar_inventario(id):
                     tipo='AJUSTE',
                     grade_id=grade.id,
                     quantidade=abs(diferenca),
+                    sinal=1 if diferenca > 0 else -1,
                     origem='INVENTARIO',
                     documento=f'INV-{inventario.id}',
                     observacao=f'Ajuste de inventário #{inventario.id}: {diferenca:+,} unidades',
@@ -3263,6 +6036,8 @@ def finalizar_inventario(id):
         
         db.session.commit()
         
+        auditoria.registrar('inventario_finalizado', inventario_id=inventario.id, ajustes=ajustes_realizados)
+        
         if ajustes_realizados > 0:
             flash(f'✅ Inventário {id_formatado} finalizado com {ajustes_realizados} ajuste(s) aplicado(s)!', 'success')
         else:
@@ -3668,6 +6443,7 @@ def criar_backup():
         caminho_backup = os.path.join(pasta_backup, nome_arquivo)
         
         shutil.copy2(db_path, caminho_backup)
+        incluir_arquivos_no_backup(caminho_backup)
         
         print(f"✅ Backup criado: {nome_arquivo}")
         
@@ -3741,10 +6517,16 @@ def restaurar_backup():
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
         backup_auto = os.path.join(pasta_backup, f"auto_pre_restauracao_{timestamp}.db")
         shutil.copy2(db_path, backup_auto)
+        incluir_arquivos_no_backup(backup_auto)
         
         db.session.remove()
+        # conexões do pool seguram os arquivos anexados, que vão ser trocados
+        db.engine.dispose()
         
         shutil.copy2(caminho_backup, db_path)
+        restaurar_arquivos_do_backup(db_path)
+        
+        auditoria.registrar('backup_restaurado', arquivo=nome_arquivo, backup_automatico=os.path.basename(backup_auto))
         
         print(f"✅ Backup restaurado: {nome_arquivo}")
         print(f"📦 Backup automático criado: {backup_auto}")
@@ -3791,6 +6573,7 @@ def excluir_backup():
         
         os.remove(caminho)
         
+        auditoria.registrar('backup_excluido', arquivo=nome_arquivo)
         print(f"🗑️ Backup excluído: {nome_arquivo}")
         
         return jsonify({
@@ -4238,42 +7021,20 @@ def testar_impressora(id):
         
         nome_impressora = dados[id-1].get('Name', '')
         
-        # Criar HTML de teste
-        html_teste = f"""
-        <html>
-        <head>
-            <title>Teste de Impressão - Havaianas</title>
-            <style>
-                body {{ font-family: Arial; padding: 20px; }}
-                h1 {{ color: #0066cc; }}
-                .box {{ border: 2px solid #0066cc; padding: 20px; margin: 20px 0; }}
-            </style>
-        </head>
-        <body>
-            <h1>🩴 SISTEMA HAVAIANAS - TESTE DE IMPRESSÃO</h1>
-            <div class="box">
-                <p><strong>Impressora:</strong> {nome_impressora}</p>
-                <p><strong>Data:</strong> {datetime.now().strftime('%d/%m/%Y %H:%M:%S')}</p>
-                <p><strong>Status:</strong> ✅ Funcionando corretamente!</p>
-            </div>
-            <p>Este é um teste de impressão do sistema Havaianas.</p>
-            <p>Se você está vendo esta página, a impressora está configurada corretamente.</p>
-        </body>
-        </html>
-        """
-        
-        # Salvar arquivo temporário
-        arquivo_html = "teste_impressao.html"
-        with open(arquivo_html, 'w', encoding='utf-8') as f:
-            f.write(html_teste)
-        
-        # Abrir no navegador para impressão manual
-        import webbrowser
-        webbrowser.open(arquivo_html)
+        # Página de teste vai para a fila da impressora (não trava a requisição)
+        empresa = Empresa.query.first()
+        trabalho = criar_trabalho_impressao(
+            impressora=impressora_comprovante(nome=nome_impressora),
+            papel=(empresa.impressao_papel if empresa else None) or '80mm',
+            tipo='teste'
+        )
+        db.session.commit()
+        spooler.despachar(trabalho)
         
         return jsonify({
             'success': True,
-            'message': f'✅ Página de teste aberta no navegador para {nome_impressora}!'
+            'message': f'✅ Página de teste enviada para {nome_impressora}!',
+            'trabalho_id': trabalho.id
         })
         
     except Exception as e:
@@ -4306,86 +7067,440 @@ def resetar_configuracoes_impressao():
             'success': False,
             'error': str(e)
         }), 500
-#===========================================================
-# ========== ROTA PARA IMPRESSÃO DIRETA ==========
-@app.route('/imprimir-direto', methods=['POST'])
-@login_required
-def imprimir_direto():
-    """Rota para imprimir comprovante sem servidor externo"""
-    try:
-        dados = request.json
-        html = dados.get('html', '')
-        impressora = dados.get('impressora', 'Microsoft Print to PDF')
-        
-        print(f"\n📥 Impressão direta solicitada às {time.strftime('%H:%M:%S')}")
-        
-        # Criar pasta temporária se não existir
-        pasta_temp = os.path.join(os.path.dirname(__file__), 'temp_prints')
-        os.makedirs(pasta_temp, exist_ok=True)
-        
-        # Gerar nome único para o arquivo
-        nome_arquivo = f"comprovante_{int(time.time())}.html"
-        caminho_completo = os.path.join(pasta_temp, nome_arquivo)
-        
-        # Adicionar CSS e script de impressão automática
-        html_completo = f"""<!DOCTYPE html>
-<html>
-<head>
-    <meta charset="UTF-8">
-    <title>Comprovante de Venda</title>
-    <style>
-        body {{ font-family: 'Courier New', monospace; width: 80mm; margin: 0 auto; padding: 5px; }}
-        @media print {{
-            body {{ width: 80mm; }}
-        }}
-    </style>
-</head>
-<body>
-    {html}
-    <script>
-        window.onload = function() {{
-            setTimeout(function() {{
-                window.print();
-                setTimeout(function() {{
-                    window.close();
-                }}, 1000);
-            }}, 500);
-        }};
-    </script>
-</body>
-</html>"""
+# ========== IMPRESSÃO TÉRMICA ESC/POS ==========
+# Comandos ESC/POS usados no comprovante
+ESC_INICIAR = b'\x1b@'
+ESC_PAGINA_CODIGO = b'\x1bt\x03'        # PC860 (português)
+ESC_ALINHAR = {'esquerda': b'\x1ba\x00', 'centro': b'\x1ba\x01', 'direita': b'\x1ba\x02'}
+ESC_NEGRITO = (b'\x1bE\x00', b'\x1bE\x01')
+ESC_TAMANHO_NORMAL = b'\x1d!\x00'
+ESC_TAMANHO_DUPLO = b'\x1d!\x11'
+ESC_ALTURA_DUPLA = b'\x1d!\x01'
+ESC_CORTAR = b'\x1dVB\x03'              # avança 3 linhas e corta parcial
+
+# Colunas por largura de papel (fonte A)
+COLUNAS_PAPEL = {'58mm': 32, '80mm': 48}
+PORTA_ESCPOS_PADRAO = 9100
+
+class ReciboEscPos:
+    """Acumula texto e comandos ESC/POS de um comprovante"""
+    
+    def __init__(self, papel='80mm'):
+        self.colunas = COLUNAS_PAPEL.get(papel, 48)
+        self.partes = [ESC_INICIAR, ESC_PAGINA_CODIGO]
+    
+    def comando(self, bytes_comando):
+        self.partes.append(bytes_comando)
+    
+    def linha(self, texto=''):
+        self.partes.append(texto.encode('cp860', errors='replace') + b'\n')
+    
+    def texto_quebrado(self, texto, colunas=None):
+        colunas = colunas or self.colunas
+        texto = ' '.join(str(texto).split())
+        while len(texto) > colunas:
+            corte = texto.rfind(' ', 0, colunas + 1)
+            if corte <= 0:
+                corte = colunas
+            self.linha(texto[:corte])
+            texto = texto[corte:].lstrip()
+        self.linha(texto)
+    
+    def colunas_ab(self, esquerda, direita):
+        """Texto à esquerda e valor alinhado à direita na mesma linha"""
+        espacos = self.colunas - len(esquerda) - len(direita)
+        if espacos < 1:
+            self.linha(esquerda)
+            self.linha(direita.rjust(self.colunas))
+        else:
+            self.linha(esquerda + ' ' * espacos + direita)
+    
+    def separador(self, caractere='-'):
+        self.linha(caractere * self.colunas)
+    
+    def bytes(self):
+        return b''.join(self.partes)
+
+def renderizar_escpos(comprovante, papel='80mm'):
+    """Converte o comprovante congelado da venda em bytes ESC/POS (58mm ou 80mm)"""
+    recibo = ReciboEscPos(papel)
+    empresa = comprovante.get('empresa') or {}
+    
+    recibo.comando(ESC_ALINHAR['centro'])
+    recibo.comando(ESC_NEGRITO[1] + ESC_TAMANHO_DUPLO)
+    recibo.texto_quebrado(empresa.get('nome_fantasia') or 'Havaianas', recibo.colunas // 2)
+    recibo.comando(ESC_TAMANHO_NORMAL + ESC_NEGRITO[0])
+    for campo in ('razao_social', 'cnpj_formatado', 'endereco', 'contato', 'cabecalho'):
+        if empresa.get(campo):
+            recibo.texto_quebrado(empresa[campo])
+    
+    recibo.comando(ESC_ALINHAR['esquerda'])
+    recibo.separador()
+    recibo.comando(ESC_NEGRITO[1])
+    recibo.linha(f"COMPROVANTE #{comprovante['venda_id_formatado']}")
+    recibo.comando(ESC_NEGRITO[0])
+    data_venda = datetime.fromisoformat(comprovante['data_criacao'])
+    recibo.linha(f"Data: {data_venda.strftime('%d/%m/%Y %H:%M')}")
+    recibo.texto_quebrado(f"Vendedor: {comprovante.get('vendedor') or 'Sistema'}")
+    recibo.texto_quebrado(f"Cliente: {comprovante.get('cliente_nome') or 'CONSUMIDOR'}")
+    if comprovante.get('cliente_cpf'):
+        documento = comprovante['cliente_cpf']
+        documento = format_cnpj(documento) if len(re.sub(r'\D', '', documento)) == 14 else format_cpf(documento)
+        recibo.linha(f"CPF/CNPJ: {documento}")
+    recibo.separador()
+    
+    for item in comprovante['itens']:
+        descricao = f"{item['descricao']} T{item['tamanho']}" if item.get('tamanho') else item['descricao']
+        recibo.texto_quebrado(descricao)
+        recibo.colunas_ab(f"  {item['quantidade']} x R$ {item['preco']:.2f}", f"R$ {item['subtotal']:.2f}")
+    recibo.separador()
+    
+    recibo.colunas_ab('Subtotal:', f"R$ {comprovante['subtotal']:.2f}")
+    if comprovante.get('desconto_valor'):
+        recibo.colunas_ab(f"Desconto ({comprovante['desconto_percentual']:.1f}%):",
+                          f"- R$ {comprovante['desconto_valor']:.2f}")
+    recibo.comando(ESC_NEGRITO[1] + ESC_ALTURA_DUPLA)
+    recibo.colunas_ab('TOTAL:', f"R$ {comprovante['total']:.2f}")
+    recibo.comando(ESC_TAMANHO_NORMAL + ESC_NEGRITO[0])
+    recibo.linha(f"Pagamento: {comprovante.get('forma_pagamento') or ''}")
+    recibo.separador()
+    
+    recibo.comando(ESC_ALINHAR['centro'])
+    mensagem = (comprovante.get('config_impressao') or {}).get('mensagem') or empresa.get('rodape')
+    if mensagem:
+        recibo.texto_quebrado(mensagem)
+    recibo.linha('** COMPROVANTE NÃO FISCAL **')
+    recibo.comando(ESC_CORTAR)
+    return recibo.bytes()
+
+def destino_impressora(impressora):
+    """Resolve para onde mandar os bytes de uma impressora cadastrada.
+    
+    - porta TCP/IP: endereco é 'host' ou 'host:porta' (padrão 9100)
+    - porta SPOOL: endereco é uma pasta; cada trabalho vira um arquivo .bin
+    - endereco com caminho de dispositivo (/dev/usb/lp0, COM1, LPT1, \\\\servidor\\fila)
+    - caso contrário, fila RAW do Windows com o nome da impressora
+    """
+    porta = (impressora.porta or '').strip().upper()
+    endereco = (impressora.endereco or '').strip()
+    
+    if porta in ('TCP/IP', 'TCP', 'REDE'):
+        host, _, numero = endereco.partition(':')
+        return 'tcp', (host, int(numero or PORTA_ESCPOS_PADRAO))
+    if porta == 'SPOOL':
+        return 'spool', endereco or os.path.join(app.instance_path, 'spool')
+    if endereco.startswith(('/', '\\\\')) or re.match(r'^(COM|LPT)\d+$', endereco.upper()):
+        return 'dispositivo', endereco
+    if re.match(r'^(COM|LPT)\d+$', porta):
+        return 'dispositivo', porta
+    return 'windows', impressora.nome
+
+def enviar_escpos(dados, impressora):
+    """Entrega os bytes ESC/POS à impressora (TCP 9100, dispositivo, pasta de spool ou fila do Windows)"""
+    tipo, alvo = destino_impressora(impressora)
+    
+    if tipo == 'tcp':
+        import socket
+        with socket.create_connection(alvo, timeout=5) as conexao:
+            conexao.sendall(dados)
+    elif tipo == 'spool':
+        os.makedirs(alvo, exist_ok=True)
+        nome = f"{datetime.now().strftime('%Y%m%d%H%M%S%f')}_{random.randint(0, 99999):05d}.bin"
+        temporario = os.path.join(alvo, nome + '.tmp')
+        with open(temporario, 'wb') as f:
+            f.write(dados)
+        os.replace(temporario, os.path.join(alvo, nome))  # leitores da pasta nunca veem arquivo pela metade
+    elif tipo == 'dispositivo':
+        caminho = alvo if not re.match(r'^(COM|LPT)\d+$', alvo.upper()) else f'\\\\.\\{alvo}'
+        with open(caminho, 'wb') as f:
+            f.write(dados)
+    else:
+        handle = win32print.OpenPrinter(alvo)
+        try:
+            win32print.StartDocPrinter(handle, 1, ('Comprovante', None, 'RAW'))
+            try:
+                win32print.StartPagePrinter(handle)
+                win32print.WritePrinter(handle, dados)
+                win32print.EndPagePrinter(handle)
+            finally:
+                win32print.EndDocPrinter(handle)
+        finally:
+            win32print.ClosePrinter(handle)
+    
+    return tipo, alvo
+
+def impressora_comprovante(impressora_id=None, nome=None):
+    """Impressora para o comprovante: a cadastrada pedida (por id ou nome) ou a
+    padrão ativa. Sem cadastro, usa a fila do Windows com o nome informado ou o
+    configurado na empresa."""
+    if impressora_id:
+        impressora = db.session.get(Impressora, int(impressora_id))
+        if impressora:
+            return impressora
+    
+    if nome:
+        impressora = Impressora.query.filter_by(nome=nome, ativo=True).first()
+        return impressora or Impressora(nome=nome, porta='USB')
+    
+    impressora = Impressora.query.filter_by(padrao=True, ativo=True).first()
+    if impressora:
+        return impressora
+    
+    empresa = Empresa.query.first()
+    nome = (empresa.impressora_padrao_nome if empresa else None) or 'Microsoft Print to PDF'
+    return Impressora(nome=nome, porta='USB')
+
+# ========== FILA DE IMPRESSÃO (SPOOLER) ==========
+SPOOLER_TENTATIVAS = 6
+SPOOLER_ESPERA_BASE = 2.0
+SPOOLER_ESPERA_MAXIMA = 60.0
+
+def renderizar_teste_escpos(nome_impressora, papel='80mm'):
+    """Página de teste em ESC/POS"""
+    recibo = ReciboEscPos(papel)
+    recibo.comando(ESC_ALINHAR['centro'] + ESC_NEGRITO[1])
+    recibo.texto_quebrado('SISTEMA HAVAIANAS')
+    recibo.texto_quebrado('TESTE DE IMPRESSÃO')
+    recibo.comando(ESC_NEGRITO[0])
+    recibo.separador()
+    recibo.texto_quebrado(f"Impressora: {nome_impressora}")
+    recibo.linha(f"Data: {datetime.now().strftime('%d/%m/%Y %H:%M:%S')}")
+    recibo.linha(f"Papel: {papel} ({recibo.colunas} colunas)")
+    recibo.separador()
+    recibo.texto_quebrado('Se você está lendo isto, a impressora está configurada corretamente.')
+    recibo.comando(ESC_CORTAR)
+    return recibo.bytes()
+
+def criar_trabalho_impressao(venda=None, impressora=None, vias=None, papel=None, tipo='comprovante'):
+    """Cria o trabalho na sessão atual; o commit é de quem chama.
+    
+    Depois do commit, entregue o trabalho ao spooler com spooler.despachar().
+    """
+    config_impressao = config_impressao_atual()
+    impressora = impressora or impressora_comprovante()
+    trabalho = TrabalhoImpressao(
+        tipo=tipo,
+        venda_id=venda.id if venda is not None else None,
+        impressora_id=impressora.id,
+        impressora_nome=impressora.nome,
+        papel=papel or config_impressao.get('papel') or '80mm',
+        vias=max(1, int(vias or config_impressao.get('vias') or 1)),
+        vias_impressas=0,
+        status='pendente',
+        tentativas=0
+    )
+    db.session.add(trabalho)
+    db.session.flush()
+    return trabalho
+
+class SpoolerImpressao:
+    """Imprime os trabalhos da tabela trabalho_impressao em segundo plano.
+    
+    Cada impressora tem sua própria fila e thread: uma impressora lenta ou
+    desligada só atrasa os próprios trabalhos, e os bytes de dois
+    comprovantes nunca se misturam no mesmo dispositivo. Falhas são
+    repetidas com espera exponencial; as vias já impressas não se repetem.
+    """
+    
+    def __init__(self):
+        self.filas = {}
+        self.lock = threading.Lock()
+        self.retomado = False
+    
+    def chave(self, trabalho):
+        return f"id:{trabalho.impressora_id}" if trabalho.impressora_id else f"nome:{trabalho.impressora_nome}"
+    
+    def despachar(self, trabalho):
+        chave = self.chave(trabalho)
+        with self.lock:
+            fila = self.filas.get(chave)
+            if fila is None:
+                fila = self.filas[chave] = queue.Queue()
+                threading.Thread(
+                    target=self._trabalhar, args=(fila,), name=f"spooler-{chave}", daemon=True
+                ).start()
+        fila.put(trabalho.id)
+    
+    def retomar(self):
+        """Reenfileira trabalhos que ficaram pendentes (ex.: servidor reiniciado)"""
+        with self.lock:
+            if self.retomado:
+                return
+            self.retomado = True
+        
+        trabalhos = TrabalhoImpressao.query.filter(
+            TrabalhoImpressao.status.in_(['pendente', 'imprimindo'])
+        ).order_by(TrabalhoImpressao.id).all()
+        
+        for trabalho in trabalhos:
+            if trabalho.status == 'imprimindo':
+                trabalho.status = 'pendente'
+        db.session.commit()
         
-        # Salvar arquivo
-        with open(caminho_completo, 'w', encoding='utf-8') as f:
-            f.write(html_completo)
+        for trabalho in trabalhos:
+            self.despachar(trabalho)
+        if trabalhos:
+            print(f"🖨️ Spooler: {len(trabalhos)} trabalho(s) pendente(s) retomado(s)")
+    
+    def _trabalhar(self, fila):
+        while True:
+            trabalho_id = fila.get()
+            with app.app_context():
+                try:
+                    self._imprimir(trabalho_id)
+                except Exception as e:
+                    print(f"❌ Spooler: erro inesperado no trabalho #{trabalho_id}: {e}")
+                finally:
+                    db.session.remove()
+    
+    def _imprimir(self, trabalho_id):
+        # Só um worker pega o trabalho, mesmo com mais de um processo servindo
+        pego = db.session.execute(
+            update(TrabalhoImpressao)
+            .where(TrabalhoImpressao.id == trabalho_id, TrabalhoImpressao.status == 'pendente')
+            .values(status='imprimindo')
+        ).rowcount
+        db.session.commit()
+        if not pego:
+            return
         
-        print(f"📄 Arquivo salvo: {caminho_completo}")
+        trabalho = db.session.get(TrabalhoImpressao, trabalho_id)
         
-        # Abrir no navegador padrão
-        import webbrowser
-        webbrowser.open(f'file://{caminho_completo}')
+        try:
+            if trabalho.tipo == 'teste':
+                dados = renderizar_teste_escpos(trabalho.impressora_nome, trabalho.papel)
+            else:
+                comprovante_json = carregar_comprovante(trabalho.venda_id)
+                if comprovante_json is None:
+                    raise ValueError(f'Venda #{trabalho.venda_id} não encontrada')
+                dados = renderizar_escpos(comprovante_para_impressao(comprovante_json), trabalho.papel)
+            impressora = impressora_comprovante(trabalho.impressora_id, None if trabalho.impressora_id else trabalho.impressora_nome)
+        except Exception as e:
+            trabalho.status = 'erro'
+            trabalho.erro = str(e)
+            db.session.commit()
+            print(f"❌ Spooler: trabalho #{trabalho_id} descartado: {e}")
+            return
         
-        # Agendar limpeza do arquivo após 10 segundos
-        def limpar_arquivo():
-            time.sleep(10)
+        while trabalho.vias_impressas < trabalho.vias:
             try:
-                os.unlink(caminho_completo)
-                print(f"🗑️ Arquivo temporário removido: {nome_arquivo}")
-            except:
-                pass
+                enviar_escpos(dados, impressora)
+                trabalho.vias_impressas += 1
+                trabalho.erro = None
+                db.session.commit()
+            except Exception as e:
+                trabalho.tentativas += 1
+                trabalho.erro = str(e)
+                if trabalho.tentativas >= SPOOLER_TENTATIVAS:
+                    trabalho.status = 'erro'
+                    db.session.commit()
+                    print(f"❌ Spooler: trabalho #{trabalho_id} falhou {trabalho.tentativas}x em {trabalho.impressora_nome}: {e}")
+                    return
+                db.session.commit()
+                espera = min(SPOOLER_ESPERA_MAXIMA, SPOOLER_ESPERA_BASE * (2 ** (trabalho.tentativas - 1)))
+                print(f"⚠️ Spooler: {trabalho.impressora_nome} falhou ({e}), nova tentativa em {espera:.0f}s")
+                time.sleep(espera * random.uniform(0.8, 1.2))
         
-        import threading
-        threading.Thread(target=limpar_arquivo, daemon=True).start()
+        trabalho.status = 'concluido'
+        trabalho.data_conclusao = hora_brasil()
+        db.session.commit()
+        print(f"🖨️ Spooler: trabalho #{trabalho_id} impresso em {trabalho.impressora_nome} ({trabalho.vias} via(s))")
+
+spooler = SpoolerImpressao()
+
+def trabalho_para_json(trabalho):
+    return {
+        'id': trabalho.id,
+        'tipo': trabalho.tipo,
+        'venda_id': trabalho.venda_id,
+        'impressora_id': trabalho.impressora_id,
+        'impressora_nome': trabalho.impressora_nome,
+        'papel': trabalho.papel,
+        'vias': trabalho.vias,
+        'vias_impressas': trabalho.vias_impressas,
+        'status': trabalho.status,
+        'tentativas': trabalho.tentativas,
+        'erro': trabalho.erro,
+        'data_criacao': trabalho.data_criacao.isoformat() if trabalho.data_criacao else None,
+        'data_conclusao': trabalho.data_conclusao.isoformat() if trabalho.data_conclusao else None
+    }
+
+@app.route('/api/impressao/trabalhos', methods=['POST'])
+@login_required
+def enfileirar_impressao():
+    """Coloca o comprovante de uma venda na fila de impressão"""
+    try:
+        dados = request.json or {}
+        venda = db.session.get(Venda, int(dados.get('venda_id') or 0))
+        if not venda:
+            return jsonify({'success': False, 'error': 'Venda não encontrada'}), 404
         
-        return jsonify({
-            'success': True,
-            'message': 'Comprovante enviado para impressão'
-        })
+        impressora = impressora_comprovante(dados.get('impressora_id'), dados.get('impressora'))
+        trabalho = criar_trabalho_impressao(venda, impressora, dados.get('vias'), dados.get('papel'))
+        db.session.commit()
+        spooler.despachar(trabalho)
+        
+        return jsonify({'success': True, 'trabalho': trabalho_para_json(trabalho)}), 202
         
     except Exception as e:
-        print(f"❌ Erro na impressão direta: {e}")
+        db.session.rollback()
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/api/impressao/trabalhos', methods=['GET'])
+@login_required
+def listar_trabalhos_impressao():
+    """Últimos trabalhos da fila, com filtro opcional por status ou venda"""
+    query = TrabalhoImpressao.query
+    if request.args.get('status'):
+        query = query.filter(TrabalhoImpressao.status == request.args['status'])
+    if request.args.get('venda_id', type=int):
+        query = query.filter(TrabalhoImpressao.venda_id == request.args.get('venda_id', type=int))
+    
+    limite = min(request.args.get('limite', 50, type=int), 200)
+    trabalhos = query.order_by(TrabalhoImpressao.id.desc()).limit(limite).all()
+    return jsonify({'success': True, 'trabalhos': [trabalho_para_json(t) for t in trabalhos]})
+
+@app.route('/api/impressao/trabalhos/<int:trabalho_id>', methods=['GET'])
+@login_required
+def status_trabalho_impressao(trabalho_id):
+    trabalho = db.session.get(TrabalhoImpressao, trabalho_id)
+    if not trabalho:
+        return jsonify({'success': False, 'error': 'Trabalho não encontrado'}), 404
+    return jsonify({'success': True, 'trabalho': trabalho_para_json(trabalho)})
+
+@app.route('/api/impressao/trabalhos/<int:trabalho_id>/reenviar', methods=['POST'])
+@login_required
+def reenviar_trabalho_impressao(trabalho_id):
+    """Devolve à fila um trabalho que esgotou as tentativas (imprime só as vias que faltaram)"""
+    trabalho = db.session.get(TrabalhoImpressao, trabalho_id)
+    if not trabalho:
+        return jsonify({'success': False, 'error': 'Trabalho não encontrado'}), 404
+    if trabalho.status != 'erro':
+        return jsonify({'success': False, 'error': f'Trabalho está {trabalho.status}'}), 409
+    
+    trabalho.status = 'pendente'
+    trabalho.tentativas = 0
+    db.session.commit()
+    spooler.despachar(trabalho)
+    return jsonify({'success': True, 'trabalho': trabalho_para_json(trabalho)}), 202
+
+#===========================================================
+# ========== ROTA PARA IMPRESSÃO DIRETA ==========
+@app.route('/imprimir-direto', methods=['POST'])
+@login_required
+def imprimir_direto():
+    """Imprime o comprovante de uma venda na impressora térmica (ESC/POS).
+    
+    A impressão acontece em segundo plano pelo spooler; acompanhe o trabalho
+    em /api/impressao/trabalhos/<id>.
+    """
+    dados = request.json or {}
+    if not dados.get('venda_id'):
+        return jsonify({'success': False, 'error': 'Informe a venda a imprimir'}), 400
+    
+    print(f"\n📥 Impressão direta da venda #{dados['venda_id']} solicitada às {time.strftime('%H:%M:%S')}")
+    return enfileirar_impressao()
+
 #============================================================
 @app.route('/api/config/logo', methods=['POST'])
 @login_required
@@ -4897,6 +8012,94 @@ def uploaded_file(filename):
 def uploaded_logo(filename):
     return send_from_directory(os.path.join(app.config['UPLOAD_FOLDER'], 'logo'), filename)
 
+# ========== MIGRAÇÕES LEVES DO BANCO ==========
+# db.create_all() só cria tabelas novas; colunas novas em tabelas antigas entram aqui
+COLUNAS_MIGRACAO = [
+    ('grade', 'versao', 'INTEGER NOT NULL DEFAULT 0'),
+    ('grade', 'ean', 'VARCHAR(14)'),
+    ('venda', 'comprovante_json', 'TEXT'),
+    ('produto', 'descricao_busca', 'VARCHAR(200)'),
+    ('grade', 'cor_busca', 'VARCHAR(50)'),
+    ('cliente', 'nome_busca', 'VARCHAR(200)'),
+    ('fornecedor', 'razao_social_busca', 'VARCHAR(200)'),
+    ('cliente', 'cpf_cnpj_digitos', 'VARCHAR(20)'),
+    ('cliente', 'telefone_digitos', 'VARCHAR(20)'),
+    ('cliente', 'celular_digitos', 'VARCHAR(20)'),
+    ('fornecedor', 'cnpj_digitos', 'VARCHAR(20)'),
+    ('fornecedor', 'telefone_digitos', 'VARCHAR(20)'),
+    ('fornecedor', 'celular_digitos', 'VARCHAR(20)'),
+    ('grade', 'alteracao', 'INTEGER NOT NULL DEFAULT 0'),
+    ('produto', 'alteracao', 'INTEGER NOT NULL DEFAULT 0'),
+    ('movimentacao', 'sinal', 'INTEGER'),
+    ('importacao_estoque', 'codificacao', 'VARCHAR(20)'),
+    ('importacao_estoque', 'hash_arquivo', 'VARCHAR(64)'),
+    ('chave_idempotencia', 'hash_corpo', 'VARCHAR(64)'),
+]
+
+# Preenchimento das colunas novas nas linhas antigas, uma vez, quando a coluna é criada
+# (também nos arquivos de movimentações, que têm a mesma tabela)
+PREENCHIMENTO_MIGRACAO = {
+    ('movimentacao', 'sinal'): (
+        "UPDATE {banco}movimentacao SET sinal = CASE WHEN observacao LIKE '%: -%' THEN -1 ELSE 1 END "
+        "WHERE tipo = 'AJUSTE'"
+    ),
+}
+
+def migrar_arquivos_movimentacoes():
+    """Colunas novas de `movimentacao` também nos instance/archive_AAAA.db já existentes"""
+    with db.engine.connect() as conexao:
+        for ano in anos_arquivados():
+            banco = f'arquivo_{ano}'
+            anexar_arquivos(conexao, [ano])
+            existentes = {linha[1] for linha in conexao.exec_driver_sql(f'PRAGMA {banco}.table_info(movimentacao)')}
+            for tabela, coluna, ddl in COLUNAS_MIGRACAO:
+                if tabela != 'movimentacao' or coluna in existentes:
+                    continue
+                conexao.exec_driver_sql(f'ALTER TABLE {banco}.movimentacao ADD COLUMN {coluna} {ddl}')
+                if (tabela, coluna) in PREENCHIMENTO_MIGRACAO:
+                    conexao.exec_driver_sql(PREENCHIMENTO_MIGRACAO[(tabela, coluna)].format(banco=f'{banco}.'))
+                print(f"🔧 Coluna adicionada: archive_{ano}.db movimentacao.{coluna}")
+            conexao.commit()
+
+def migrar_banco():
+    """Adiciona em bancos de versões anteriores as colunas e índices que faltam"""
+    from sqlalchemy import inspect
+    inspector = inspect(db.engine)
+    with db.engine.begin() as conn:
+        for tabela, coluna, ddl in COLUNAS_MIGRACAO:
+            existentes = {c['name'] for c in inspector.get_columns(tabela)}
+            if coluna not in existentes:
+                conn.execute(text(f'ALTER TABLE {tabela} ADD COLUMN {coluna} {ddl}'))
+                if (tabela, coluna) in PREENCHIMENTO_MIGRACAO:
+                    conn.execute(text(PREENCHIMENTO_MIGRACAO[(tabela, coluna)].format(banco='')))
+                print(f"🔧 Coluna adicionada: {tabela}.{coluna}")
+        
+        for tabela in db.metadata.sorted_tables:
+            for indice in tabela.indexes:
+                indice.create(bind=conn, checkfirst=True)
+        
+        conn.execute(text('INSERT OR IGNORE INTO contador_catalogo (id, valor) VALUES (1, 0)'))
+    
+    migrar_arquivos_movimentacoes()
+    criar_busca_textual()
+    preencher_colunas_busca()
+
+def processo_atende_requisicoes():
+    """True só no processo que serve o app: fora do vigia do reloader e dos comandos `flask <comando>`.
+    
+    Decide onde rodam os trabalhos em segundo plano; dois processos retomando a mesma
+    importação somariam o estoque duas vezes, e o vigia do reloader não deve imprimir.
+    """
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        return True  # filho do reloader
+    if __name__ == '__main__':
+        return False  # `python app.py` roda com debug=True: quem serve é o filho do reloader
+    contexto = click.get_current_context(silent=True)
+    if contexto is not None:
+        # `flask run` com reloader também tem um processo vigia
+        return contexto.info_name == 'run' and not (contexto.params.get('reload') or get_debug_flag())
+    return True
+
 # =====================
 # INICIALIZAÇÃO DO SISTEMA 
 # =====================
@@ -4916,6 +8119,14 @@ with app.app_context():
     print(f"📊 Banco existia? {banco_existia}")
     
     db.create_all()
+    migrar_banco()
+    indice_pdv.construir()
+    
+    # Trabalhos em segundo plano que o servidor reiniciado deixou pela metade
+    if processo_atende_requisicoes():
+        importador_estoque.retomar()
+        spooler.retomar()
+        fechamento_diario.iniciar()
     
     is_main_process = os.environ.get('WERKZEUG_RUN_MAIN') != 'true'
     
@@ -5023,47 +8234,45 @@ with app.app_context():
 def comprovante_html(venda_id):
     """Retorna HTML do comprovante para impressão"""
     try:
-        venda = Venda.query.get_or_404(venda_id)
-        empresa = Empresa.query.first()
-        config = ConfigComprovante.query.first()
+        comprovante_json = carregar_comprovante(venda_id)
+        if comprovante_json is None:
+            return f"Venda #{venda_id} não encontrada", 404
         
-        # Buscar itens da venda
-        itens = []
-        for item in venda.itens:
-            grade = Grade.query.get(item.grade_id)
-            if grade:
-                produto = Produto.query.get(grade.produto_id)
-                descricao = f"{produto.descricao} {grade.cor} T{grade.tamanho}"
-            else:
-                descricao = f"Item #{item.id}"
-            
-            itens.append({
-                'descricao': descricao,
-                'quantidade': item.quantidade,
-                'preco': item.preco_unitario,
-                'subtotal': item.quantidade * item.preco_unitario
-            })
+        etag = 'html-' + etag_comprovante(comprovante_json)
+        if request.if_none_match.contains(etag):
+            return '', 304, {'ETag': f'"{etag}"'}
+        
+        venda = json.loads(comprovante_json)
+        empresa = venda['empresa']
+        data_venda = datetime.fromisoformat(venda['data_criacao'])
+        
+        itens = [{
+            'descricao': f"{item['descricao']} T{item['tamanho']}" if item['tamanho'] else item['descricao'],
+            'quantidade': item['quantidade'],
+            'preco': item['preco'],
+            'subtotal': item['subtotal']
+        } for item in venda['itens']]
         
         # Calcular totais
         subtotal = sum(i['subtotal'] for i in itens)
-        desconto = venda.desconto or 0
-        total = venda.total or (subtotal - desconto)
+        desconto = venda['desconto_valor'] or 0
+        total = venda['total'] or (subtotal - desconto)
         
         # Formatar CPF
         cpf_formatado = ''
-        if venda.cliente_cpf:
-            cpf = venda.cliente_cpf.replace('.', '').replace('-', '')
+        if venda['cliente_cpf']:
+            cpf = venda['cliente_cpf'].replace('.', '').replace('-', '')
             if len(cpf) == 11:
                 cpf_formatado = f"{cpf[:3]}.{cpf[3:6]}.{cpf[6:9]}-{cpf[9:]}"
             else:
-                cpf_formatado = venda.cliente_cpf
+                cpf_formatado = venda['cliente_cpf']
         
         # Gerar HTML
         html = f"""<!DOCTYPE html>
 <html>
 <head>
     <meta charset="UTF-8">
-    <title>Comprovante #{venda.id:03d}</title>
+    <title>Comprovante #{venda['venda_id_formatado']}</title>
     <style>
         body {{ 
             font-family: 'Courier New', monospace; 
@@ -5095,18 +8304,18 @@ def comprovante_html(venda_id):
 </head>
 <body>
     <div class="header">
-        <h3>{empresa.nome_fantasia or 'Havaianas Store'}</h3>
-        <p>{empresa.cnpj or '00.000.000/0000-00'}</p>
-        <p>{empresa.endereco or ''} {empresa.numero or ''}</p>
+        <h3>{empresa['nome_fantasia'] or 'Havaianas Store'}</h3>
+        <p>{empresa.get('cnpj') or empresa['cnpj_formatado'].removeprefix('CNPJ: ') or '00.000.000/0000-00'}</p>
+        <p>{empresa['endereco']}</p>
     </div>
     
     <hr>
     
     <div class="info">
-        <p><strong>COMPROVANTE #{venda.id:03d}</strong></p>
-        <p>Data: {venda.data.strftime('%d/%m/%Y %H:%M')}</p>
-        <p>Vendedor: {venda.vendedor or 'Sistema'}</p>
-        <p>Cliente: {venda.cliente or 'CONSUMIDOR'}</p>
+        <p><strong>COMPROVANTE #{venda['venda_id_formatado']}</strong></p>
+        <p>Data: {data_venda.strftime('%d/%m/%Y %H:%M')}</p>
+        <p>Vendedor: {venda['vendedor'] or 'Sistema'}</p>
+        <p>Cliente: {venda['cliente_nome'] or 'CONSUMIDOR'}</p>
         {f'<p>CPF: {cpf_formatado}</p>' if cpf_formatado else ''}
     </div>
     
@@ -5143,11 +8352,11 @@ def comprovante_html(venda_id):
     <hr>
     
     <div class="info">
-        <p>Forma de pagamento: {venda.forma_pagamento}</p>
+        <p>Forma de pagamento: {venda['forma_pagamento']}</p>
     </div>
     
     <div class="footer">
-        <p>{config.rodape if config else 'Obrigado pela preferência!'}</p>
+        <p>{empresa['rodape']}</p>
     </div>
     
     <div style="text-align: center; margin-top: 20px;">
@@ -5166,7 +8375,9 @@ def comprovante_html(venda_id):
 </body>
 </html>"""
         
-        return html
+        resposta = app.make_response(html)
+        resposta.set_etag(etag)
+        return resposta
         
     except Exception as e:
         print(f"❌ Erro ao gerar comprovante: {e}")
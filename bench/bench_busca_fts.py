@@ -0,0 +1,116 @@
+"""Busca textual: índice FTS5 contra os LIKE '%termo%' de antes, com 100 mil grades.
+
+Roda numa cópia isolada do projeto (ver tests/ambiente.py):
+
+    python bench/bench_busca_fts.py [--grades 100000] [--repeticoes 20]
+"""
+import argparse
+import contextlib
+import io
+import itertools
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tests'))
+from ambiente import carregar_app  # noqa: E402
+
+CORES = ['Preto', 'Branco', 'Azul Marinho', 'Rosa Flúor', 'Café', 'Verde Água', 'Vermelho', 'Cinza']
+TAMANHOS = ['33/34', '35/36', '37/38', '39/40', '41/42', '43/44']
+MODELOS = ['Slim', 'Top', 'Eco', 'Flash', 'Sprint', 'Tradiçao', 'Classic', 'Brasil']
+ESTAMPAS = ['Logo', 'Floral', 'Color', 'Estampa', 'Básica']
+GRADES_POR_PRODUTO = 10
+
+TERMOS_ESTOQUE = ['Tradiçao', 'P0123', 'marinho 39', 'Floral 777']
+TERMOS_PRODUTOS = ['P012', 'Classic']
+
+
+def popular(m, total_grades):
+    sorteio = random.Random(42)
+    produtos = total_grades // GRADES_POR_PRODUTO
+    with m.app.app_context():
+        descricoes = [f'Havaianas {sorteio.choice(MODELOS)} {sorteio.choice(ESTAMPAS)} {i}' for i in range(produtos)]
+        m.db.session.execute(m.insert(m.Produto), [{
+            'sku': f'P{i:05d}', 'descricao': descricao, 'descricao_busca': m.normalizar_busca(descricao),
+            'modelo': sorteio.choice(MODELOS), 'colecao': 'Verão 2026', 'preco_venda': 39.9, 'custo': 15, 'ativo': True
+        } for i, descricao in enumerate(descricoes)])
+        linhas = m.db.session.execute(
+            m.db.select(m.Produto.id, m.Produto.sku).where(m.Produto.sku.like('P%'))
+        ).all()
+        combinacoes = list(itertools.product(CORES, TAMANHOS))
+        m.db.session.execute(m.insert(m.Grade), [{
+            'produto_id': produto_id, 'cor': cor, 'cor_busca': m.normalizar_busca(cor), 'tamanho': tamanho,
+            'sku_grade': f'{sku}-{cor}-{tamanho}', 'estoque_atual': 5, 'versao': 0, 'alteracao': 0
+        } for produto_id, sku in linhas for cor, tamanho in sorteio.sample(combinacoes, GRADES_POR_PRODUTO)])
+        m.db.session.commit()
+
+
+def medir(repeticoes, funcao):
+    funcao()
+    inicio = time.perf_counter()
+    for _ in range(repeticoes):
+        funcao()
+    return (time.perf_counter() - inicio) / repeticoes * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--grades', type=int, default=100000)
+    parser.add_argument('--repeticoes', type=int, default=20)
+    args = parser.parse_args()
+    
+    with contextlib.redirect_stdout(io.StringIO()):
+        m = carregar_app()
+        popular(m, args.grades)
+    if not m.BUSCA_FTS_ATIVA:
+        sys.exit('SQLite sem FTS5: não há o que comparar')
+    
+    def like_estoque(termo):
+        campos = [m.Produto.descricao, m.Produto.sku, m.Grade.cor, m.Grade.tamanho]
+        return lambda: (m.db.session.query(m.Grade.id).join(m.Produto)
+                        .filter(m.db.or_(*(campo.contains(termo) for campo in campos))).all())
+    
+    def fts_estoque(termo):
+        campos = [m.Produto.descricao, m.Produto.sku, m.Grade.cor, m.Grade.tamanho]
+        return lambda: m.filtrar_busca(m.db.session.query(m.Grade.id).join(m.Produto),
+                                       m.busca_grade_fts, m.Grade.id, termo, campos).all()
+    
+    def like_produtos(termo):
+        # as três consultas que /api/buscar-produtos fazia antes do índice
+        return lambda: (
+            m.Produto.query.filter(m.Produto.sku.ilike(f'%{termo}%'), m.Produto.ativo == True).limit(10).all(),
+            m.Produto.query.filter(m.Produto.descricao.ilike(f'%{termo}%'), m.Produto.ativo == True).limit(10).all(),
+            m.Grade.query.join(m.Produto).filter(m.Grade.sku_grade.ilike(f'%{termo}%')).limit(10).all(),
+        )
+    
+    def fts_produtos(termo):
+        return lambda: m.ranking_produtos(termo)
+    
+    print(f"{'consulta':<36} {'LIKE ms':>9} {'FTS ms':>9}")
+    with m.app.app_context():
+        for termo in TERMOS_ESTOQUE:
+            print(f"{'estoque ' + repr(termo):<36} {medir(args.repeticoes, like_estoque(termo)):>9.2f} "
+                  f"{medir(args.repeticoes, fts_estoque(termo)):>9.2f}")
+        for termo in TERMOS_PRODUTOS:
+            print(f"{'buscar-produtos ' + repr(termo):<36} {medir(args.repeticoes, like_produtos(termo)):>9.2f} "
+                  f"{medir(args.repeticoes, fts_produtos(termo)):>9.2f}")
+    
+    cliente = m.app.test_client()
+    with cliente.session_transaction() as sessao:
+        sessao['usuario_id'] = 1
+        sessao['usuario_admin'] = True
+        sessao['usuario_nome'] = 'admin'
+    print()
+    print(f"{'rota (FTS)':<36} {'ms':>9}")
+    with contextlib.redirect_stdout(io.StringIO()):
+        tempos = [(f'GET /api/buscar-produtos/{termo}', medir(args.repeticoes, lambda: cliente.get(f'/api/buscar-produtos/{termo}')))
+                  for termo in TERMOS_PRODUTOS]
+        tempos += [(f'GET {rota}?q=P0123', medir(5, lambda: cliente.get(f'{rota}?q=P0123')))
+                   for rota in ('/estoque', '/produtos')]
+    for nome, ms in tempos:
+        print(f'{nome:<36} {ms:>9.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""Latência do checkout (/api/pdv/venda) em função do tamanho do carrinho.
+
+Roda numa cópia isolada do projeto (ver tests/ambiente.py), pelo test client do Flask:
+
+    python bench/bench_checkout.py [--vendas 30]
+"""
+import argparse
+import contextlib
+import io
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tests'))
+from ambiente import carregar_app, criar_grades  # noqa: E402
+
+TAMANHOS_CARRINHO = (1, 5, 15, 30, 50)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--vendas', type=int, default=30, help='vendas medidas por tamanho de carrinho')
+    args = parser.parse_args()
+    
+    with contextlib.redirect_stdout(io.StringIO()):
+        m = carregar_app()
+        grades = criar_grades(m, 1, tamanhos=[str(i) for i in range(max(TAMANHOS_CARRINHO))],
+                              estoque=10 ** 6, prefixo='BENCH')
+    cliente = m.app.test_client()
+    
+    def vender(linhas):
+        resposta = cliente.post('/api/pdv/venda', json={
+            'itens': [{'grade_id': grade_id, 'quantidade': 1, 'preco': 39.9} for grade_id in grades[:linhas]],
+            'forma_pagamento': 'PIX'
+        })
+        assert resposta.status_code == 200, resposta.get_json()
+    
+    print(f"{'itens':>6} {'mediana ms':>11} {'p95 ms':>8}")
+    for linhas in TAMANHOS_CARRINHO:
+        tempos = []
+        with contextlib.redirect_stdout(io.StringIO()):
+            vender(linhas)  # aquece caches e o pool de conexões
+            for _ in range(args.vendas):
+                inicio = time.perf_counter()
+                vender(linhas)
+                tempos.append((time.perf_counter() - inicio) * 1000)
+        tempos.sort()
+        print(f"{linhas:>6} {statistics.median(tempos):>11.2f} {tempos[int(len(tempos) * 0.95) - 1]:>8.2f}")
+
+
+if __name__ == '__main__':
+    main()
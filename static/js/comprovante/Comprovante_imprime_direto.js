@@ -3,7 +3,8 @@
 // Agora usando rota do próprio Flask (sem servidor externo)
 
 // ===== FUNÇÃO DE IMPRESSÃO DIRETA VIA FLASK =====
-async function imprimirDireto(html, impressoraNome) {
+// O servidor monta o comprovante em ESC/POS a partir da venda gravada
+async function imprimirDireto(vendaId, impressoraNome) {
     try {
         console.log('📤 Enviando para impressão via Flask...');
         
@@ -13,7 +14,7 @@ async function imprimirDireto(html, impressoraNome) {
                 'Content-Type': 'application/json',
             },
             body: JSON.stringify({
-                html: html,
+                venda_id: vendaId,
                 impressora: impressoraNome
             })
         });
@@ -277,7 +278,7 @@ ${pagamentoHTML}
         }
         
         // Enviar para a rota do Flask
-        imprimirDireto(html, dados.impressora_nome);
+        imprimirDireto(dados.venda_id, dados.impressora_nome);
         
     } else {
         // 🔥 MODO DIÁLOGO - Comportamento normal com janela
@@ -0,0 +1,59 @@
+"""Carrega o app.py numa cópia isolada do projeto, com banco novo numa pasta temporária.
+
+O app.py cria/migra instance/database.db ao ser importado, então testes e benchmarks
+nunca importam o arquivo da raiz: copiam app.py, templates e static para `destino`
+e importam de lá.
+"""
+import importlib
+import os
+import shutil
+import sys
+import tempfile
+import types
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def carregar_app(destino=None):
+    destino = destino or tempfile.mkdtemp(prefix='havaianas_')
+    shutil.copy2(os.path.join(RAIZ, 'app.py'), destino)
+    for pasta in ('templates', 'static'):
+        shutil.copytree(os.path.join(RAIZ, pasta), os.path.join(destino, pasta), dirs_exist_ok=True)
+    
+    try:
+        import win32print  # noqa: F401
+    except ImportError:
+        # Fora do Windows: só o que o app usa ao importar e ao listar impressoras
+        falso = types.ModuleType('win32print')
+        falso.PRINTER_ENUM_LOCAL = 2
+        falso.PRINTER_ENUM_CONNECTIONS = 4
+        falso.EnumPrinters = lambda *args: []
+        sys.modules['win32print'] = falso
+    
+    sys.path.insert(0, destino)
+    sys.modules.pop('app', None)
+    modulo = importlib.import_module('app')
+    # a rotina diária (fechamento + arquivo) não deve disparar no meio das medições
+    modulo.fechamento_diario.dia = modulo.hora_brasil().date()
+    return modulo
+
+
+def criar_grades(modulo, produtos, cores=('Preto',), tamanhos=('37/38',), estoque=10, prefixo='T'):
+    """Cadastra `produtos` produtos com uma grade por cor x tamanho; devolve os ids das grades"""
+    m = modulo
+    with m.app.app_context():
+        m.db.session.execute(m.insert(m.Produto), [{
+            'sku': f'{prefixo}{i:06d}', 'descricao': f'Havaianas Teste {i}', 'modelo': 'Slim',
+            'colecao': 'Teste', 'preco_venda': 39.9, 'ativo': True
+        } for i in range(produtos)])
+        linhas = m.db.session.execute(
+            m.db.select(m.Produto.id, m.Produto.sku).where(m.Produto.sku.like(f'{prefixo}%'))
+        ).all()
+        m.db.session.execute(m.insert(m.Grade), [{
+            'produto_id': produto_id, 'cor': cor, 'cor_busca': m.normalizar_busca(cor), 'tamanho': tamanho,
+            'sku_grade': f'{sku}-{cor}-{tamanho}', 'estoque_atual': estoque, 'versao': 0, 'alteracao': 0
+        } for produto_id, sku in linhas for cor in cores for tamanho in tamanhos])
+        m.db.session.commit()
+        return m.db.session.execute(
+            m.db.select(m.Grade.id).join(m.Produto).where(m.Produto.sku.like(f'{prefixo}%')).order_by(m.Grade.id)
+        ).scalars().all()
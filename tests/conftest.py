@@ -0,0 +1,19 @@
+import pytest
+
+from ambiente import carregar_app
+
+
+@pytest.fixture(scope='session')
+def m(tmp_path_factory):
+    """Módulo app carregado numa cópia isolada (um banco para a sessão de testes inteira)"""
+    return carregar_app(str(tmp_path_factory.mktemp('projeto')))
+
+
+@pytest.fixture
+def cliente(m):
+    cliente = m.app.test_client()
+    with cliente.session_transaction() as sessao:
+        sessao['usuario_id'] = 1
+        sessao['usuario_admin'] = True
+        sessao['usuario_nome'] = 'admin'
+    return cliente
@@ -0,0 +1,55 @@
+"""Relatórios sobre os arquivos anuais de movimentações (instance/archive_AAAA.db)"""
+from datetime import datetime
+
+import pytest
+
+from ambiente import carregar_app, criar_grades
+
+ANOS = range(2013, 2024)  # 11 anos: mais que ARQUIVO_MAX_ANEXOS
+
+
+@pytest.fixture(scope='module')
+def arquivado(tmp_path_factory):
+    """App próprio (os arquivos ficam na instance dele) com um ano arquivado por ano de ANOS"""
+    m = carregar_app(str(tmp_path_factory.mktemp('arquivo')))
+    grade_id, = criar_grades(m, 1, prefixo='ARQ')
+    with m.app.app_context():
+        linhas = [{'tipo': 'ENTRADA', 'grade_id': grade_id, 'quantidade': 1, 'data': datetime(ano, 6, 1),
+                   'origem': 'TESTE', 'documento': f'A-{ano}'} for ano in ANOS]
+        # o último ano enche sozinho a página do relatório
+        linhas += [{'tipo': 'SAIDA', 'grade_id': grade_id, 'quantidade': 1, 'data': datetime(ANOS[-1], 7, 1),
+                    'origem': 'TESTE', 'documento': f'B-{i}'} for i in range(250)]
+        m.db.session.execute(m.insert(m.Movimentacao), linhas)
+        # a mais nova fica na tabela quente
+        m.db.session.add(m.Movimentacao(tipo='ENTRADA', grade_id=grade_id, quantidade=1, origem='TESTE'))
+        m.db.session.commit()
+        m.arquivar_movimentacoes(30)
+        assert m.anos_arquivados() == list(ANOS)
+    return m
+
+
+def test_periodo_com_anos_demais_falha_em_vez_de_cortar(arquivado):
+    m = arquivado
+    with m.app.app_context():
+        with pytest.raises(ValueError, match='11 anos arquivados'):
+            m.movimentacoes_do_periodo()
+        mov = m.movimentacoes_do_periodo(datetime(2020, 1, 1))
+        documentos = {d for (d,) in m.db.session.query(mov.documento).filter(mov.documento.like('A-%'))}
+        assert documentos == {'A-2020', 'A-2021', 'A-2022', 'A-2023'}
+
+
+def test_relatorio_sem_data_inicial_anexa_so_o_que_precisa(arquivado, monkeypatch):
+    m = arquivado
+    anexados = []
+    anexar = m.anexar_arquivos
+    monkeypatch.setattr(m, 'anexar_arquivos', lambda conexao, anos: (anexados.extend(anos), anexar(conexao, anos)))
+
+    cliente = m.app.test_client()
+    resposta = cliente.get('/movimentacoes')
+    assert resposta.status_code == 200
+    assert anexados == [ANOS[-1]]
+
+    resposta = cliente.get('/movimentacoes?data_fim=2016-12-31')
+    assert resposta.status_code == 200
+    assert b'A-2016' in resposta.data and b'A-2013' in resposta.data
+    assert b'A-2017' not in resposta.data
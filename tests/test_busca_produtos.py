@@ -0,0 +1,44 @@
+import pytest
+
+
+@pytest.fixture(scope='module')
+def catalogo(m):
+    """Produto ativo com grades no padrão do recebimento (cor em caixa mista) e um inativo"""
+    with m.app.app_context():
+        ativo = m.Produto(sku='HAV01', descricao='Havaianas Top', ativo=True)
+        inativo = m.Produto(sku='HAV02', descricao='Havaianas Slim', ativo=False)
+        m.db.session.add_all([ativo, inativo])
+        m.db.session.flush()
+        m.db.session.add_all([
+            m.Grade(produto_id=ativo.id, cor='Preto', tamanho='37/38', sku_grade='HAV01-Preto-37/38'),
+            m.Grade(produto_id=ativo.id, cor='Preto', tamanho='39/40', sku_grade='HAV01-Preto-39/40'),
+            m.Grade(produto_id=inativo.id, cor='Azul', tamanho='37/38', sku_grade='XHAV02-Azul-37/38'),
+        ])
+        m.db.session.commit()
+
+
+@pytest.mark.parametrize('termo', ['HAV01-Preto', 'hav01-preto', 'HAV01-PRETO-3'])
+def test_sku_da_grade_sem_diferenca_de_maiusculas(cliente, catalogo, termo):
+    resultado = cliente.get(f'/api/buscar-produtos/{termo}').get_json()
+    assert [item['codigo'] for item in resultado] == ['HAV01']
+    assert resultado[0]['cor'] == 'Preto'
+
+
+def test_grade_exata_vem_na_frente(m, catalogo):
+    with m.app.app_context():
+        (produto, grade), = m.ranking_produtos('hav01-preto-39/40')
+        assert (produto.sku, grade.sku_grade) == ('HAV01', 'HAV01-Preto-39/40')
+        (produto, grade), = m.ranking_produtos('HAV01-PRETO')
+        assert grade.sku_grade == 'HAV01-Preto-37/38'
+
+
+def test_produto_inativo_nao_entra_pela_grade(cliente, catalogo):
+    assert cliente.get('/api/buscar-produtos/XHAV02').get_json() == []
+
+
+def test_faixas_de_sku_usam_os_indices_nocase(m, catalogo):
+    with m.app.app_context():
+        consulta = m.db.select(m.Grade.id).where(m.filtro_prefixo(m.Grade.sku_grade.collate('NOCASE'), 'hav'))
+        sql = str(consulta.compile(m.db.engine, compile_kwargs={'literal_binds': True}))
+        plano = ' '.join(linha[-1] for linha in m.db.session.execute(m.text(f'EXPLAIN QUERY PLAN {sql}')))
+    assert 'ix_grade_sku_grade_nocase' in plano
@@ -0,0 +1,55 @@
+import itertools
+import json
+
+import pytest
+
+from ambiente import criar_grades
+
+PREFIXOS = itertools.count()
+
+
+@pytest.fixture
+def venda_id(m, cliente):
+    grade_id, = criar_grades(m, 1, prefixo=f'COMPR{next(PREFIXOS):03d}-')
+    return cliente.post('/api/pdv/venda', json={
+        'itens': [{'grade_id': grade_id, 'quantidade': 2, 'preco': 39.9}], 'forma_pagamento': 'PIX'
+    }).get_json()['venda_id']
+
+
+@pytest.fixture
+def empresa(m):
+    with m.app.app_context():
+        empresa = m.Empresa.query.first()
+        if not empresa:
+            empresa = m.Empresa(razao_social='Havaianas Store Ltda', nome_fantasia='Havaianas')
+            m.db.session.add(empresa)
+        empresa.cnpj = '12345678000195'
+        empresa.impressao_papel = '80mm'
+        config = m.ConfigComprovante.query.first() or m.ConfigComprovante()
+        config.mostrar_cnpj = False
+        m.db.session.add(config)
+        m.db.session.commit()
+
+
+def test_papel_vem_da_configuracao_vigente(m, cliente, empresa, venda_id):
+    with m.app.app_context():
+        m.Empresa.query.first().impressao_papel = '58mm'
+        m.db.session.commit()
+    comprovante = cliente.get(f'/api/pdv/venda/{venda_id}/comprovante').get_json()['comprovante']
+    assert comprovante['config_impressao']['papel'] == '58mm'
+    with m.app.app_context():
+        assert 'config_impressao' not in json.loads(m.db.session.get(m.Venda, venda_id).comprovante_json)
+
+
+def test_venda_antiga_e_montada_sem_gravar(m, cliente, empresa, venda_id):
+    with m.app.app_context():
+        m.db.session.get(m.Venda, venda_id).comprovante_json = None
+        m.db.session.commit()
+    resposta = cliente.get(f'/api/pdv/venda/{venda_id}/comprovante')
+    assert resposta.get_json()['comprovante']['itens'][0]['quantidade'] == 2
+    with m.app.app_context():
+        assert m.db.session.get(m.Venda, venda_id).comprovante_json is None
+
+
+def test_html_sempre_mostra_o_cnpj(cliente, empresa, venda_id):
+    assert b'12.345.678/0001-95' in cliente.get(f'/comprovante-html/{venda_id}').data
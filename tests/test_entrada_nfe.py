@@ -0,0 +1,88 @@
+import io
+import itertools
+import re
+
+import pytest
+
+from ambiente import criar_grades
+
+PREFIXOS = itertools.count()
+
+
+def xml_nfe(numero, cnpj, itens, chave=None):
+    dets = ''.join(
+        f'<det nItem="{i}"><prod><cProd>{codigo}</cProd><cEAN>SEM GTIN</cEAN><xProd>Chinelo</xProd>'
+        f'<qCom>{quantidade}.0000</qCom></prod></det>'
+        for i, (codigo, quantidade) in enumerate(itens, 1)
+    )
+    id_nfe = f' Id="NFe{chave}"' if chave else ''
+    return (
+        '<nfeProc xmlns="http://www.portalfiscal.inf.br/nfe"><NFe><infNFe versao="4.00"' + id_nfe + '>'
+        f'<ide><serie>1</serie><nNF>{numero}</nNF></ide>'
+        f'<emit><CNPJ>{cnpj}</CNPJ><xNome>Fornecedor {cnpj[:2]}</xNome></emit>'
+        f'{dets}</infNFe></NFe></nfeProc>'
+    ).encode()
+
+
+@pytest.fixture
+def grades(m):
+    ids = criar_grades(m, 1, tamanhos=('37/38', '39/40'), estoque=0, prefixo=f'NFE{next(PREFIXOS):03d}-')
+    with m.app.app_context():
+        return {g.sku_grade: g.id for g in m.db.session.query(m.Grade).filter(m.Grade.id.in_(ids))}
+
+
+def estoque(m, grade_id):
+    with m.app.app_context():
+        return m.db.session.get(m.Grade, grade_id).estoque_atual
+
+
+def previa(cliente, xml):
+    resposta = cliente.post('/estoque/entrada/nfe', data={'arquivo': (io.BytesIO(xml), 'nota.xml')},
+                            content_type='multipart/form-data')
+    assert resposta.status_code == 200
+    return int(re.search(rb'name="nota_id" value="(\d+)"', resposta.data).group(1)), resposta.data
+
+
+def test_confirmacao_lanca_o_xml_e_nao_o_formulario(m, cliente, grades):
+    sku, outro = sorted(grades)
+    nota_id, _ = previa(cliente, xml_nfe('1001', '11111111000191', [(sku, 5)]))
+
+    # o navegador não manda mais as linhas; campos extras são ignorados
+    cliente.post('/estoque/entrada/nfe/confirmar', data={
+        'nota_id': nota_id, 'fornecedor': 'Fornecedor 11',
+        'itens': f'[{{"codigo": "{outro}", "grade_id": {grades[outro]}, "quantidade": 999}}]',
+    })
+    assert estoque(m, grades[sku]) == 5
+    assert estoque(m, grades[outro]) == 0
+
+
+def test_segunda_confirmacao_nao_soma_de_novo(m, cliente, grades):
+    sku = min(grades)
+    nota_id, _ = previa(cliente, xml_nfe('1002', '11111111000191', [(sku, 3)]))
+    for _ in range(2):
+        cliente.post('/estoque/entrada/nfe/confirmar', data={'nota_id': nota_id, 'fornecedor': 'F'})
+    assert estoque(m, grades[sku]) == 3
+
+    # reenviar o XML mostra a nota como lançada e a mesma prévia não lança de novo
+    nota_id_de_novo, pagina = previa(cliente, xml_nfe('1002', '11111111000191', [(sku, 3)]))
+    assert nota_id_de_novo == nota_id
+    assert 'já foi lançada'.encode() in pagina
+    cliente.post('/estoque/entrada/nfe/confirmar', data={'nota_id': nota_id, 'fornecedor': 'F'})
+    assert estoque(m, grades[sku]) == 3
+
+
+def test_mesmo_numero_de_fornecedores_diferentes(m, cliente, grades):
+    sku = min(grades)
+    for cnpj in ('22222222000191', '33333333000191'):
+        nota_id, pagina = previa(cliente, xml_nfe('1003', cnpj, [(sku, 2)]))
+        assert 'já foi lançada'.encode() not in pagina
+        cliente.post('/estoque/entrada/nfe/confirmar', data={'nota_id': nota_id, 'fornecedor': 'F'})
+    assert estoque(m, grades[sku]) == 4
+
+
+def test_chave_de_acesso_identifica_a_nota(m):
+    chave = '35260111111111000191550010000010041000010040'
+    cabecalho, _ = m.ler_nfe(io.BytesIO(xml_nfe('1004', '11111111000191', [('X', 1)], chave=chave)))
+    assert m.chave_nfe(cabecalho) == chave
+    cabecalho, _ = m.ler_nfe(io.BytesIO(xml_nfe('1004', '11111111000191', [('X', 1)])))
+    assert m.chave_nfe(cabecalho) == '11111111000191-1-1004'
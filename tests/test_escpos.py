@@ -0,0 +1,114 @@
+import os
+import socket
+import threading
+
+import pytest
+
+COMPROVANTE = {
+    'venda_id_formatado': '042',
+    'data_criacao': '2026-01-15T14:30:00',
+    'vendedor': 'Maria',
+    'cliente_nome': 'João da Silva',
+    'cliente_cpf': '12345678909',
+    'itens': [
+        {'descricao': 'Havaianas Top Tradição Estampada Edição Limitada Verão', 'tamanho': '37/38',
+         'quantidade': 2, 'preco': 39.9, 'subtotal': 79.8},
+        {'descricao': 'Havaianas Slim', 'tamanho': '35/36', 'quantidade': 1, 'preco': 49.9, 'subtotal': 49.9},
+    ],
+    'subtotal': 129.7,
+    'desconto_percentual': 10.0,
+    'desconto_valor': 12.97,
+    'total': 116.73,
+    'forma_pagamento': 'PIX',
+    'empresa': {'nome_fantasia': 'Havaianas', 'razao_social': 'Havaianas Store Ltda',
+                'cnpj_formatado': 'CNPJ: 12.345.678/0001-95', 'rodape': 'Obrigado pela preferência!'},
+    'config_impressao': {},
+}
+
+
+def linhas_de_texto(dados, m):
+    """Linhas impressas, sem os comandos ESC/GS que vêm no começo delas"""
+    comandos = sorted({m.ESC_INICIAR, m.ESC_PAGINA_CODIGO, *m.ESC_ALINHAR.values(), *m.ESC_NEGRITO,
+                       m.ESC_TAMANHO_NORMAL, m.ESC_TAMANHO_DUPLO, m.ESC_ALTURA_DUPLA, m.ESC_CORTAR},
+                      key=len, reverse=True)
+    linhas = []
+    for linha in dados.split(b'\n'):
+        for comando in comandos:
+            linha = linha.replace(comando, b'')
+        linhas.append(linha.decode('cp860'))
+    return linhas
+
+
+@pytest.mark.parametrize('papel, colunas', [('58mm', 32), ('80mm', 48)])
+def test_comprovante_respeita_a_largura_do_papel(m, papel, colunas):
+    dados = m.renderizar_escpos(COMPROVANTE, papel)
+    linhas = linhas_de_texto(dados, m)
+
+    assert dados.startswith(m.ESC_INICIAR + m.ESC_PAGINA_CODIGO)
+    assert dados.endswith(m.ESC_CORTAR)
+    # o nome fantasia sai em tamanho duplo, na metade das colunas
+    assert all(len(linha) <= colunas for linha in linhas if linha != 'Havaianas')
+    assert '-' * colunas in linhas
+    assert f"{'TOTAL:':<{colunas - len('R$ 116.73')}}R$ 116.73" in linhas
+    assert 'Desconto (10.0%):'.ljust(colunas - len('- R$ 12.97')) + '- R$ 12.97' in linhas
+    assert 'CPF/CNPJ: 123.456.789-09' in linhas
+    assert 'COMPROVANTE NÃO FISCAL'.encode('cp860') in dados
+    assert 'Obrigado pela preferência!'.encode('cp860') in dados
+
+    # descrição longa quebra em palavras inteiras e nada se perde
+    descricao = f"{COMPROVANTE['itens'][0]['descricao']} T37/38"
+    inicio = next(i for i, linha in enumerate(linhas) if linha.startswith('Havaianas Top'))
+    quebradas = []
+    while ' '.join(quebradas) != descricao:
+        quebradas.append(linhas[inicio + len(quebradas)])
+    assert len(quebradas) > 1
+
+
+def test_papel_desconhecido_usa_80mm(m):
+    assert m.renderizar_escpos(COMPROVANTE, 'A4') == m.renderizar_escpos(COMPROVANTE, '80mm')
+
+
+def test_envio_para_pasta_de_spool(m, tmp_path):
+    dados = m.renderizar_escpos(COMPROVANTE, '58mm')
+    pasta = tmp_path / 'spool'
+    impressora = m.Impressora(nome='Térmica balcão', porta='SPOOL', endereco=str(pasta))
+
+    assert m.enviar_escpos(dados, impressora) == ('spool', str(pasta))
+    assert m.enviar_escpos(dados, impressora) == ('spool', str(pasta))
+
+    arquivos = sorted(os.listdir(pasta))
+    assert len(arquivos) == 2 and all(nome.endswith('.bin') for nome in arquivos)
+    for nome in arquivos:
+        assert (pasta / nome).read_bytes() == dados
+
+
+def test_envio_por_tcp(m):
+    recebido = []
+    servidor = socket.create_server(('127.0.0.1', 0))
+    servidor.settimeout(5)
+    porta = servidor.getsockname()[1]
+
+    def aceitar():
+        conexao, _ = servidor.accept()
+        with conexao:
+            partes = []
+            while parte := conexao.recv(4096):
+                partes.append(parte)
+            recebido.append(b''.join(partes))
+
+    ouvinte = threading.Thread(target=aceitar)
+    ouvinte.start()
+    try:
+        dados = m.renderizar_escpos(COMPROVANTE, '80mm')
+        impressora = m.Impressora(nome='Térmica rede', porta='TCP/IP', endereco=f'127.0.0.1:{porta}')
+        assert m.enviar_escpos(dados, impressora) == ('tcp', ('127.0.0.1', porta))
+        ouvinte.join(5)
+    finally:
+        servidor.close()
+
+    assert recebido == [dados]
+
+
+def test_endereco_tcp_sem_porta_usa_9100(m):
+    impressora = m.Impressora(nome='Térmica rede', porta='TCP/IP', endereco='192.168.0.50')
+    assert m.destino_impressora(impressora) == ('tcp', ('192.168.0.50', m.PORTA_ESCPOS_PADRAO))
@@ -0,0 +1,24 @@
+from ambiente import criar_grades
+
+
+def test_excluir_venda_devolve_estoque_e_registra_estorno(m, cliente):
+    grade_id, = criar_grades(m, 1, estoque=10, prefixo='ESTORNO')
+    venda = cliente.post('/api/pdv/venda', json={
+        'itens': [{'grade_id': grade_id, 'quantidade': 3, 'preco': 39.9}], 'forma_pagamento': 'PIX'
+    }).get_json()
+    venda_id = venda['venda_id']
+    with m.app.app_context():
+        antes_do_estorno = m.hora_brasil()
+
+    assert cliente.delete(f'/api/pdv/venda/{venda_id}').status_code == 200
+
+    with m.app.app_context():
+        m.db.session.expire_all()
+        assert m.db.session.get(m.Grade, grade_id).estoque_atual == 10
+        assert m.db.session.get(m.Venda, venda_id) is None
+        # a saída continua no histórico e o estorno entra com o mesmo documento
+        movimentos = m.db.session.query(m.Movimentacao.tipo, m.Movimentacao.origem, m.Movimentacao.quantidade)\
+            .filter(m.Movimentacao.documento == f'V-{venda_id}').order_by(m.Movimentacao.id).all()
+        assert movimentos == [('SAIDA', 'VENDA', 3), ('ENTRADA', 'ESTORNO', 3)]
+        assert m.estoque_na_data(antes_do_estorno, [grade_id])[0] == {grade_id: 7}
+        assert m.estoque_na_data(m.hora_brasil(), [grade_id])[0] == {grade_id: 10}
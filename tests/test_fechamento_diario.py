@@ -0,0 +1,27 @@
+def fechamentos(m):
+    with m.app.app_context():
+        return m.FechamentoEstoque.query.count()
+
+
+def test_comando_fechar_estoque_roda_a_rotina(m):
+    antes = fechamentos(m)
+    resultado = m.app.test_cli_runner().invoke(args=['fechar-estoque'])
+    assert resultado.exit_code == 0, resultado.output
+    assert 'Fechamento diário concluído' in resultado.output
+    assert fechamentos(m) == antes + 1
+
+
+def test_verificacao_roda_uma_vez_por_dia(m, monkeypatch):
+    monkeypatch.setattr(m.fechamento_diario, 'dia', None)
+    m.fechamento_diario.verificar()
+    depois_da_primeira = fechamentos(m)
+    assert m.fechamento_diario.dia == m.hora_brasil().date()
+
+    # já houve fechamento hoje: a rotina não grava outro nem com o dia esquecido
+    monkeypatch.setattr(m.fechamento_diario, 'dia', None)
+    m.fechamento_diario.verificar()
+    assert fechamentos(m) == depois_da_primeira
+
+
+def test_sem_gancho_antes_das_requisicoes(m):
+    assert not m.app.before_request_funcs.get(None)
@@ -0,0 +1,27 @@
+from ambiente import criar_grades
+
+
+def test_carregar_mais_percorre_o_historico_filtrado(m, cliente):
+    grade_id, = criar_grades(m, 1, estoque=50, prefixo='HIST')
+    vendidas = {}
+    for i in range(7):
+        forma = 'PIX' if i % 2 else 'DINHEIRO'
+        venda_id = cliente.post('/api/pdv/venda', json={
+            'itens': [{'grade_id': grade_id, 'quantidade': 1, 'preco': 10}], 'forma_pagamento': forma
+        }).get_json()['venda_id']
+        vendidas[venda_id] = forma
+    with m.app.app_context():
+        hoje = m.hora_brasil().date().isoformat()
+
+    url = f'/api/pdv/vendas?de={hoje}&ate={hoje}&forma_pagamento=PIX&limite=2'
+    vistas, paginas = [], 0
+    while url:
+        resposta = cliente.get(url)
+        vistas += [venda['id'] for venda in resposta.get_json()]
+        paginas += 1
+        cursor = resposta.headers.get('X-Proximo-Cursor')
+        url = f'/api/pdv/vendas?de={hoje}&ate={hoje}&forma_pagamento=PIX&limite=2&cursor={cursor}' if cursor else None
+
+    pix = sorted((v for v, forma in vendidas.items() if forma == 'PIX'), reverse=True)
+    assert [v for v in vistas if v in vendidas] == pix
+    assert paginas >= 2
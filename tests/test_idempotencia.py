@@ -0,0 +1,48 @@
+import itertools
+from datetime import timedelta
+
+import pytest
+
+from ambiente import criar_grades
+
+PREFIXOS = itertools.count()
+
+
+@pytest.fixture
+def grade_id(m):
+    return criar_grades(m, 1, estoque=20, prefixo=f'IDEM{next(PREFIXOS):03d}-')[0]
+
+
+def vender(cliente, grade_id, chave, quantidade=1):
+    return cliente.post('/api/pdv/venda', headers={'Idempotency-Key': chave}, json={
+        'itens': [{'grade_id': grade_id, 'quantidade': quantidade, 'preco': 10}], 'forma_pagamento': 'PIX'
+    })
+
+
+def test_reenvio_com_outro_corpo_e_recusado(cliente, grade_id):
+    primeira = vender(cliente, grade_id, f'chave-{grade_id}')
+    reenvio = vender(cliente, grade_id, f'chave-{grade_id}')
+    assert reenvio.headers.get('Idempotent-Replay') == 'true'
+    assert reenvio.get_json() == primeira.get_json()
+
+    outra = vender(cliente, grade_id, f'chave-{grade_id}', quantidade=2)
+    assert outra.status_code == 422
+
+
+def test_cancelar_venda_apaga_a_chave(m, cliente, grade_id):
+    venda_id = vender(cliente, grade_id, f'cancelada-{grade_id}').get_json()['venda_id']
+    assert cliente.delete(f'/api/pdv/venda/{venda_id}').status_code == 200
+    with m.app.app_context():
+        assert m.db.session.get(m.ChaveIdempotencia, f'cancelada-{grade_id}') is None
+
+
+def test_chaves_vencidas_sao_apagadas(m, cliente, grade_id):
+    vender(cliente, grade_id, f'velha-{grade_id}')
+    vender(cliente, grade_id, f'nova-{grade_id}')
+    with m.app.app_context():
+        velha = m.db.session.get(m.ChaveIdempotencia, f'velha-{grade_id}')
+        velha.data_criacao -= m.RETENCAO_IDEMPOTENCIA + timedelta(minutes=1)
+        m.db.session.commit()
+        assert m.limpar_chaves_idempotencia() >= 1
+        assert m.db.session.get(m.ChaveIdempotencia, f'velha-{grade_id}') is None
+        assert m.db.session.get(m.ChaveIdempotencia, f'nova-{grade_id}') is not None
@@ -0,0 +1,64 @@
+import io
+import itertools
+import time
+
+import pytest
+from openpyxl import Workbook
+
+from ambiente import criar_grades
+
+PREFIXOS = itertools.count()
+
+
+@pytest.fixture
+def sku(m):
+    prefixo = f'IMPORT{next(PREFIXOS):03d}-'
+    criar_grades(m, 1, estoque=0, prefixo=prefixo)
+    return f'{prefixo}000000-Preto-37/38'
+
+
+def enviar(cliente, conteudo, nome):
+    return cliente.post('/api/estoque/importacao', data={'arquivo': (io.BytesIO(conteudo), nome)},
+                        content_type='multipart/form-data')
+
+
+def esperar(cliente, importacao_id):
+    for _ in range(200):
+        importacao = cliente.get(f'/api/estoque/importacao/{importacao_id}').get_json()['importacao']
+        if importacao['status'] in ('concluido', 'erro'):
+            return importacao
+        time.sleep(0.05)
+    raise AssertionError('importação não terminou')
+
+
+def test_csv_cp1252_com_linha_ruim_sai_no_progresso(cliente, sku):
+    conteudo = f'SKU;Quantidade;Observação\n{sku};5;ok\n{sku};abc;não\nNAOEXISTE;1;x\n'.encode('cp1252')
+    resposta = enviar(cliente, conteudo, 'entrada.csv')
+    assert resposta.status_code == 202
+    assert resposta.get_json()['importacao']['total_linhas'] == 3
+
+    importacao = esperar(cliente, resposta.get_json()['importacao']['id'])
+    assert importacao['status'] == 'concluido'
+    assert (importacao['linhas_aplicadas'], importacao['linhas_rejeitadas']) == (1, 2)
+    assert [erro['linha'] for erro in importacao['erros']] == [3, 4]
+    assert importacao['percentual'] == 100.0
+
+
+def test_xlsx_estima_pelas_dimensoes(cliente, sku):
+    livro = Workbook()
+    livro.active.append(['SKU', 'Quantidade'])
+    for _ in range(4):
+        livro.active.append([sku, 1])
+    conteudo = io.BytesIO()
+    livro.save(conteudo)
+
+    resposta = enviar(cliente, conteudo.getvalue(), 'entrada.xlsx')
+    assert resposta.status_code == 202
+    assert resposta.get_json()['importacao']['total_linhas'] == 4
+    assert esperar(cliente, resposta.get_json()['importacao']['id'])['linhas_aplicadas'] == 4
+
+
+def test_cabecalho_invalido_e_recusado_no_upload(cliente):
+    resposta = enviar(cliente, b'Produto;Estoque\nX;1\n', 'saldo.csv')
+    assert resposta.status_code == 400
+    assert 'inventário' in resposta.get_json()['error']
@@ -0,0 +1,57 @@
+import itertools
+
+import pytest
+
+PREFIXOS = itertools.count()
+
+
+@pytest.fixture
+def produto(m):
+    """Produto com uma grade antiga cuja cor foi renomeada depois (o SKU ficou com a cor antiga)"""
+    with m.app.app_context():
+        produto = m.Produto(sku=f'RCB{next(PREFIXOS):03d}', descricao='Havaianas Recebimento', ativo=True)
+        m.db.session.add(produto)
+        m.db.session.flush()
+        grade = m.Grade(produto_id=produto.id, cor='Black', tamanho='37/38', estoque_atual=2,
+                        sku_grade=f'{produto.sku}-PRETO-37/38')
+        m.db.session.add(grade)
+        m.db.session.commit()
+        return produto.id, produto.sku, grade.id
+
+
+def receber(m, produto_id, cor, tamanho, quantidade=3):
+    with m.app.app_context():
+        resumo = m.RecebimentoEstoque([
+            {'produto_id': produto_id, 'cor': cor, 'tamanho': tamanho, 'quantidade': quantidade}
+        ]).aplicar('Fornecedor', 'NF-1')
+        m.db.session.commit()
+        return resumo
+
+
+def test_grade_nova_usa_o_mesmo_sku_do_cadastro(m, produto):
+    produto_id, sku, _ = produto
+    receber(m, produto_id, 'azul', '39/40')
+    with m.app.app_context():
+        grade = m.Grade.query.filter_by(produto_id=produto_id, tamanho='39/40').one()
+        assert (grade.cor, grade.sku_grade) == ('Azul', m.sku_da_grade(sku, 'azul', '39/40'))
+        assert grade.sku_grade == f'{sku}-AZUL-39/40'
+
+
+def test_sku_ja_ocupado_soma_na_grade_existente(m, produto):
+    produto_id, _, grade_id = produto
+    resumo = receber(m, produto_id, 'Preto', '37/38')
+    assert (resumo['grades_criadas'], resumo['grades_atualizadas']) == (0, 1)
+    with m.app.app_context():
+        assert m.db.session.get(m.Grade, grade_id).estoque_atual == 5
+
+
+def test_sku_de_outro_produto_e_recusado_com_mensagem(m, produto):
+    produto_id, sku, _ = produto
+    receber(m, produto_id, 'Listra-Preto', '37/38')  # RCBnnn-LISTRA-PRETO-37/38
+    with m.app.app_context():
+        outro = m.Produto(sku=f'{sku}-LISTRA', descricao='Outro', ativo=True)
+        m.db.session.add(outro)
+        m.db.session.commit()
+        outro_id = outro.id
+    with pytest.raises(ValueError, match='já é de outro produto'):
+        receber(m, outro_id, 'Preto', '37/38', quantidade=1)
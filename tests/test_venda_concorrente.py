@@ -0,0 +1,64 @@
+"""Checkout do PDV sob concorrência: centenas de vendas disputando uma grade com pouco estoque"""
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy.exc import OperationalError
+
+from ambiente import criar_grades
+
+VENDAS = 300
+ESTOQUE = 25
+
+
+def test_vendas_paralelas_nao_vendem_alem_do_estoque(m):
+    disputada, outra = criar_grades(m, 1, tamanhos=('37/38', '39/40'), estoque=ESTOQUE, prefixo='CONC')
+    with m.app.app_context():
+        itens_antes = m.ItemVenda.query.filter_by(grade_id=disputada).count()
+    
+    def vender(_):
+        cliente = m.app.test_client()
+        resposta = cliente.post('/api/pdv/venda', json={
+            'itens': [
+                {'grade_id': disputada, 'quantidade': 1, 'preco': 39.9},
+                {'grade_id': outra, 'quantidade': 0, 'preco': 39.9},
+            ],
+            'forma_pagamento': 'PIX'
+        })
+        return resposta.status_code, (resposta.get_json() or {}).get('error')
+    
+    with ThreadPoolExecutor(16) as executor:
+        resultados = list(executor.map(vender, range(VENDAS)))
+    
+    status = collections.Counter(codigo for codigo, _ in resultados)
+    assert status[500] == 0
+    assert set(status) <= {200, 400, 409}, status
+    # quem não vendeu recebeu estoque insuficiente ou conflito, nunca outro erro
+    assert all(
+        'Estoque insuficiente' in erro or 'outro terminal' in erro
+        for codigo, erro in resultados if codigo != 200
+    )
+    
+    with m.app.app_context():
+        m.db.session.expire_all()
+        grade = m.db.session.get(m.Grade, disputada)
+        vendidos = m.ItemVenda.query.filter_by(grade_id=disputada).count() - itens_antes
+        saidas = m.db.session.query(m.func.sum(m.Movimentacao.quantidade)).filter(
+            m.Movimentacao.grade_id == disputada, m.Movimentacao.tipo == 'SAIDA'
+        ).scalar() or 0
+    
+    assert grade.estoque_atual >= 0
+    assert vendidos == status[200] == saidas
+    assert grade.estoque_atual == ESTOQUE - vendidos
+    assert vendidos > 0
+
+
+def test_erro_do_banco_que_nao_e_concorrencia_sai_como_400(m, monkeypatch):
+    def disco_com_erro(*args, **kwargs):
+        raise OperationalError('UPDATE grade', {}, Exception('disk I/O error'))
+    
+    monkeypatch.setattr(m, 'registrar_itens_venda', disco_com_erro)
+    resposta = m.app.test_client().post('/api/pdv/venda', json={
+        'itens': [{'grade_id': 1, 'quantidade': 1, 'preco': 10}], 'forma_pagamento': 'PIX'
+    })
+    assert resposta.status_code == 400
+    assert 'disk I/O error' in resposta.get_json()['error']